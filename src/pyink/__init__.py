@@ -1,19 +1,26 @@
+import importlib
 import io
 import json
+import os
 import platform
 import re
+import sqlite3
 import sys
+import time
 import tokenize
 import traceback
 from contextlib import contextmanager
 from dataclasses import replace
 from datetime import datetime, timezone
 from enum import Enum
+from functools import partial
 from json.decoder import JSONDecodeError
 from pathlib import Path
 from typing import (
+    TYPE_CHECKING,
     Any,
     Collection,
+    ContextManager,
     Dict,
     Generator,
     Iterator,
@@ -35,8 +42,14 @@ from pathspec import PathSpec
 from pathspec.patterns.gitwildmatch import GitWildMatchPatternError
 
 from _pyink_version import version as __version__
-from pyink.cache import Cache
-from pyink.comments import normalize_fmt_off
+from pyink.cache import (
+    Cache,
+    DirectoryListings,
+    FileData,
+    content_digest,
+    get_cache_file,
+    merge_cache_files,
+)
 from pyink.const import (
     DEFAULT_EXCLUDES,
     DEFAULT_INCLUDES,
@@ -48,10 +61,12 @@ from pyink.files import (
     find_pyproject_toml,
     find_user_pyproject_toml,
     gen_python_files,
+    gen_python_files_from_git,
     get_gitignore,
     normalize_path_maybe_ignore,
     parse_pyproject_toml,
     path_is_excluded,
+    shard_sources,
     wrap_stream_for_windows,
 )
 from pyink.handle_ipynb_magics import (
@@ -63,30 +78,61 @@ from pyink.handle_ipynb_magics import (
     remove_trailing_semicolon,
     unmask_cell,
 )
-from pyink.linegen import LN, LineGenerator, transform_line
-from pyink.lines import EmptyLineTracker, LinesBlock
-from pyink.mode import FUTURE_FLAG_TO_FEATURE, VERSION_TO_FEATURES, Feature
+from pyink.mode import VERSION_TO_FEATURES, Feature
 from pyink.mode import Mode as Mode  # re-exported
 from pyink.mode import QuoteStyle, TargetVersion, supports_feature
-from pyink.nodes import (
-    STARS,
-    is_number_token,
-    is_simple_decorator_expression,
-    is_string_token,
-    syms,
-)
 from pyink.output import color_diff, diff, dump_to_file, err, ipynb_diff, out
-from pyink.parsing import InvalidInput  # noqa F401
-from pyink.parsing import lib2to3_parse, parse_ast, stringify_ast
-from pyink import ink
-from pyink.ranges import adjusted_lines, convert_unchanged_lines, parse_line_ranges
 from pyink.report import Changed, NothingChanged, Report
-from pyink.trans import iter_fexpr_spans
-from blib2to3.pgen2 import token
-from blib2to3.pytree import Leaf, Node
+
+if TYPE_CHECKING:
+    from pyink.nodes import LN
+    from blib2to3.pytree import Leaf, Node
 
 COMPILED = Path(__file__).suffix in (".pyd", ".so")
 
+# The formatting machinery takes longer to import than everything else together,
+# and many runs don't format anything, e.g. when every file is cached. It's only
+# imported once it's needed; these names are still available from here, through
+# `__getattr__`.
+_LAZY_IMPORTS = {
+    "EmptyLineTracker": "pyink.lines",
+    "InvalidInput": "pyink.parsing",
+    "LN": "pyink.nodes",
+    "Leaf": "blib2to3.pytree",
+    "LineGenerator": "pyink.linegen",
+    "LinesBlock": "pyink.lines",
+    "Node": "blib2to3.pytree",
+    "STARS": "pyink.nodes",
+    "adjusted_lines": "pyink.ranges",
+    "convert_unchanged_lines": "pyink.ranges",
+    "ink": "pyink.ink",
+    "is_number_token": "pyink.nodes",
+    "is_simple_decorator_expression": "pyink.nodes",
+    "is_string_token": "pyink.nodes",
+    "iter_fexpr_spans": "pyink.trans",
+    "lib2to3_parse": "pyink.parsing",
+    "normalize_fmt_off": "pyink.comments",
+    "parse_ast": "pyink.parsing",
+    "parse_line_ranges": "pyink.ranges",
+    "stringify_ast": "pyink.parsing",
+    "syms": "pyink.nodes",
+    "token": "blib2to3.pgen2.token",
+    "transform_line": "pyink.linegen",
+}
+
+
+def __getattr__(name: str) -> Any:
+    """Import the formatting machinery listed in `_LAZY_IMPORTS` when first used."""
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_LAZY_IMPORTS[name])
+    # Some of the names are modules themselves.
+    is_module = module.__name__.rpartition(".")[2] == name
+    value = module if is_module else getattr(module, name)
+    globals()[name] = value
+    return value
+
+
 # types
 FileContent = str
 Encoding = str
@@ -214,6 +260,22 @@ def validate_regex(
         raise click.BadParameter(f"Not a valid regular expression: {e}") from None
 
 
+def validate_shard(
+    ctx: click.Context,
+    param: click.Parameter,
+    value: Optional[str],
+) -> Optional[Tuple[int, int]]:
+    if value is None:
+        return None
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("Expected INDEX/COUNT, e.g. 1/4.") from None
+    if not 1 <= index <= count:
+        raise click.BadParameter("INDEX must be between 1 and COUNT.")
+    return index, count
+
+
 @click.command(
     context_settings={"help_option_names": ["-h", "--help"]},
     # While Click does set this field automatically using the docstring, mypyc
@@ -376,6 +438,24 @@ def validate_regex(
         " it. [default: --safe]"
     ),
 )
+@click.option(
+    "--cache-by-content",
+    is_flag=True,
+    help=(
+        "Also skip files whose exact contents were already found to be well formatted"
+        " under a different path, e.g. after a branch switch, in a fresh CI checkout,"
+        " or for vendored copies. Standard input is looked up the same way."
+    ),
+)
+@click.option(
+    "--fast-tokenizer",
+    is_flag=True,
+    help=(
+        "Tokenize with pyink's own tokenizer, which produces the same tokens as the"
+        " one of blib2to3 with less overhead per token. Sources it doesn't handle are"
+        " still tokenized by blib2to3."
+    ),
+)
 @click.option(
     "--required-version",
     type=str,
@@ -444,6 +524,35 @@ def validate_regex(
     ),
     show_default=True,
 )
+@click.option(
+    "--use-git-index",
+    is_flag=True,
+    help=(
+        "In a git checkout, list the files in directories with git, which knows them"
+        " from its index, instead of walking the directories. Files ignored through"
+        " .git/info/exclude or core.excludesFile are left out too. Files unmodified"
+        " since they were added to the index are checked against the cache without"
+        " reading them."
+    ),
+)
+@click.option(
+    "--cache-listings",
+    is_flag=True,
+    help=(
+        "Keep the entries of directories in the cache, with their modification time,"
+        " and only list directories again when it changed. Speeds up finding the"
+        " files to format when running repeatedly on the same project."
+    ),
+)
+@click.option(
+    "--watch",
+    is_flag=True,
+    help=(
+        "Keep running after formatting, and format files again when they change."
+        " New files in the given directories are picked up too. Uses inotify on"
+        " Linux, and polls for changes elsewhere."
+    ),
+)
 @click.option(
     "-W",
     "--workers",
@@ -453,7 +562,50 @@ def validate_regex(
         "When Black formats multiple files, it may use a process pool to speed up"
         " formatting. This option controls the number of parallel workers. This can"
         " also be specified via the PYINK_NUM_WORKERS environment variable. Defaults"
-        " to the number of CPUs in the system."
+        " to the number of CPUs this process may use, taking CPU affinity and cgroup"
+        " quotas into account, or fewer for small amounts of code."
+    ),
+)
+@click.option(
+    "--per-file-timeout",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    metavar="SECONDS",
+    help=(
+        "When formatting multiple files, give up on a file that takes longer than"
+        " this to format, and report it as a failure. Not supported on Windows."
+    ),
+)
+@click.option(
+    "--per-file-max-memory",
+    type=click.IntRange(min=1),
+    default=None,
+    metavar="MB",
+    help=(
+        "When formatting multiple files, limit the memory (address space) of each"
+        " worker process, and report files that exceed it as failures. Not"
+        " supported on Windows."
+    ),
+)
+@click.option(
+    "--start-method",
+    type=click.Choice(["fork", "forkserver", "spawn"]),
+    default=None,
+    help=(
+        "How to start the worker processes when formatting multiple files. Defaults"
+        " to the default of the platform."
+    ),
+)
+@click.option(
+    "--shard",
+    type=str,
+    callback=validate_shard,
+    metavar="INDEX/COUNT",
+    help=(
+        "Only format one of COUNT about equally large parts of the files found, to"
+        " split a run across machines. INDEX counts from 1. The parts depend on file"
+        " sizes, so all shards must see the same files, e.g. in separate checkouts."
+        " Every shard writes its own cache; combine them with `pyink cache merge`."
     ),
 )
 @click.option(
@@ -516,6 +668,8 @@ def main(  # noqa: C901
     line_ranges: Sequence[str],
     color: bool,
     fast: bool,
+    cache_by_content: bool,
+    fast_tokenizer: bool,
     pyi: bool,
     ipynb: bool,
     python_cell_magics: Sequence[str],
@@ -536,7 +690,14 @@ def main(  # noqa: C901
     extend_exclude: Optional[Pattern[str]],
     force_exclude: Optional[Pattern[str]],
     stdin_filename: Optional[str],
+    use_git_index: bool,
+    cache_listings: bool,
+    watch: bool,
     workers: Optional[int],
+    per_file_timeout: Optional[float],
+    per_file_max_memory: Optional[int],
+    start_method: Optional[str],
+    shard: Optional[Tuple[int, int]],
     src: Tuple[str, ...],
     config: Optional[str],
 ) -> None:
@@ -599,6 +760,15 @@ def main(  # noqa: C901
     if ipynb and pyi:
         err("Cannot pass both `pyi` and `ipynb` flags!")
         ctx.exit(1)
+    if shard is not None and (code is not None or "-" in src):
+        err("Cannot use --shard with code passed in as a string or standard input.")
+        ctx.exit(1)
+    if watch and (code is not None or "-" in src):
+        err("Cannot use --watch with code passed in as a string or standard input.")
+        ctx.exit(1)
+    if watch and (shard is not None or line_ranges or pyink_lines):
+        err("Cannot use --watch with --shard or --line-ranges.")
+        ctx.exit(1)
 
     write_back = WriteBack.from_configuration(check=check, diff=diff, color=color)
     if target_version:
@@ -623,6 +793,7 @@ def main(  # noqa: C901
         quote_style=(
             QuoteStyle.MAJORITY if pyink_use_majority_quotes else QuoteStyle.DOUBLE
         ),
+        fast_tokenizer=fast_tokenizer,
     )
 
     lines: List[Tuple[int, int]] = []
@@ -631,6 +802,8 @@ def main(  # noqa: C901
             err("Cannot use --line-ranges with ipynb files.")
             ctx.exit(1)
 
+        from pyink.ranges import parse_line_ranges
+
         try:
             lines = parse_line_ranges(line_ranges)
         except ValueError as e:
@@ -643,6 +816,8 @@ def main(  # noqa: C901
             fg="yellow",
         )
         if not lines:
+            from pyink.ranges import parse_line_ranges
+
             try:
                 lines = parse_line_ranges(pyink_lines)
             except ValueError as e:
@@ -679,6 +854,8 @@ def main(  # noqa: C901
                 force_exclude=force_exclude,
                 report=report,
                 stdin_filename=stdin_filename,
+                use_git_index=use_git_index,
+                cache_listings=cache_listings,
             )
         except GitWildMatchPatternError:
             ctx.exit(1)
@@ -691,7 +868,18 @@ def main(  # noqa: C901
             ctx,
         )
 
-        if len(sources) == 1:
+        if shard is not None:
+            index, count = shard
+            found = len(sources)
+            sources = shard_sources(sources, root, index, count)
+            if verbose:
+                out(
+                    f"Shard {index}/{count}: {len(sources)} of {found} files", fg="blue"
+                )
+            if not sources:
+                ctx.exit(0)
+
+        if len(sources) == 1 and not watch:
             reformat_one(
                 src=sources.pop(),
                 fast=fast,
@@ -699,21 +887,90 @@ def main(  # noqa: C901
                 mode=mode,
                 report=report,
                 lines=lines,
+                cache_by_content=cache_by_content,
+                use_git_index=use_git_index,
             )
         else:
-            from pyink.concurrency import reformat_many
-
             if lines:
                 err("Cannot use --line-ranges to format multiple files.")
                 ctx.exit(1)
-            reformat_many(
-                sources=sources,
-                fast=fast,
-                write_back=write_back,
-                mode=mode,
-                report=report,
-                workers=workers,
-            )
+            if start_method is not None:
+                import multiprocessing
+
+                if start_method not in multiprocessing.get_all_start_methods():
+                    err(f"Start method {start_method} is not supported here.")
+                    ctx.exit(1)
+            if sys.platform == "win32" and (per_file_timeout or per_file_max_memory):
+                err("Per-file limits are not supported on Windows.")
+                ctx.exit(1)
+            if watch:
+                from pyink.concurrency import Limits
+                from pyink.watch import watch_sources
+
+                watch_sources(
+                    sources=sources,
+                    directories=[Path(s) for s in src if Path(s).is_dir()],
+                    discover=partial(
+                        get_sources,
+                        root=root,
+                        src=src,
+                        quiet=quiet,
+                        verbose=verbose,
+                        include=include,
+                        exclude=exclude,
+                        extend_exclude=extend_exclude,
+                        force_exclude=force_exclude,
+                        report=report,
+                        stdin_filename=stdin_filename,
+                        use_git_index=use_git_index,
+                        cache_listings=cache_listings,
+                    ),
+                    include=include,
+                    fast=fast,
+                    write_back=write_back,
+                    mode=mode,
+                    report=report,
+                    workers=workers,
+                    cache_by_content=cache_by_content,
+                    use_git_index=use_git_index,
+                    start_method=start_method,
+                    limits=Limits(per_file_timeout, per_file_max_memory),
+                )
+                ctx.exit(report.return_code)
+            cache = None
+            if write_back not in (WriteBack.DIFF, WriteBack.COLOR_DIFF):
+                # Cached files are told apart by their stat results alone, before
+                # any worker processes are started or the formatter is imported,
+                # which is all many runs have to do.
+                cache = Cache.read(mode, by_content=cache_by_content)
+                files = {
+                    src
+                    for src in sources
+                    if str(src) != "-" and not str(src).startswith(STDIN_PLACEHOLDER)
+                }
+                if use_git_index:
+                    cache.use_git_index([src.resolve() for src in files])
+                _, cached = cache.filtered_by_stat(files)
+                for src in sorted(cached):
+                    report.done(src, Changed.CACHED)
+                sources = sources - cached
+            if sources:
+                from pyink.concurrency import Limits, reformat_many
+
+                reformat_many(
+                    sources=sources,
+                    fast=fast,
+                    write_back=write_back,
+                    mode=mode,
+                    report=report,
+                    workers=workers,
+                    cache_by_content=cache_by_content,
+                    # The cache already holds the digests from the git index.
+                    use_git_index=False,
+                    start_method=start_method,
+                    limits=Limits(per_file_timeout, per_file_max_memory),
+                    cache=cache,
+                )
 
     if verbose or not quiet:
         if code is None and (verbose or report.change_count or report.failure_count):
@@ -736,9 +993,19 @@ def get_sources(
     force_exclude: Optional[Pattern[str]],
     report: "Report",
     stdin_filename: Optional[str],
+    use_git_index: bool = False,
+    cache_listings: bool = False,
 ) -> Set[Path]:
-    """Compute the set of files to be formatted."""
+    """Compute the set of files to be formatted.
+
+    With `use_git_index`, the files in directories are listed by git when they
+    are in a git checkout, instead of walking the directories. With
+    `cache_listings`, walks skip listing directories that didn't change since the
+    last run.
+    """
+    start = time.perf_counter()
     sources: Set[Path] = set()
+    listings = DirectoryListings.read(root) if cache_listings else None
 
     using_default_exclude = exclude is None
     exclude = re_compile_maybe_verbose(DEFAULT_EXCLUDES) if exclude is None else exclude
@@ -795,6 +1062,24 @@ def get_sources(
                     root: root_gitignore,
                     path: get_gitignore(path),
                 }
+            if use_git_index:
+                listed = gen_python_files_from_git(
+                    path,
+                    root,
+                    include,
+                    exclude,
+                    extend_exclude,
+                    force_exclude,
+                    report,
+                    gitignore,
+                    verbose=verbose,
+                    quiet=quiet,
+                )
+                if listed is not None:
+                    sources.update(listed)
+                    continue
+                if verbose:
+                    out(f'"{path}" is not in a git checkout, walking it', fg="blue")
             sources.update(
                 gen_python_files(
                     path.iterdir(),
@@ -807,6 +1092,7 @@ def get_sources(
                     gitignore,
                     verbose=verbose,
                     quiet=quiet,
+                    listings=listings,
                 )
             )
         elif s == "-":
@@ -816,6 +1102,11 @@ def get_sources(
         else:
             err(f"invalid path: {s}")
 
+    if listings is not None:
+        listings.write()
+    if verbose:
+        elapsed = time.perf_counter() - start
+        out(f"Found {len(sources)} source(s) in {elapsed:.3f}s", fg="blue")
     return sources
 
 
@@ -872,11 +1163,17 @@ def reformat_one(
     report: "Report",
     *,
     lines: Collection[Tuple[int, int]] = (),
+    cache_by_content: bool = False,
+    use_git_index: bool = False,
 ) -> None:
     """Reformat a single file under `src` without spawning child processes.
 
     `fast`, `write_back`, and `mode` options are passed to
     :func:`format_file_in_place` or :func:`format_stdin_to_stdout`.
+    With `cache_by_content`, cache lookups also match files with identical
+    contents under other paths, and are performed for standard input too.
+    With `use_git_index`, the digest of a file unmodified in git is taken from
+    its index.
     """
     try:
         changed = Changed.NO
@@ -896,23 +1193,45 @@ def reformat_one(
                 mode = replace(mode, is_pyi=True)
             elif src.suffix == ".ipynb":
                 mode = replace(mode, is_ipynb=True)
-            if format_stdin_to_stdout(
+            if cache_by_content and write_back not in (
+                WriteBack.DIFF,
+                WriteBack.COLOR_DIFF,
+            ):
+                if format_stdin_to_stdout(
+                    fast=fast,
+                    write_back=write_back,
+                    mode=mode,
+                    lines=lines,
+                    cache=Cache.read(mode, by_content=True),
+                ):
+                    changed = Changed.YES
+            elif format_stdin_to_stdout(
                 fast=fast, write_back=write_back, mode=mode, lines=lines
             ):
                 changed = Changed.YES
         else:
-            cache = Cache.read(mode)
+            cache = Cache.read(mode, by_content=cache_by_content)
             if write_back not in (WriteBack.DIFF, WriteBack.COLOR_DIFF):
+                if use_git_index:
+                    cache.use_git_index([src.resolve()])
                 if not cache.is_changed(src):
                     changed = Changed.CACHED
-            if changed is not Changed.CACHED and format_file_in_place(
-                src, fast=fast, write_back=write_back, mode=mode, lines=lines
-            ):
-                changed = Changed.YES
+            grammars: Dict[Path, str] = {}
+            if changed is not Changed.CACHED:
+                from pyink.parsing import preferred_grammar
+
+                grammar = cache.get_grammar(str(src.resolve()))
+                with preferred_grammar(grammar) as choice:
+                    if format_file_in_place(
+                        src, fast=fast, write_back=write_back, mode=mode, lines=lines
+                    ):
+                        changed = Changed.YES
+                if choice.used is not None:
+                    grammars[src] = choice.used
             if (write_back is WriteBack.YES and changed is not Changed.CACHED) or (
                 write_back is WriteBack.CHECK and changed is Changed.NO
             ):
-                cache.write([src])
+                cache.write([src], grammars)
         report.done(src, changed)
     except Exception as exc:
         if report.verbose:
@@ -935,23 +1254,61 @@ def format_file_in_place(
     code to the file.
     `mode` and `fast` options are passed to :func:`format_file_contents`.
     """
+    st = src.stat()
+    changed, _ = format_file_bytes_in_place(
+        src, st, src.read_bytes(), fast, mode, write_back, lock, lines=lines
+    )
+    return changed
+
+
+def format_file_bytes_in_place(
+    src: Path,
+    st: os.stat_result,
+    data: bytes,
+    fast: bool,
+    mode: Mode,
+    write_back: WriteBack = WriteBack.NO,
+    lock: Any = None,
+    *,
+    lines: Collection[Tuple[int, int]] = (),
+    diffs: Optional[List[Tuple[str, Encoding, NewLine]]] = None,
+    timeout: Optional[float] = None,
+) -> Tuple[bool, FileData]:
+    """Like :func:`format_file_in_place`, with `src` already read.
+
+    `st` and `data` are the stat result and the contents of `src`. Return whether
+    it changed, and its file data for the cache after formatting, computed from
+    the bytes in memory instead of reading the file again.
+
+    If `diffs` is given, a diff is appended to it, along with the encoding and
+    newline style to write it with, instead of being written to stdout.
+
+    With `timeout`, formatting is interrupted by a TimeLimitError after that many
+    seconds. Writing the result back never is, so `src` can't be left truncated.
+    """
     if src.suffix == ".pyi":
         mode = replace(mode, is_pyi=True)
     elif src.suffix == ".ipynb":
         mode = replace(mode, is_ipynb=True)
 
-    then = datetime.fromtimestamp(src.stat().st_mtime, timezone.utc)
+    file_data = FileData(st.st_mtime, st.st_size, content_digest(data))
+    then = datetime.fromtimestamp(st.st_mtime, timezone.utc)
     header = b""
-    with open(src, "rb") as buf:
-        if mode.skip_source_first_line:
-            header = buf.readline()
-        src_contents, encoding, newline = decode_bytes(buf.read())
+    if mode.skip_source_first_line:
+        header = data[: data.find(b"\n") + 1] or data
+    src_contents, encoding, newline = decode_bytes(data[len(header) :])
+    limit: ContextManager[None] = nullcontext()
+    if timeout is not None:
+        from pyink.concurrency import time_limit
+
+        limit = time_limit(timeout)
     try:
-        dst_contents = format_file_contents(
-            src_contents, fast=fast, mode=mode, lines=lines
-        )
+        with limit:
+            dst_contents = format_file_contents(
+                src_contents, fast=fast, mode=mode, lines=lines
+            )
     except NothingChanged:
-        return False
+        return False, file_data
     except JSONDecodeError:
         raise ValueError(
             f"File '{src}' cannot be parsed as valid Jupyter notebook."
@@ -962,6 +1319,9 @@ def format_file_in_place(
     if write_back == WriteBack.YES:
         with open(src, "w", encoding=encoding, newline=newline) as f:
             f.write(dst_contents)
+        dst_data = dst_contents.replace("\n", newline).encode(encoding)
+        st = src.stat()
+        file_data = FileData(st.st_mtime, st.st_size, content_digest(dst_data))
     elif write_back in (WriteBack.DIFF, WriteBack.COLOR_DIFF):
         now = datetime.now(timezone.utc)
         src_name = f"{src}\t{then}"
@@ -974,18 +1334,31 @@ def format_file_in_place(
         if write_back == WriteBack.COLOR_DIFF:
             diff_contents = color_diff(diff_contents)
 
-        with lock or nullcontext():
-            f = io.TextIOWrapper(
-                sys.stdout.buffer,
-                encoding=encoding,
-                newline=newline,
-                write_through=True,
-            )
-            f = wrap_stream_for_windows(f)
-            f.write(diff_contents)
-            f.detach()
+        if diffs is not None:
+            diffs.append((diff_contents, encoding, newline))
+        else:
+            write_diff(diff_contents, encoding, newline, lock)
 
-    return True
+    return True, file_data
+
+
+def write_diff(
+    diff_contents: str, encoding: Encoding, newline: NewLine, lock: Any = None
+) -> None:
+    """Write `diff_contents` to stdout, with the encoding and newlines of its file.
+
+    `lock` keeps diffs written from several processes from interleaving.
+    """
+    with lock or nullcontext():
+        f = io.TextIOWrapper(
+            sys.stdout.buffer,
+            encoding=encoding,
+            newline=newline,
+            write_through=True,
+        )
+        f = wrap_stream_for_windows(f)
+        f.write(diff_contents)
+        f.detach()
 
 
 def format_stdin_to_stdout(
@@ -995,6 +1368,7 @@ def format_stdin_to_stdout(
     write_back: WriteBack = WriteBack.NO,
     mode: Mode,
     lines: Collection[Tuple[int, int]] = (),
+    cache: Optional[Cache] = None,
 ) -> bool:
     """Format file on stdin. Return True if changed.
 
@@ -1003,16 +1377,31 @@ def format_stdin_to_stdout(
     If `write_back` is YES, write reformatted code back to stdout. If it is DIFF,
     write a diff to stdout. The `mode` argument is passed to
     :func:`format_file_contents`.
+
+    If `cache` is given and the input is byte-identical to contents it knows to be
+    well formatted, formatting is skipped altogether.
     """
     then = datetime.now(timezone.utc)
 
     if content is None:
-        src, encoding, newline = decode_bytes(sys.stdin.buffer.read())
+        src_bytes = sys.stdin.buffer.read()
+        src, encoding, newline = decode_bytes(src_bytes)
     else:
+        src_bytes = content.encode("utf-8")
         src, encoding, newline = content, "utf-8", ""
 
     dst = src
     try:
+        # The first line is skipped for files only, so cached contents don't apply.
+        if (
+            cache is not None
+            and not mode.skip_source_first_line
+            and cache.is_known_content(
+                src_bytes, is_pyi=mode.is_pyi, is_ipynb=mode.is_ipynb
+            )
+        ):
+            return False
+
         dst = format_file_contents(src, fast=fast, mode=mode, lines=lines)
         return True
 
@@ -1230,6 +1619,8 @@ def format_str(
     # parentheses.  Admittedly ugly.
     if src_contents != dst_contents:
         if lines:
+            from pyink.ranges import adjusted_lines
+
             lines = adjusted_lines(lines, src_contents, dst_contents)
         return _format_str_once(dst_contents, mode=mode, lines=lines)
     return dst_contents
@@ -1238,22 +1629,43 @@ def format_str(
 def _format_str_once(
     src_contents: str, *, mode: Mode, lines: Collection[Tuple[int, int]] = ()
 ) -> str:
-    src_node = lib2to3_parse(src_contents.lstrip(), mode.target_versions)
+    from pyink.annotation import annotate_tree
+    from pyink.comments import normalize_fmt_off
+    from pyink.linegen import LineGenerator, transform_line
+    from pyink.lines import EmptyLineTracker, LinesBlock
+    from pyink.parsing import lib2to3_parse
+    from pyink.ranges import convert_unchanged_lines
+
+    src_node = lib2to3_parse(
+        src_contents.lstrip(),
+        mode.target_versions,
+        fast_tokenizer=mode.fast_tokenizer,
+    )
     dst_blocks: List[LinesBlock] = []
+    # Everything the stages below need to know about the tree, in one pass.
+    annotations = annotate_tree(
+        src_node,
+        future_imports=(None if mode.target_versions else get_future_imports(src_node)),
+        detect_features=not mode.target_versions,
+    )
     if mode.target_versions:
         versions = mode.target_versions
     else:
-        future_imports = get_future_imports(src_node)
-        versions = detect_target_versions(src_node, future_imports=future_imports)
+        versions = {
+            version
+            for version in TargetVersion
+            if annotations.features <= VERSION_TO_FEATURES[version]
+        }
 
     if mode.string_normalization and mode.quote_style == QuoteStyle.MAJORITY:
-        mode = replace(mode, majority_quote=ink.majority_quote(src_node))
+        mode = replace(mode, majority_quote=annotations.majority_quote)
     context_manager_features = {
         feature
         for feature in {Feature.PARENTHESIZED_CONTEXT_MANAGERS}
         if supports_feature(versions, feature)
     }
-    normalize_fmt_off(src_node, mode, lines)
+    if annotations.fmt_pass_leaves:
+        normalize_fmt_off(src_node, mode, lines, annotations.fmt_pass_leaves)
     if lines:
         # This should be called after normalize_fmt_off.
         convert_unchanged_lines(src_node, lines)
@@ -1305,8 +1717,8 @@ def decode_bytes(src: bytes) -> Tuple[FileContent, Encoding, NewLine]:
         return tiow.read(), encoding, newline
 
 
-def get_features_used(  # noqa: C901
-    node: Node, *, future_imports: Optional[Set[str]] = None
+def get_features_used(
+    node: "Node", *, future_imports: Optional[Set[str]] = None
 ) -> Set[Feature]:
     """Return a set of (relatively) new Python features used in this file.
 
@@ -1325,140 +1737,13 @@ def get_features_used(  # noqa: C901
     - except* clause;
     - variadic generics;
     """
-    features: Set[Feature] = set()
-    if future_imports:
-        features |= {
-            FUTURE_FLAG_TO_FEATURE[future_import]
-            for future_import in future_imports
-            if future_import in FUTURE_FLAG_TO_FEATURE
-        }
+    from pyink.annotation import annotate_tree
 
-    for n in node.pre_order():
-        if is_string_token(n):
-            value_head = n.value[:2]
-            if value_head in {'f"', 'F"', "f'", "F'", "rf", "fr", "RF", "FR"}:
-                features.add(Feature.F_STRINGS)
-                if Feature.DEBUG_F_STRINGS not in features:
-                    for span_beg, span_end in iter_fexpr_spans(n.value):
-                        if n.value[span_beg : span_end - 1].rstrip().endswith("="):
-                            features.add(Feature.DEBUG_F_STRINGS)
-                            break
-
-        elif is_number_token(n):
-            if "_" in n.value:
-                features.add(Feature.NUMERIC_UNDERSCORES)
-
-        elif n.type == token.SLASH:
-            if n.parent and n.parent.type in {
-                syms.typedargslist,
-                syms.arglist,
-                syms.varargslist,
-            }:
-                features.add(Feature.POS_ONLY_ARGUMENTS)
-
-        elif n.type == token.COLONEQUAL:
-            features.add(Feature.ASSIGNMENT_EXPRESSIONS)
-
-        elif n.type == syms.decorator:
-            if len(n.children) > 1 and not is_simple_decorator_expression(
-                n.children[1]
-            ):
-                features.add(Feature.RELAXED_DECORATORS)
-
-        elif (
-            n.type in {syms.typedargslist, syms.arglist}
-            and n.children
-            and n.children[-1].type == token.COMMA
-        ):
-            if n.type == syms.typedargslist:
-                feature = Feature.TRAILING_COMMA_IN_DEF
-            else:
-                feature = Feature.TRAILING_COMMA_IN_CALL
-
-            for ch in n.children:
-                if ch.type in STARS:
-                    features.add(feature)
-
-                if ch.type == syms.argument:
-                    for argch in ch.children:
-                        if argch.type in STARS:
-                            features.add(feature)
-
-        elif (
-            n.type in {syms.return_stmt, syms.yield_expr}
-            and len(n.children) >= 2
-            and n.children[1].type == syms.testlist_star_expr
-            and any(child.type == syms.star_expr for child in n.children[1].children)
-        ):
-            features.add(Feature.UNPACKING_ON_FLOW)
-
-        elif (
-            n.type == syms.annassign
-            and len(n.children) >= 4
-            and n.children[3].type == syms.testlist_star_expr
-        ):
-            features.add(Feature.ANN_ASSIGN_EXTENDED_RHS)
-
-        elif (
-            n.type == syms.with_stmt
-            and len(n.children) > 2
-            and n.children[1].type == syms.atom
-        ):
-            atom_children = n.children[1].children
-            if (
-                len(atom_children) == 3
-                and atom_children[0].type == token.LPAR
-                and _contains_asexpr(atom_children[1])
-                and atom_children[2].type == token.RPAR
-            ):
-                features.add(Feature.PARENTHESIZED_CONTEXT_MANAGERS)
-
-        elif n.type == syms.match_stmt:
-            features.add(Feature.PATTERN_MATCHING)
-
-        elif (
-            n.type == syms.except_clause
-            and len(n.children) >= 2
-            and n.children[1].type == token.STAR
-        ):
-            features.add(Feature.EXCEPT_STAR)
-
-        elif n.type in {syms.subscriptlist, syms.trailer} and any(
-            child.type == syms.star_expr for child in n.children
-        ):
-            features.add(Feature.VARIADIC_GENERICS)
-
-        elif (
-            n.type == syms.tname_star
-            and len(n.children) == 3
-            and n.children[2].type == syms.star_expr
-        ):
-            features.add(Feature.VARIADIC_GENERICS)
-
-        elif n.type in (syms.type_stmt, syms.typeparams):
-            features.add(Feature.TYPE_PARAMS)
-
-    return features
-
-
-def _contains_asexpr(node: Union[Node, Leaf]) -> bool:
-    """Return True if `node` contains an as-pattern."""
-    if node.type == syms.asexpr_test:
-        return True
-    elif node.type == syms.atom:
-        if (
-            len(node.children) == 3
-            and node.children[0].type == token.LPAR
-            and node.children[2].type == token.RPAR
-        ):
-            return _contains_asexpr(node.children[1])
-    elif node.type == syms.testlist_gexp:
-        return any(_contains_asexpr(child) for child in node.children)
-    return False
+    return annotate_tree(node, future_imports=future_imports).features
 
 
 def detect_target_versions(
-    node: Node, *, future_imports: Optional[Set[str]] = None
+    node: "Node", *, future_imports: Optional[Set[str]] = None
 ) -> Set[TargetVersion]:
     """Detect the version to target based on the nodes used."""
     features = get_features_used(node, future_imports=future_imports)
@@ -1467,11 +1752,17 @@ def detect_target_versions(
     }
 
 
-def get_future_imports(node: Node) -> Set[str]:
+def get_future_imports(node: "Node") -> Set[str]:
     """Return a set of __future__ imports in the file."""
+    from pyink.nodes import syms
+    from blib2to3.pgen2 import token
+    from blib2to3.pytree import Leaf
+
     imports: Set[str] = set()
 
-    def get_imports_from_children(children: List[LN]) -> Generator[str, None, None]:
+    def get_imports_from_children(
+        children: List["LN"],
+    ) -> Generator[str, None, None]:
         for child in children:
             if isinstance(child, Leaf):
                 if child.type == token.NAME:
@@ -1519,6 +1810,8 @@ def get_future_imports(node: Node) -> Set[str]:
 
 def assert_equivalent(src: str, dst: str) -> None:
     """Raise AssertionError if `src` and `dst` aren't equivalent."""
+    from pyink.parsing import parse_ast, stringify_ast
+
     try:
         src_ast = parse_ast(src)
     except Exception as exc:
@@ -1587,6 +1880,64 @@ def nullcontext() -> Iterator[None]:
     yield
 
 
+@click.group(
+    name="pyink cache",
+    context_settings={"help_option_names": ["-h", "--help"]},
+    help="Manage the pyink cache.",
+)
+def cache_main() -> None:
+    pass
+
+
+@cache_main.command(
+    name="merge",
+    context_settings={"help_option_names": ["-h", "--help"]},
+    help=(
+        "Merge the caches written by sharded runs into the cache of this machine,"
+        " so the next full run starts warm. Each SOURCE is a cache file, or a"
+        " directory with cache files like the PYINK_CACHE_DIR of a shard."
+    ),
+)
+@click.option(
+    "--into",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Merge into the cache files in this directory instead of the cache.",
+)
+@click.argument(
+    "sources",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, path_type=Path),
+    metavar="SOURCE ...",
+)
+@click.pass_context
+def cache_merge(
+    ctx: click.Context, into: Optional[Path], sources: Tuple[Path, ...]
+) -> None:
+    target_dir = into if into is not None else get_cache_file(Mode()).parent
+    cache_files: Dict[str, List[Path]] = {}
+    for source in sources:
+        if source.is_dir():
+            if (source / __version__).is_dir():
+                source = source / __version__
+            found = sorted(source.glob("cache.*.db"))
+        else:
+            found = [source]
+        for cache_file in found:
+            cache_files.setdefault(cache_file.name, []).append(cache_file)
+    if not cache_files:
+        err("No cache files found.")
+        ctx.exit(1)
+    for name, files in sorted(cache_files.items()):
+        try:
+            merge_cache_files(target_dir / name, files)
+        except (OSError, sqlite3.Error, ValueError) as e:
+            err(f"Cannot merge into {target_dir / name}: {e}")
+            ctx.exit(1)
+        out(f"Merged {len(files)} file(s) into {target_dir / name}")
+
+
 def patched_main() -> None:
     # PyInstaller patches multiprocessing to need freeze_support() even in non-Windows
     # environments so just assume we always need to call it if frozen.
@@ -1595,7 +1946,12 @@ def patched_main() -> None:
 
         freeze_support()
 
-    main()
+    # `pyink cache ...` manages the cache, unless there is a path to format by that
+    # name, as before the subcommand existed.
+    if sys.argv[1:2] == ["cache"] and not os.path.exists("cache"):
+        cache_main(args=sys.argv[2:], prog_name="pyink cache")
+    else:
+        main()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+"""
+What the formatter needs to know about a tree before generating any line from it,
+collected in a single pass over the tree.
+"""
+
+from dataclasses import dataclass, field
+from typing import Final, List, Optional, Set, Union
+
+from pyink.comments import has_fmt_marker
+from pyink.mode import FUTURE_FLAG_TO_FEATURE, Feature, Quote
+from pyink.nodes import STARS, is_simple_decorator_expression, syms
+from pyink.strings import STRING_PREFIX_CHARS
+from pyink.trans import iter_fexpr_spans
+from blib2to3.pgen2 import token
+from blib2to3.pytree import Leaf, Node
+
+LN = Union[Leaf, Node]
+
+F_STRING_HEADS: Final = {'f"', 'F"', "f'", "F'", "rf", "fr", "RF", "FR"}
+# Node types that can tell about the features used. For leaves, that is decided
+# by their type alone.
+FEATURE_NODE_TYPES: Final = {
+    syms.decorator,
+    syms.typedargslist,
+    syms.arglist,
+    syms.return_stmt,
+    syms.yield_expr,
+    syms.annassign,
+    syms.with_stmt,
+    syms.match_stmt,
+    syms.except_clause,
+    syms.subscriptlist,
+    syms.trailer,
+    syms.tname_star,
+    syms.type_stmt,
+    syms.typeparams,
+}
+
+
+@dataclass
+class TreeAnnotations:
+    """What `annotate_tree` found in a tree."""
+
+    features: Set[Feature] = field(default_factory=set)
+    # Not counting triple-quoted strings.
+    single_quotes: int = 0
+    double_quotes: int = 0
+    # Leaves with a `# fmt: off`, `# fmt: skip` or similar comment in their
+    # prefix, in the order of the tree.
+    fmt_pass_leaves: List[Leaf] = field(default_factory=list)
+
+    @property
+    def majority_quote(self) -> Quote:
+        """The quote most strings use, not counting triple-quoted ones.
+
+        If there are as many single as double quotes, that's double quotes.
+        """
+        if self.single_quotes > self.double_quotes:
+            return Quote.SINGLE
+        return Quote.DOUBLE
+
+
+def annotate_tree(
+    node: Node,
+    *,
+    future_imports: Optional[Set[str]] = None,
+    detect_features: bool = True,
+) -> TreeAnnotations:
+    """Walk `node` once, collecting the features it uses (if `detect_features`,
+    see `get_features_used`), the quotes of its strings and the leaves with
+    fmt: off/skip comments.
+    """
+    annotations = TreeAnnotations()
+    features = annotations.features
+    if detect_features and future_imports:
+        features |= {
+            FUTURE_FLAG_TO_FEATURE[future_import]
+            for future_import in future_imports
+            if future_import in FUTURE_FLAG_TO_FEATURE
+        }
+    fmt_pass_leaves = annotations.fmt_pass_leaves
+    for n in node.pre_order():
+        if isinstance(n, Leaf):
+            t = n.type
+            if has_fmt_marker(n.prefix):
+                fmt_pass_leaves.append(n)
+            if t == token.STRING:
+                value = n.value.lstrip(STRING_PREFIX_CHARS)
+                if not value.startswith(("'''", '"""')):
+                    if value.startswith('"'):
+                        annotations.double_quotes += 1
+                    else:
+                        annotations.single_quotes += 1
+            if not detect_features:
+                continue
+            if t == token.STRING:
+                _add_string_features(n, features)
+            elif t == token.NUMBER:
+                if "_" in n.value:
+                    features.add(Feature.NUMERIC_UNDERSCORES)
+            elif t == token.SLASH:
+                if n.parent and n.parent.type in {
+                    syms.typedargslist,
+                    syms.arglist,
+                    syms.varargslist,
+                }:
+                    features.add(Feature.POS_ONLY_ARGUMENTS)
+            elif t == token.COLONEQUAL:
+                features.add(Feature.ASSIGNMENT_EXPRESSIONS)
+        elif detect_features and n.type in FEATURE_NODE_TYPES:
+            _add_node_features(n, features)
+    return annotations
+
+
+def _add_string_features(leaf: Leaf, features: Set[Feature]) -> None:
+    if leaf.value[:2] in F_STRING_HEADS:
+        features.add(Feature.F_STRINGS)
+        if Feature.DEBUG_F_STRINGS not in features:
+            for span_beg, span_end in iter_fexpr_spans(leaf.value):
+                if leaf.value[span_beg : span_end - 1].rstrip().endswith("="):
+                    features.add(Feature.DEBUG_F_STRINGS)
+                    break
+
+
+def _add_node_features(n: LN, features: Set[Feature]) -> None:  # noqa: C901
+    if n.type == syms.decorator:
+        if len(n.children) > 1 and not is_simple_decorator_expression(n.children[1]):
+            features.add(Feature.RELAXED_DECORATORS)
+
+    elif (
+        n.type in {syms.typedargslist, syms.arglist}
+        and n.children
+        and n.children[-1].type == token.COMMA
+    ):
+        if n.type == syms.typedargslist:
+            feature = Feature.TRAILING_COMMA_IN_DEF
+        else:
+            feature = Feature.TRAILING_COMMA_IN_CALL
+
+        for ch in n.children:
+            if ch.type in STARS:
+                features.add(feature)
+
+            if ch.type == syms.argument:
+                for argch in ch.children:
+                    if argch.type in STARS:
+                        features.add(feature)
+
+    elif (
+        n.type in {syms.return_stmt, syms.yield_expr}
+        and len(n.children) >= 2
+        and n.children[1].type == syms.testlist_star_expr
+        and any(child.type == syms.star_expr for child in n.children[1].children)
+    ):
+        features.add(Feature.UNPACKING_ON_FLOW)
+
+    elif (
+        n.type == syms.annassign
+        and len(n.children) >= 4
+        and n.children[3].type == syms.testlist_star_expr
+    ):
+        features.add(Feature.ANN_ASSIGN_EXTENDED_RHS)
+
+    elif (
+        n.type == syms.with_stmt
+        and len(n.children) > 2
+        and n.children[1].type == syms.atom
+    ):
+        atom_children = n.children[1].children
+        if (
+            len(atom_children) == 3
+            and atom_children[0].type == token.LPAR
+            and _contains_asexpr(atom_children[1])
+            and atom_children[2].type == token.RPAR
+        ):
+            features.add(Feature.PARENTHESIZED_CONTEXT_MANAGERS)
+
+    elif n.type == syms.match_stmt:
+        features.add(Feature.PATTERN_MATCHING)
+
+    elif (
+        n.type == syms.except_clause
+        and len(n.children) >= 2
+        and n.children[1].type == token.STAR
+    ):
+        features.add(Feature.EXCEPT_STAR)
+
+    elif n.type in {syms.subscriptlist, syms.trailer} and any(
+        child.type == syms.star_expr for child in n.children
+    ):
+        features.add(Feature.VARIADIC_GENERICS)
+
+    elif (
+        n.type == syms.tname_star
+        and len(n.children) == 3
+        and n.children[2].type == syms.star_expr
+    ):
+        features.add(Feature.VARIADIC_GENERICS)
+
+    elif n.type in (syms.type_stmt, syms.typeparams):
+        features.add(Feature.TYPE_PARAMS)
+
+
+def _contains_asexpr(node: LN) -> bool:
+    """Return True if `node` contains an as-pattern."""
+    if node.type == syms.asexpr_test:
+        return True
+    elif node.type == syms.atom:
+        if (
+            len(node.children) == 3
+            and node.children[0].type == token.LPAR
+            and node.children[2].type == token.RPAR
+        ):
+            return _contains_asexpr(node.children[1])
+    elif node.type == syms.testlist_gexp:
+        return any(_contains_asexpr(child) for child in node.children)
+    return False
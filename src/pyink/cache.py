@@ -1,17 +1,32 @@
 """Caching of formatted files with feature-based invalidation."""
 
 import hashlib
+import json
 import os
-import pickle
+import sqlite3
 import sys
-import tempfile
-from dataclasses import dataclass, field
+import time
+from contextlib import closing
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from typing import Dict, Iterable, NamedTuple, Set, Tuple
+from typing import (
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from platformdirs import user_cache_dir
 
 from _pyink_version import version as __version__
+from pyink import git
 from pyink.mode import Mode
 
 if sys.version_info >= (3, 11):
@@ -19,6 +34,49 @@ if sys.version_info >= (3, 11):
 else:
     from typing_extensions import Self
 
+# Bump this whenever the layout of the tables below changes. Cache files with a
+# different version are discarded and rebuilt on the next write.
+SCHEMA_VERSION = 4
+SCHEMA = """
+CREATE TABLE files (
+    path TEXT PRIMARY KEY,
+    st_mtime REAL NOT NULL,
+    st_size INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE contents (
+    key TEXT PRIMARY KEY
+);
+CREATE TABLE durations (
+    path TEXT PRIMARY KEY,
+    seconds REAL NOT NULL
+);
+CREATE TABLE grammars (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+"""
+TABLES = ("files", "contents", "durations", "grammars")
+# The same for the directory listings, which are kept in a file of their own since
+# they don't depend on the mode.
+LISTINGS_SCHEMA_VERSION = 1
+LISTINGS_SCHEMA = """
+CREATE TABLE listings (
+    path TEXT PRIMARY KEY,
+    st_mtime_ns INTEGER NOT NULL,
+    entries TEXT NOT NULL
+);
+"""
+LISTINGS_TABLES = ("listings",)
+# Directories modified more recently than this many seconds before they were
+# listed aren't cached: with a coarse mtime resolution, a later change in the same
+# tick would go unnoticed.
+LISTING_MIN_AGE = 2.0
+# How long to wait for another pyink process to finish writing.
+LOCK_TIMEOUT = 30.0
+# SQLite limits the number of parameters of a single statement.
+MAX_QUERY_PARAMETERS = 500
+
 
 class FileData(NamedTuple):
     st_mtime: float
@@ -26,6 +84,17 @@ class FileData(NamedTuple):
     hash: str
 
 
+def content_digest(data: bytes) -> str:
+    """Return the digest of the file contents `data`.
+
+    It's the id git gives the contents as a blob, so the digests of files that are
+    unmodified in a git checkout can be taken from its index, without reading
+    the files.
+    """
+    header = b"blob %d\0" % len(data)
+    return hashlib.sha1(header + data).hexdigest()
+
+
 def get_cache_dir() -> Path:
     """Get the cache directory used by pyink.
 
@@ -47,41 +116,224 @@ CACHE_DIR = get_cache_dir()
 
 
 def get_cache_file(mode: Mode) -> Path:
-    return CACHE_DIR / f"cache.{mode.get_cache_key()}.pickle"
+    return CACHE_DIR / f"cache.{mode.get_cache_key()}.db"
+
+
+def get_listings_file() -> Path:
+    return CACHE_DIR / "listings.db"
+
+
+def _connect(cache_file: Path, *, create: bool) -> sqlite3.Connection:
+    """Open the SQLite database in `cache_file`.
+
+    Without `create`, the database is opened read-only and must already exist.
+    """
+    if create:
+        db = sqlite3.connect(str(cache_file), timeout=LOCK_TIMEOUT)
+    else:
+        uri = f"{cache_file.resolve().as_uri()}?mode=ro"
+        db = sqlite3.connect(uri, timeout=LOCK_TIMEOUT, uri=True)
+    return db
+
+
+def _ensure_schema(
+    db: sqlite3.Connection,
+    *,
+    listings: bool = False,
+) -> None:
+    """Create the tables, replacing any of another schema version.
+
+    With `listings`, those of the directory listings file instead. Must run in a
+    write transaction, so it can't race with other processes.
+    """
+    if listings:
+        schema_version, schema, tables = (
+            LISTINGS_SCHEMA_VERSION,
+            LISTINGS_SCHEMA,
+            LISTINGS_TABLES,
+        )
+    else:
+        schema_version, schema, tables = SCHEMA_VERSION, SCHEMA, TABLES
+    (version,) = db.execute("PRAGMA user_version").fetchone()
+    if version != schema_version:
+        for table in tables:
+            db.execute(f"DROP TABLE IF EXISTS main.{table}")
+        for statement in schema.split(";"):
+            if statement.strip():
+                db.execute(statement)
+        db.execute(f"PRAGMA user_version = {schema_version}")
+
+
+def _write_database(
+    cache_file: Path, write: Callable[[sqlite3.Connection], None]
+) -> None:
+    """Call `write` with a connection to the database in `cache_file`.
+
+    Failing to write is not an error, the entries are only missing next time. A
+    file that isn't a database is replaced with a fresh one and written again.
+    One that is locked for longer than LOCK_TIMEOUT, read-only or failing with
+    I/O errors is left alone, since other pyink processes may be using it.
+    """
+    for attempt in range(2):
+        try:
+            with closing(_connect(cache_file, create=True)) as db:
+                # Every write is a single short transaction, and losing the latest
+                # entries after a power failure only costs a re-check.
+                db.execute("PRAGMA synchronous = OFF")
+                write(db)
+        except sqlite3.OperationalError:
+            pass
+        except sqlite3.DatabaseError:
+            # Not a database we can use. Start over with a fresh file.
+            if attempt == 0:
+                try:
+                    cache_file.unlink()
+                except OSError:
+                    return
+                continue
+        except (OSError, sqlite3.Error):
+            pass
+        return
+
+
+def merge_cache_files(target: Path, sources: Iterable[Path]) -> None:
+    """Merge the cache databases in `sources` into the one in `target`.
+
+    Sharded runs each write their own cache, and merging them lets the next full
+    run start warm. Entries for the same path are taken from the last source that
+    has them. Raise ValueError if a source isn't a cache of this pyink version, in
+    which case nothing is merged.
+    """
+    sources = list(sources)
+    for source in sources:
+        with closing(_connect(source, create=False)) as db:
+            (version,) = db.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            raise ValueError(f"{source} is not a cache of this version of pyink")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with closing(_connect(target, create=True)) as db:
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            _ensure_schema(db)
+        for source in sources:
+            # Databases can't be attached within a transaction.
+            db.execute("ATTACH DATABASE ? AS source", (str(source),))
+            try:
+                with db:
+                    db.execute("BEGIN IMMEDIATE")
+                    for table in TABLES:
+                        db.execute(
+                            f"INSERT OR REPLACE INTO main.{table}"
+                            f" SELECT * FROM source.{table}"
+                        )
+            finally:
+                db.execute("DETACH DATABASE source")
 
 
 @dataclass
 class Cache:
+    """Formatting results for `mode`, stored in an SQLite database.
+
+    Entries are only read from disk when they are looked up, and `write` upserts
+    just the given entries in a single transaction, so concurrent pyink processes
+    don't overwrite each other's results. `file_data` holds the entries that were
+    looked up or written so far; it takes precedence over the database.
+    """
+
     mode: Mode
     cache_file: Path
     file_data: Dict[str, FileData] = field(default_factory=dict)
+    # When set, a file also counts as unchanged if any file with byte-identical
+    # contents was cached before, regardless of its path.
+    by_content: bool = False
+    # How long formatting each file took the last time it was formatted, in
+    # seconds. Used to schedule the slowest files first.
+    durations: Dict[str, float] = field(default_factory=dict)
+    # The grammar each file was parsed with the last time, to try it first.
+    grammars: Dict[str, str] = field(default_factory=dict)
+    # Digests of files that are unmodified in the git index, by resolved path.
+    git_digests: Dict[str, str] = field(default_factory=dict)
+    _content_keys: Set[str] = field(default_factory=set, repr=False)
+    _missing: Set[str] = field(default_factory=set, repr=False)
 
     @classmethod
-    def read(cls, mode: Mode) -> Self:
-        """Read the cache if it exists and is well formed.
+    def read(cls, mode: Mode, *, by_content: bool = False) -> Self:
+        """Open the cache for `mode`.
 
-        If it is not well formed, the call to write later should
+        Entries are loaded lazily. If the cache file is missing or not well formed,
+        lookups behave as if it was empty, and the call to write later should
         resolve the issue.
         """
-        cache_file = get_cache_file(mode)
-        if not cache_file.exists():
-            return cls(mode, cache_file)
+        return cls(mode, get_cache_file(mode), by_content=by_content)
 
-        with cache_file.open("rb") as fobj:
-            try:
-                data: Dict[str, Tuple[float, int, str]] = pickle.load(fobj)
-                file_data = {k: FileData(*v) for k, v in data.items()}
-            except (pickle.UnpicklingError, ValueError, IndexError):
-                return cls(mode, cache_file)
+    def _select(self, query: str, keys: Collection[str]) -> List[Tuple[Any, ...]]:
+        """Run `query` once per chunk of `keys` and return all rows.
+
+        `query` must contain a single `{}` placeholder for the list of keys.
+        """
+        if not keys or not self.cache_file.exists():
+            return []
+        keys = list(keys)
+        rows: List[Tuple[Any, ...]] = []
+        try:
+            with closing(_connect(self.cache_file, create=False)) as db:
+                (version,) = db.execute("PRAGMA user_version").fetchone()
+                if version != SCHEMA_VERSION:
+                    return []
+                for start in range(0, len(keys), MAX_QUERY_PARAMETERS):
+                    chunk = keys[start : start + MAX_QUERY_PARAMETERS]
+                    sql = query.format(",".join("?" * len(chunk)))
+                    rows.extend(db.execute(sql, chunk).fetchall())
+        except sqlite3.Error:
+            return []
+        return rows
+
+    def _load(self, paths: Iterable[str]) -> None:
+        """Fetch the entries for `paths` that weren't looked up yet."""
+        todo = {
+            path
+            for path in paths
+            if path not in self.file_data and path not in self._missing
+        }
+        rows = self._select(
+            "SELECT path, st_mtime, st_size, hash FROM files WHERE path IN ({})", todo
+        )
+        for path, *data in rows:
+            self.file_data[path] = FileData(*data)
+        self._missing.update(todo.difference(self.file_data))
+        rows = self._select(
+            "SELECT path, seconds FROM durations WHERE path IN ({})",
+            todo.difference(self.durations),
+        )
+        self.durations.update(rows)
+        rows = self._select(
+            "SELECT path, name FROM grammars WHERE path IN ({})",
+            todo.difference(self.grammars),
+        )
+        self.grammars.update(rows)
+
+    def _load_content_keys(self, keys: Iterable[str]) -> None:
+        """Fetch which of the content `keys` are known to the database."""
+        todo = set(keys).difference(self._content_keys)
+        rows = self._select("SELECT key FROM contents WHERE key IN ({})", todo)
+        self._content_keys.update(key for (key,) in rows)
 
-        return cls(mode, cache_file, file_data)
+    def get(self, path: str) -> Optional[FileData]:
+        """Return the cached entry for the resolved `path`, if any."""
+        self._load([path])
+        return self.file_data.get(path)
+
+    def get_grammar(self, path: str) -> Optional[str]:
+        """Return the grammar the resolved `path` was parsed with last, if known."""
+        self._load([path])
+        return self.grammars.get(path)
 
     @staticmethod
     def hash_digest(path: Path) -> str:
         """Return hash digest for path."""
 
         data = path.read_bytes()
-        return hashlib.sha256(data).hexdigest()
+        return content_digest(data)
 
     @staticmethod
     def get_file_data(path: Path) -> FileData:
@@ -91,21 +343,135 @@ class Cache:
         hash = Cache.hash_digest(path)
         return FileData(stat.st_mtime, stat.st_size, hash)
 
-    def is_changed(self, source: Path) -> bool:
-        """Check if source has changed compared to cached version."""
-        res_src = source.resolve()
-        old = self.file_data.get(str(res_src))
-        if old is None:
-            return True
+    def content_key(self, digest: str, *, is_pyi: bool, is_ipynb: bool) -> str:
+        """Return the key under which contents with `digest` are cached.
+
+        Stubs and notebooks are formatted differently from regular files, so the
+        same contents are only interchangeable between files of the same kind.
+        """
+        if is_pyi or self.mode.is_pyi:
+            return f"{digest}.pyi"
+        if is_ipynb or self.mode.is_ipynb:
+            return f"{digest}.ipynb"
+        return digest
+
+    def _path_content_key(self, path: str, digest: str) -> str:
+        return self.content_key(
+            digest, is_pyi=path.endswith(".pyi"), is_ipynb=path.endswith(".ipynb")
+        )
+
+    def is_known_content(self, data: bytes, *, is_pyi: bool, is_ipynb: bool) -> bool:
+        """Check if contents identical to `data` were cached before."""
+        digest = content_digest(data)
+        key = self.content_key(digest, is_pyi=is_pyi, is_ipynb=is_ipynb)
+        self._load_content_keys([key])
+        return key in self._content_keys
+
+    def prefetch(self, paths: Iterable[Path]) -> None:
+        """Look up the entries for the resolved `paths` in a single query."""
+        self._load(str(path) for path in paths)
+
+    def use_git_index(self, paths: Collection[Path]) -> None:
+        """Take the digests of the resolved `paths` from the git index.
+
+        Only files that git considers unmodified get one. Those whose blob id
+        matches their cache entry count as unchanged without reading them; the
+        others are checked as usual.
+        """
+        # Digests taken before, e.g. by an earlier run of --watch, may be stale.
+        for path in paths:
+            self.git_digests.pop(str(path), None)
+        if not paths:
+            return
+        if len(paths) == 1:
+            (path,) = paths
+            directory, pathspecs = path.parent, [path.name]
+        else:
+            directory, pathspecs = Path(os.path.commonpath(paths)), []
+            if not directory.is_dir():
+                directory = directory.parent
+        blob_ids = git.blob_ids(directory, *pathspecs)
+        if not blob_ids:
+            return
+        wanted = {str(path) for path in paths}
+        for name, blob_id in blob_ids.items():
+            path = os.path.join(directory, name)
+            if path in wanted:
+                self.git_digests[path] = blob_id
+
+    def subset(self, path: Path) -> "Cache":
+        """Return a copy holding only what is known about the resolved `path`.
+
+        The copy is cheap to send to a worker process, which can then validate
+        the entry without querying the cache file again.
+        """
+        key = str(path)
+        self._load([key])
+        subset = replace(
+            self,
+            file_data={},
+            durations={},
+            grammars={},
+            git_digests={},
+            _content_keys=set(),
+            _missing=set(),
+        )
+        if key in self.git_digests:
+            subset.git_digests[key] = self.git_digests[key]
+        if key in self.grammars:
+            subset.grammars[key] = self.grammars[key]
+        if key in self.file_data:
+            subset.file_data[key] = self.file_data[key]
+        else:
+            subset._missing.add(key)
+        return subset
 
-        st = res_src.stat()
+    def _check_path(
+        self, res_src: Path, st: os.stat_result, *, read: bool = True
+    ) -> Tuple[bool, Optional[bytes]]:
+        """Compare `res_src`, with stat result `st`, to its entry in the cache.
+
+        Return whether it is unchanged, and its contents if they had to be read
+        along the way. Without `read`, a file that would have to be read counts
+        as changed.
+        """
+        old = self.get(str(res_src))
+        if old is None:
+            return False, None
+        if self.git_digests.get(str(res_src)) == old.hash:
+            return True, None
+        # Git hashes contents after its eol conversion and filters, so a blob id
+        # that doesn't match can still belong to the cached file on disk.
         if st.st_size != old.st_size:
-            return True
+            return False, None
         if int(st.st_mtime) != int(old.st_mtime):
-            new_hash = Cache.hash_digest(res_src)
-            if new_hash != old.hash:
-                return True
-        return False
+            if not read:
+                return False, None
+            data = res_src.read_bytes()
+            return content_digest(data) == old.hash, data
+        return True, None
+
+    def check(self, res_src: Path, st: os.stat_result) -> Tuple[bool, Optional[bytes]]:
+        """Check if `res_src`, with stat result `st`, is unchanged.
+
+        Return the contents of `res_src` too if they had to be read, so that
+        callers can reuse them instead of reading the file again.
+        """
+        unchanged, data = self._check_path(res_src, st)
+        if unchanged or not self.by_content:
+            return unchanged, data
+        digest = self.git_digests.get(str(res_src))
+        if digest is None:
+            if data is None:
+                data = res_src.read_bytes()
+            digest = content_digest(data)
+        key = self._path_content_key(str(res_src), digest)
+        self._load_content_keys([key])
+        return key in self._content_keys, data
+
+    def is_changed(self, source: Path) -> bool:
+        """Check if source has changed compared to cached version."""
+        return bool(self.filtered_cached([source])[0])
 
     def filtered_cached(self, sources: Iterable[Path]) -> Tuple[Set[Path], Set[Path]]:
         """Split an iterable of paths in `sources` into two sets.
@@ -113,31 +479,239 @@ class Cache:
         The first contains paths of files that modified on disk or are not in the
         cache. The other contains paths to non-modified files.
         """
+        resolved = {src: src.resolve() for src in sources}
+        self.prefetch(resolved.values())
         changed: Set[Path] = set()
         done: Set[Path] = set()
-        for src in sources:
-            if self.is_changed(src):
+        by_content: Dict[Path, str] = {}
+        for src, res_src in resolved.items():
+            unchanged, data = self._check_path(res_src, res_src.stat())
+            if unchanged:
+                done.add(src)
+            elif self.by_content:
+                digest = self.git_digests.get(str(res_src))
+                if digest is None:
+                    if data is None:
+                        data = res_src.read_bytes()
+                    digest = content_digest(data)
+                by_content[src] = self._path_content_key(str(res_src), digest)
+            else:
                 changed.add(src)
+
+        self._load_content_keys(by_content.values())
+        for src, key in by_content.items():
+            if key in self._content_keys:
+                done.add(src)
             else:
+                changed.add(src)
+        return changed, done
+
+    def filtered_by_stat(self, sources: Iterable[Path]) -> Tuple[Set[Path], Set[Path]]:
+        """Like `filtered_cached`, but without reading any of the files.
+
+        Files that can only be told unchanged by their contents count as changed,
+        to be checked again where they are formatted. This is cheap enough to run
+        before deciding whether there is any formatting to do at all.
+        """
+        resolved = {src: src.resolve() for src in sources}
+        self.prefetch(resolved.values())
+        changed: Set[Path] = set()
+        done: Set[Path] = set()
+        for src, res_src in resolved.items():
+            try:
+                st = res_src.stat()
+            except OSError:
+                changed.add(src)
+                continue
+            unchanged, _ = self._check_path(res_src, st, read=False)
+            if unchanged:
                 done.add(src)
+            else:
+                changed.add(src)
         return changed, done
 
-    def write(self, sources: Iterable[Path]) -> None:
-        """Update the cache file data and write a new cache file."""
-        self.file_data.update(
-            **{str(src.resolve()): Cache.get_file_data(src) for src in sources}
+    def write(
+        self, sources: Iterable[Path], grammars: Optional[Mapping[Path, str]] = None
+    ) -> None:
+        """Update the cache file data and upsert it into the cache file."""
+        self.write_file_data(
+            {src: Cache.get_file_data(src) for src in sources}, grammars=grammars
         )
+
+    def write_file_data(
+        self,
+        file_data: Mapping[Path, FileData],
+        durations: Optional[Mapping[Path, float]] = None,
+        grammars: Optional[Mapping[Path, str]] = None,
+    ) -> None:
+        """Like `write`, with the file data of each source already computed.
+
+        Workers compute it from the contents they formatted, which saves reading
+        every file again just to hash it. `durations` records how long formatting
+        took, and `grammars` which grammar parsed the file, for any files, cached
+        or not.
+        """
+        new_file_data = {str(src.resolve()): data for src, data in file_data.items()}
+        new_durations = {
+            str(src.resolve()): seconds for src, seconds in (durations or {}).items()
+        }
+        new_grammars = {
+            str(src.resolve()): name for src, name in (grammars or {}).items()
+        }
+        self.durations.update(new_durations)
+        self.grammars.update(new_grammars)
+        self.file_data.update(**new_file_data)
+        self._missing.difference_update(new_file_data)
+        new_content_keys = {
+            self._path_content_key(path, data.hash)
+            for path, data in new_file_data.items()
+        }
+        self._content_keys.update(new_content_keys)
         try:
             CACHE_DIR.mkdir(parents=True, exist_ok=True)
-            with tempfile.NamedTemporaryFile(
-                dir=str(self.cache_file.parent), delete=False
-            ) as f:
-                # We store raw tuples in the cache because pickling NamedTuples
-                # doesn't work with mypyc on Python 3.8, and because it's faster.
-                data: Dict[str, Tuple[float, int, str]] = {
-                    k: (*v,) for k, v in self.file_data.items()
-                }
-                pickle.dump(data, f, protocol=4)
-            os.replace(f.name, self.cache_file)
         except OSError:
-            pass
+            return
+        _write_database(
+            self.cache_file,
+            lambda db: self._upsert(
+                db, new_file_data, new_content_keys, new_durations, new_grammars
+            ),
+        )
+
+    @staticmethod
+    def _upsert(
+        db: sqlite3.Connection,
+        file_data: Dict[str, FileData],
+        content_keys: Set[str],
+        durations: Dict[str, float],
+        grammars: Dict[str, str],
+    ) -> None:
+        with db:
+            # Take the write lock right away so the schema check below can't
+            # race with another process setting up the tables.
+            db.execute("BEGIN IMMEDIATE")
+            _ensure_schema(db)
+            db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                [(path, *data) for path, data in file_data.items()],
+            )
+            db.executemany(
+                "INSERT OR IGNORE INTO contents VALUES (?)",
+                [(key,) for key in content_keys],
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO durations VALUES (?, ?)",
+                list(durations.items()),
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO grammars VALUES (?, ?)",
+                list(grammars.items()),
+            )
+
+
+@dataclass
+class DirectoryListings:
+    """The entries of directories, stored in an SQLite database with the mtime the
+    directory had when it was listed.
+
+    Adding, removing or renaming an entry updates the mtime of its directory, so a
+    listing stays valid as long as the mtime is the same. Entries are kept with
+    their kind: "d" for directories, "f" for regular files, "l" for symbolic links
+    and "" for anything else. Where symbolic links point can change without
+    touching the directory, so they must be followed again by the caller.
+    """
+
+    cache_file: Path
+    # The listings of the directory passed to `read` and the ones below it.
+    listings: Dict[str, Tuple[int, List[Tuple[str, str]]]] = field(default_factory=dict)
+    _changed: Set[str] = field(default_factory=set, repr=False)
+
+    @classmethod
+    def read(cls, directory: Path) -> Self:
+        """Load the listings of `directory` and everything below it.
+
+        If the listings file is missing or not well formed, this behaves as if
+        it was empty, and the call to write later should resolve the issue.
+        """
+        listings = cls(get_listings_file())
+        if not listings.cache_file.exists():
+            return listings
+        # Everything below `directory` sorts between these two.
+        prefix = os.path.join(str(directory), "")
+        end = prefix[:-1] + chr(ord(os.sep) + 1)
+        try:
+            with closing(_connect(listings.cache_file, create=False)) as db:
+                (version,) = db.execute("PRAGMA user_version").fetchone()
+                if version != LISTINGS_SCHEMA_VERSION:
+                    return listings
+                rows = db.execute(
+                    "SELECT path, st_mtime_ns, entries FROM listings"
+                    " WHERE path = ? OR (path >= ? AND path < ?)",
+                    (str(directory), prefix, end),
+                ).fetchall()
+        except sqlite3.Error:
+            return listings
+        for path, st_mtime_ns, entries in rows:
+            try:
+                decoded = [(name, kind) for name, kind in json.loads(entries)]
+            except (ValueError, TypeError):
+                continue
+            listings.listings[path] = (st_mtime_ns, decoded)
+        return listings
+
+    def scan(self, directory: Path) -> List[Tuple[str, str]]:
+        """Return the names and kinds of the entries in `directory`.
+
+        The directory is only listed if it changed since it was listed before.
+        """
+        key = str(directory)
+        st = directory.stat()
+        cached = self.listings.get(key)
+        if cached is not None and cached[0] == st.st_mtime_ns:
+            return cached[1]
+        entries = scan_directory(directory)
+        if time.time() - st.st_mtime >= LISTING_MIN_AGE:
+            self.listings[key] = (st.st_mtime_ns, entries)
+            self._changed.add(key)
+        return entries
+
+    def write(self) -> None:
+        """Upsert the listings that changed since they were read."""
+        rows = [
+            (path, self.listings[path][0], json.dumps(self.listings[path][1]))
+            for path in sorted(self._changed)
+        ]
+        if not rows:
+            return
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            return
+
+        def upsert(db: sqlite3.Connection) -> None:
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                _ensure_schema(db, listings=True)
+                db.executemany("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", rows)
+
+        _write_database(self.cache_file, upsert)
+        self._changed.clear()
+
+
+def scan_directory(directory: Path) -> List[Tuple[str, str]]:
+    """List the names and kinds of the entries in `directory`, like they are kept
+    in `DirectoryListings`.
+    """
+    entries: List[Tuple[str, str]] = []
+    with os.scandir(directory) as scanned:
+        for entry in scanned:
+            if entry.is_symlink():
+                kind = "l"
+            elif entry.is_dir(follow_symlinks=False):
+                kind = "d"
+            elif entry.is_file(follow_symlinks=False):
+                kind = "f"
+            else:
+                kind = ""
+            entries.append((entry.name, kind))
+    return entries
@@ -1,7 +1,16 @@
 import re
 from dataclasses import dataclass
 from functools import lru_cache
-from typing import Collection, Final, Iterator, List, Optional, Tuple, Union
+from typing import (
+    Collection,
+    Final,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from pyink.mode import Mode, Preview
 from pyink.nodes import (
@@ -23,6 +32,8 @@ LN = Union[Leaf, Node]
 FMT_OFF: Final = {"# fmt: off", "# fmt:off", "# yapf: disable"}
 FMT_SKIP: Final = {"# fmt: skip", "# fmt:skip"}
 FMT_ON: Final = {"# fmt: on", "# fmt:on", "# yapf: enable"}
+# Each of the comments above contains one of these.
+FMT_MARKERS: Final = ("fmt:", "yapf:")
 
 COMMENT_EXCEPTIONS = " !:#'"
 _COMMENT_PREFIX = "# "
@@ -162,99 +173,169 @@ def make_comment(content: str) -> str:
 
 
 def normalize_fmt_off(
-    node: Node, mode: Mode, lines: Collection[Tuple[int, int]]
+    node: Node,
+    mode: Mode,
+    lines: Collection[Tuple[int, int]],
+    fmt_pass_leaves: Optional[Iterable[Leaf]] = None,
 ) -> None:
-    """Convert content between `# fmt: off`/`# fmt: on` into standalone comments."""
-    try_again = True
-    while try_again:
-        try_again = convert_one_fmt_off_pair(node, mode, lines)
+    """Convert content between `# fmt: off`/`# fmt: on` into standalone comments.
+
+    The leaves with such comments are visited once, in the order of the tree, so
+    this takes linear time however many regions there are. `fmt_pass_leaves`, if
+    given, are those leaves, e.g. as found by `annotate_tree`.
+    """
+    if fmt_pass_leaves is None:
+        fmt_pass_leaves = (
+            leaf for leaf in node.leaves() if has_fmt_marker(leaf.prefix)
+        )
+    # Converting a region removes its nodes from the tree, so the leaves are
+    # collected first. The last one is visited first.
+    todo = list(fmt_pass_leaves)
+    todo.reverse()
+    while todo:
+        leaf = todo.pop()
+        if root_of(leaf) is not node:
+            # Converted along with an earlier region.
+            continue
+        standalone = convert_fmt_pass_comment(leaf, mode, lines)
+        if standalone is not None and has_fmt_marker(standalone.prefix):
+            # It took over comments before the converted one.
+            todo.append(standalone)
+
+
+def has_fmt_marker(prefix: str) -> bool:
+    """Return True if `prefix` may have a `# fmt:` or `# yapf:` comment."""
+    return "#" in prefix and any(marker in prefix for marker in FMT_MARKERS)
 
 
-def convert_one_fmt_off_pair(
-    node: Node, mode: Mode, lines: Collection[Tuple[int, int]]
-) -> bool:
-    """Convert content of a single `# fmt: off`/`# fmt: on` into a standalone comment.
+def root_of(leaf: Leaf) -> LN:
+    """Return the topmost ancestor of `leaf`, which is `leaf` itself if it has none."""
+    node: LN = leaf
+    while node.parent is not None:
+        node = node.parent
+    return node
 
-    Returns True if a pair was converted.
+
+def convert_fmt_pass_comment(
+    leaf: Leaf, mode: Mode, lines: Collection[Tuple[int, int]]
+) -> Optional[Leaf]:
+    """Convert the content after the first `# fmt: off` in the prefix of `leaf` up
+    to the matching `# fmt: on`, or the line of its `# fmt: skip`, into a standalone
+    comment.
+
+    Returns the standalone comment leaf, or None if nothing was converted.
     """
-    for leaf in node.leaves():
-        previous_consumed = 0
-        for comment in list_comments(leaf.prefix, is_endmarker=False):
-            should_pass_fmt = comment.value in FMT_OFF or _contains_fmt_skip_comment(
-                comment.value, mode
-            )
-            if not should_pass_fmt:
-                previous_consumed = comment.consumed
-                continue
-            # We only want standalone comments. If there's no previous leaf or
-            # the previous leaf is indentation, it's a standalone comment in
-            # disguise.
-            if should_pass_fmt and comment.type != STANDALONE_COMMENT:
-                prev = preceding_leaf(leaf)
-                if prev:
-                    if comment.value in FMT_OFF and prev.type not in WHITESPACE:
-                        continue
-                    if (
-                        _contains_fmt_skip_comment(comment.value, mode)
-                        and prev.type in WHITESPACE
-                    ):
-                        continue
-
-            ignored_nodes = list(generate_ignored_nodes(leaf, comment, mode))
-            if not ignored_nodes:
-                continue
-
-            first = ignored_nodes[0]  # Can be a container node with the `leaf`.
-            parent = first.parent
-            prefix = first.prefix
-            if comment.value in FMT_OFF:
-                first.prefix = prefix[comment.consumed :]
-            if _contains_fmt_skip_comment(comment.value, mode):
-                first.prefix = ""
-                standalone_comment_prefix = prefix
-            else:
-                standalone_comment_prefix = (
-                    prefix[:previous_consumed] + "\n" * comment.newlines
-                )
-            hidden_value = "".join(str(n) for n in ignored_nodes)
-            comment_lineno = leaf.lineno - comment.newlines
-            if comment.value in FMT_OFF:
-                fmt_off_prefix = ""
-                if len(lines) > 0 and not any(
-                    comment_lineno >= line[0] and comment_lineno <= line[1]
-                    for line in lines
+    previous_consumed = 0
+    for comment in list_comments(leaf.prefix, is_endmarker=False):
+        should_pass_fmt = comment.value in FMT_OFF or _contains_fmt_skip_comment(
+            comment.value, mode
+        )
+        if not should_pass_fmt:
+            previous_consumed = comment.consumed
+            continue
+        # We only want standalone comments. If there's no previous leaf or
+        # the previous leaf is indentation, it's a standalone comment in
+        # disguise.
+        if should_pass_fmt and comment.type != STANDALONE_COMMENT:
+            prev = preceding_leaf(leaf)
+            if prev:
+                if comment.value in FMT_OFF and prev.type not in WHITESPACE:
+                    continue
+                if (
+                    _contains_fmt_skip_comment(comment.value, mode)
+                    and prev.type in WHITESPACE
                 ):
-                    # keeping indentation of comment by preserving original whitespaces.
-                    fmt_off_prefix = prefix.split(comment.value)[0]
-                    if "\n" in fmt_off_prefix:
-                        fmt_off_prefix = fmt_off_prefix.split("\n")[-1]
-                standalone_comment_prefix += fmt_off_prefix
-                hidden_value = comment.value + "\n" + hidden_value
-            if _contains_fmt_skip_comment(comment.value, mode):
-                hidden_value += "  " + comment.value
-            if hidden_value.endswith("\n"):
-                # That happens when one of the `ignored_nodes` ended with a NEWLINE
-                # leaf (possibly followed by a DEDENT).
-                hidden_value = hidden_value[:-1]
-            first_idx: Optional[int] = None
-            for ignored in ignored_nodes:
-                index = ignored.remove()
-                if first_idx is None:
-                    first_idx = index
-            assert parent is not None, "INTERNAL ERROR: fmt: on/off handling (1)"
-            assert first_idx is not None, "INTERNAL ERROR: fmt: on/off handling (2)"
-            parent.insert_child(
-                first_idx,
-                Leaf(
-                    STANDALONE_COMMENT,
-                    hidden_value,
-                    prefix=standalone_comment_prefix,
-                    fmt_pass_converted_first_leaf=first_leaf_of(first),
-                ),
+                    continue
+
+        ignored_nodes = list(generate_ignored_nodes(leaf, comment, mode))
+        if not ignored_nodes:
+            continue
+
+        first = ignored_nodes[0]  # Can be a container node with the `leaf`.
+        parent = first.parent
+        prefix = first.prefix
+        if comment.value in FMT_OFF:
+            first.prefix = prefix[comment.consumed :]
+        if _contains_fmt_skip_comment(comment.value, mode):
+            first.prefix = ""
+            standalone_comment_prefix = prefix
+        else:
+            standalone_comment_prefix = (
+                prefix[:previous_consumed] + "\n" * comment.newlines
             )
-            return True
+        hidden_value = "".join(str(n) for n in ignored_nodes)
+        comment_lineno = leaf.lineno - comment.newlines
+        if comment.value in FMT_OFF:
+            fmt_off_prefix = ""
+            if len(lines) > 0 and not any(
+                comment_lineno >= line[0] and comment_lineno <= line[1]
+                for line in lines
+            ):
+                # keeping indentation of comment by preserving original whitespaces.
+                fmt_off_prefix = prefix.split(comment.value)[0]
+                if "\n" in fmt_off_prefix:
+                    fmt_off_prefix = fmt_off_prefix.split("\n")[-1]
+            standalone_comment_prefix += fmt_off_prefix
+            hidden_value = comment.value + "\n" + hidden_value
+        if _contains_fmt_skip_comment(comment.value, mode):
+            hidden_value += "  " + comment.value
+        if hidden_value.endswith("\n"):
+            # That happens when one of the `ignored_nodes` ended with a NEWLINE
+            # leaf (possibly followed by a DEDENT).
+            hidden_value = hidden_value[:-1]
+        assert parent is not None, "INTERNAL ERROR: fmt: on/off handling (1)"
+        standalone = Leaf(
+            STANDALONE_COMMENT,
+            hidden_value,
+            prefix=standalone_comment_prefix,
+            fmt_pass_converted_first_leaf=first_leaf_of(first),
+        )
+        _replace_ignored_nodes(parent, ignored_nodes, standalone)
+        return standalone
 
-    return False
+    return None
+
+
+def _replace_ignored_nodes(parent: Node, ignored_nodes: List[LN], leaf: Leaf) -> None:
+    """Replace `ignored_nodes`, the first of which is a child of `parent`, with
+    `leaf`.
+
+    Removing and inserting children drops the sibling maps of `parent`, and
+    rebuilding them for each region would take quadratic time with many regions
+    under the same parent. When the ignored nodes are consecutive children of
+    `parent`, only the entries next to them are updated instead.
+    """
+    prev_map = parent.prev_sibling_map
+    next_map = parent.next_sibling_map
+    consecutive = True
+    first_idx: Optional[int] = None
+    for ignored in ignored_nodes:
+        if ignored.parent is not parent:
+            consecutive = False
+        index = ignored.remove()
+        if first_idx is None:
+            first_idx = index
+        elif index != first_idx:
+            consecutive = False
+    assert first_idx is not None, "INTERNAL ERROR: fmt: on/off handling (2)"
+    parent.insert_child(first_idx, leaf)
+    if not consecutive or prev_map is None or next_map is None:
+        return
+
+    for ignored in ignored_nodes:
+        del prev_map[id(ignored)]
+        del next_map[id(ignored)]
+    children = parent.children
+    prev_sibling = children[first_idx - 1] if first_idx > 0 else None
+    next_sibling = children[first_idx + 1] if first_idx + 1 < len(children) else None
+    prev_map[id(leaf)] = prev_sibling
+    next_map[id(leaf)] = next_sibling
+    if prev_sibling is not None:
+        next_map[id(prev_sibling)] = leaf
+    if next_sibling is not None:
+        prev_map[id(next_sibling)] = leaf
+    parent.prev_sibling_map = prev_map
+    parent.next_sibling_map = next_map
 
 
 def generate_ignored_nodes(
@@ -6,23 +6,46 @@ NOTE: this module is only imported if we need to format several files at once.
 
 import asyncio
 import logging
+import math
+import multiprocessing
 import os
 import signal
 import sys
+import threading
+import time
 import traceback
 from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
-from multiprocessing import Manager
+from contextlib import contextmanager
+from dataclasses import replace
 from pathlib import Path
-from typing import Any, Iterable, Optional, Set
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
 from mypy_extensions import mypyc_attr
 
-from pyink import WriteBack, format_file_in_place
-from pyink.cache import Cache
+from pyink import WriteBack, format_file_bytes_in_place, format_str, write_diff
+from pyink.cache import Cache, FileData, content_digest
+from pyink.jobserver import JobServer
 from pyink.mode import Mode
-from pyink.output import err
+from pyink.output import err, out
 from pyink.report import Changed, Report
 
+E = TypeVar("E", bound=BaseException)
+
 
 def maybe_install_uvloop() -> None:
     """If our environment has uvloop installed we use it.
@@ -65,6 +88,426 @@ def shutdown(loop: asyncio.AbstractEventLoop) -> None:
         loop.close()
 
 
+# Formatting throughput assumed for files that have no recorded durations, in
+# seconds per byte. It's only used when no file has a recorded duration, so only
+# the relative order of the estimates matters.
+SECONDS_PER_BYTE = 5e-6
+# Cheap files are grouped into tasks estimated to take at least this many seconds,
+# so that pickling and IPC overhead doesn't dominate their formatting time.
+BATCH_SECONDS = 0.05
+MAX_BATCH_SIZE = 64
+# With --diff, at most this many tasks may be running or waiting for the diffs of
+# earlier files to be printed. This bounds the memory held by diffs that are
+# ready before it's their turn.
+DIFF_REORDER_WINDOW = 256
+# The cache is written every this many files or seconds, whichever comes first,
+# so that an interrupted or crashed run doesn't lose what it already verified.
+CHECKPOINT_FILES = 1000
+CHECKPOINT_SECONDS = 10.0
+# Each worker process should get at least this many bytes to format, or starting
+# it costs more than it saves. Smaller jobs are formatted in-process.
+MIN_BYTES_PER_WORKER = 32 * 1024
+
+
+# Formatted by each worker process on startup. It's meant to exercise the common
+# code paths of the formatter once, not to be a realistic file.
+WARM_UP_SOURCE = """\
+import os
+
+
+class A(B, metaclass=M):
+    '''Docstring.'''
+
+    @decorator
+    async def f(self, x: "int" = 1, *args, **kwargs) -> Dict[str, int]:
+        # Comment.
+        if x and not args or kwargs:  # type: ignore
+            return await g(x, *[y for y in 'ab'], **{"k": f"{x!r}"})
+        with open(os.sep) as f, lock:
+            y = [1, 2, 3,]; z = (lambda: x ** -1)()
+        return {**kwargs, 'y': y[1:2], "z": z}
+"""
+
+# Seconds spent in `warm_up_worker` by this worker process, until it is reported
+# to the parent process along with the first results.
+_warm_up_seconds: Optional[float] = None
+
+
+def warm_up_worker(mode: Optional[Mode] = None) -> None:
+    """Prepare a worker process for formatting with `mode`.
+
+    Meant as the initializer of a process pool. Loading the grammars and running
+    the formatter once takes care of the imports, parser tables and caches that
+    would otherwise be paid for by the first file each worker formats, which
+    matters most when workers are started with spawn or forkserver.
+    """
+    from pyink.parsing import get_grammars, matches_grammar
+
+    global _warm_up_seconds
+    start = time.perf_counter()
+    for grammar in get_grammars(set()):
+        matches_grammar("pass\n", grammar)
+    try:
+        format_str(WARM_UP_SOURCE, mode=replace(mode or Mode(), is_ipynb=False))
+    except Exception:
+        # An exception in a pool initializer breaks the whole pool. If something
+        # is wrong with the mode, let the first file report it instead.
+        pass
+    _warm_up_seconds = time.perf_counter() - start
+
+
+class WorkerResult(NamedTuple):
+    """Outcome of checking and formatting a single file in a worker process."""
+
+    changed: Changed
+    # The cache entry for the file after formatting, unless it was cached.
+    file_data: Optional[FileData]
+    # Seconds spent formatting the file, unless it was cached.
+    duration: Optional[float]
+    # With --diff, the diff to print with the encoding and newlines of the file.
+    diff: Optional[Tuple[str, str, str]] = None
+    # The name of the grammar the file was parsed with, if it was parsed.
+    grammar: Optional[str] = None
+
+
+class Limits(NamedTuple):
+    """Resource limits for formatting a single file in a worker process."""
+
+    # Seconds after which formatting a file is interrupted.
+    timeout: Optional[float] = None
+    # Megabytes of address space a worker process may use.
+    max_memory: Optional[int] = None
+
+
+class WorkerError(NamedTuple):
+    """An exception raised while formatting a single file in a worker process."""
+
+    exc: Exception
+    traceback: str
+
+
+def format_file_in_worker(
+    src: Path,
+    fast: bool,
+    mode: Mode,
+    write_back: WriteBack,
+    cache: Optional[Cache],
+    *,
+    timeout: Optional[float] = None,
+) -> WorkerResult:
+    """Validate the cache entry of `src` and format it if it changed.
+
+    Meant to run in a worker process. `cache` holds just the entry for `src`, see
+    :meth:`Cache.subset`, or is None if the cache shouldn't be used. The file is
+    read at most once: the same bytes are hashed for validation, formatted, and
+    hashed for the new cache entry that is returned. Diffs are returned too,
+    for the parent process to print in order. The grammar the file was parsed
+    with before is tried first. Formatting is interrupted after `timeout`
+    seconds, see :func:`time_limit`.
+    """
+    from pyink.parsing import preferred_grammar
+
+    st = src.stat()
+    data = None
+    grammar = None
+    if cache is not None:
+        res_src = src.resolve()
+        grammar = cache.grammars.get(str(res_src))
+        unchanged, data = cache.check(res_src, st)
+        if unchanged:
+            if data is None:
+                return WorkerResult(Changed.CACHED, None, None)
+            # It was only found unchanged by its contents, e.g. after a checkout.
+            # Refresh the entry so the next run can tell from the stat result.
+            file_data = FileData(st.st_mtime, st.st_size, content_digest(data))
+            return WorkerResult(Changed.CACHED, file_data, None)
+    if data is None:
+        data = src.read_bytes()
+    diffs: List[Tuple[str, str, str]] = []
+    start = time.perf_counter()
+    with preferred_grammar(grammar) as choice:
+        changed, file_data = format_file_bytes_in_place(
+            src, st, data, fast, mode, write_back, diffs=diffs, timeout=timeout
+        )
+    duration = time.perf_counter() - start
+    return WorkerResult(
+        Changed.YES if changed else Changed.NO,
+        file_data,
+        duration,
+        diffs[0] if diffs else None,
+        choice.used,
+    )
+
+
+class TimeLimitError(TimeoutError):
+    """Raised by :func:`time_limit` when a file takes too long to format."""
+
+
+def find_cause(exc: BaseException, exc_type: Type[E]) -> Optional[E]:
+    """Return `exc` or the exception it was raised from, if any is an `exc_type`.
+
+    The formatter may wrap errors, e.g. when an AST can't be built for its safety
+    checks, but a resource limit should be reported as such.
+    """
+    seen = set()
+    cause: Optional[BaseException] = exc
+    while cause is not None and id(cause) not in seen:
+        if isinstance(cause, exc_type):
+            return cause
+        seen.add(id(cause))
+        cause = cause.__cause__ or cause.__context__
+    return None
+
+
+@contextmanager
+def time_limit(seconds: Optional[float]) -> Iterator[None]:
+    """Raise TimeLimitError in the block if it runs for longer than `seconds`.
+
+    This relies on SIGALRM, so it only has an effect in the main thread on POSIX
+    systems, like the one of a worker process.
+    """
+    if (
+        seconds is None
+        or not hasattr(signal, "setitimer")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def interrupt(signum: int, frame: Any) -> None:
+        raise TimeLimitError(f"timed out after {seconds:g} seconds")
+
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+@contextmanager
+def memory_limit(megabytes: Optional[int]) -> Iterator[None]:
+    """Cap the address space of the current worker process at `megabytes` in the
+    block.
+
+    Allocations beyond the cap raise MemoryError. The previous cap is restored
+    afterwards, so that the worker can still send its results back. Nothing is
+    done outside of a worker process, so that a thread pool fallback can't limit
+    pyink itself.
+    """
+    if megabytes is None or multiprocessing.parent_process() is None:
+        yield
+        return
+
+    import resource
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = megabytes * 1024 * 1024
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+
+def format_files_in_worker(
+    batch: List[Tuple[Path, Optional[Cache]]],
+    fast: bool,
+    mode: Mode,
+    write_back: WriteBack,
+    limits: Limits = Limits(),
+) -> Tuple[List[Union[WorkerResult, WorkerError]], Optional[float]]:
+    """Run :func:`format_file_in_worker` for every file in `batch`.
+
+    Exceptions are returned in place of results, so that a single file failing to
+    format, or exceeding `limits`, doesn't lose the results for the rest of the
+    batch. The time this worker spent warming up is returned with its first batch.
+    """
+    global _warm_up_seconds
+    warm_up_seconds, _warm_up_seconds = _warm_up_seconds, None
+    results: List[Union[WorkerResult, WorkerError]] = []
+    with memory_limit(limits.max_memory):
+        for src, cache in batch:
+            try:
+                result = format_file_in_worker(
+                    src, fast, mode, write_back, cache, timeout=limits.timeout
+                )
+            except Exception as exc:
+                if timeout := find_cause(exc, TimeLimitError):
+                    exc = timeout
+                elif find_cause(exc, MemoryError) and limits.max_memory is not None:
+                    exc = MemoryError(
+                        f"exceeded the memory limit of {limits.max_memory} MB"
+                    )
+                try:
+                    tb = traceback.format_exc()
+                except MemoryError:
+                    # Still too close to the limit to format the traceback.
+                    tb = ""
+                results.append(WorkerError(exc, tb))
+            else:
+                results.append(result)
+    return results, warm_up_seconds
+
+
+def estimate_costs(
+    sources: Mapping[Path, Path], cache: Optional[Cache]
+) -> Dict[Path, float]:
+    """Estimate how many seconds formatting each of `sources` will take.
+
+    `sources` maps each source to its resolved path. Durations recorded in the
+    cache by previous runs are used when available. Other files are estimated
+    from their size, at the throughput observed for the files with recorded
+    durations.
+    """
+    sizes: Dict[Path, int] = {}
+    known: Dict[Path, float] = {}
+    for src, res_src in sources.items():
+        entry = None
+        if cache is not None:
+            entry = cache.file_data.get(str(res_src))
+            if (duration := cache.durations.get(str(res_src))) is not None:
+                known[src] = duration
+        if entry is not None:
+            sizes[src] = entry.st_size
+        else:
+            try:
+                sizes[src] = src.stat().st_size
+            except OSError:
+                sizes[src] = 0
+
+    seconds_per_byte = SECONDS_PER_BYTE
+    known_bytes = sum(sizes[src] for src in known)
+    if known_bytes:
+        seconds_per_byte = sum(known.values()) / known_bytes
+    return {src: known.get(src, sizes[src] * seconds_per_byte) for src in sources}
+
+
+def batch_sources(
+    costs: Mapping[Path, float], *, ordered: bool = False
+) -> List[List[Path]]:
+    """Group sources into tasks, from the most to the least expensive.
+
+    `costs` are the estimates from :func:`estimate_costs`. Expensive files get a
+    task of their own and are started first, so that a single huge file doesn't
+    end up running alone after all other work is done. Cheap files are grouped
+    into tasks of at least `BATCH_SECONDS` to cut per-task overhead.
+
+    With `ordered`, tasks are formed from consecutive sources in sorted order
+    instead, for output that has to be printed in that order.
+    """
+    batches: List[List[Path]] = []
+    batch: List[Path] = []
+    batch_cost = 0.0
+    if ordered:
+        order = sorted(costs)
+    else:
+        order = sorted(costs, key=lambda src: (-costs[src], src))
+    for src in order:
+        batch.append(src)
+        batch_cost += costs[src]
+        if batch_cost >= BATCH_SECONDS or len(batch) >= MAX_BATCH_SIZE:
+            batches.append(batch)
+            batch = []
+            batch_cost = 0.0
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def cgroup_cpu_quota(root: Path = Path("/sys/fs/cgroup")) -> Optional[int]:
+    """Return the CPU quota of the cgroup under `root`, rounded up, if it has one.
+
+    Supports both cgroup v2 (`cpu.max`) and v1 (`cpu.cfs_quota_us`). In a
+    container, `root` is the cgroup of the container.
+    """
+    try:
+        quota, period = (root / "cpu.max").read_text(encoding="utf-8").split()
+    except (OSError, ValueError):
+        try:
+            cpu = root / "cpu"
+            quota = (cpu / "cpu.cfs_quota_us").read_text(encoding="utf-8").strip()
+            period = (cpu / "cpu.cfs_period_us").read_text(encoding="utf-8").strip()
+        except OSError:
+            return None
+    if quota in ("max", "-1"):
+        return None
+    try:
+        return max(1, math.ceil(int(quota) / int(period)))
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def usable_cpus() -> Tuple[int, str]:
+    """Return how many CPUs this process can use, and what limits that number."""
+    count, reason = os.cpu_count() or 1, "CPUs in the system"
+    if hasattr(os, "sched_getaffinity"):
+        affinity = len(os.sched_getaffinity(0))
+        if affinity < count:
+            count, reason = affinity, "CPUs this process may run on"
+    quota = cgroup_cpu_quota()
+    if quota is not None and quota < count:
+        count, reason = quota, "cgroup CPU quota"
+    return count, reason
+
+
+def choose_workers(sources: Iterable[Path]) -> Tuple[int, str]:
+    """Return how many worker processes to format `sources` with, and why.
+
+    One worker per usable CPU, but no more than there is work for, counting
+    `MIN_BYTES_PER_WORKER` per worker.
+    """
+    cpus, reason = usable_cpus()
+    total = 0
+    count = 0
+    for src in sources:
+        try:
+            total += src.stat().st_size
+        except OSError:
+            pass
+        count += 1
+        if total >= cpus * MIN_BYTES_PER_WORKER and count >= cpus:
+            # There's enough work to keep every CPU busy.
+            return cpus, reason
+    workers = max(1, min(cpus, count, total // MIN_BYTES_PER_WORKER))
+    if workers < cpus:
+        return workers, f"{count} file(s), {total} bytes"
+    return cpus, reason
+
+
+def start_workers(
+    workers: int,
+    mode: Mode,
+    start_method: Optional[str] = None,
+    *,
+    initializer: Callable[[Optional[Mode]], None] = warm_up_worker,
+) -> Executor:
+    """Start a pool of `workers` processes, warmed up for formatting with `mode`.
+
+    Falls back to a single thread where processes aren't supported.
+    """
+    try:
+        options: Dict[str, Any] = {}
+        if start_method is not None:
+            options["mp_context"] = multiprocessing.get_context(start_method)
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=initializer,
+            initargs=(mode,),
+            **options,
+        )
+    except (ImportError, NotImplementedError, OSError):
+        # we arrive here if the underlying system does not support
+        # multi-processing like in AWS Lambda or Termux, in which case we
+        # gracefully fallback to a ThreadPoolExecutor with just a single worker
+        # (more workers would not do us any good due to the Global Interpreter
+        # Lock)
+        return ThreadPoolExecutor(max_workers=1)
+
+
 # diff-shades depends on being to monkeypatch this function to operate. I know it's
 # not ideal, but this shouldn't cause any issues ... hopefully. ~ichard26
 @mypyc_attr(patchable=True)
@@ -75,25 +518,54 @@ def reformat_many(
     mode: Mode,
     report: Report,
     workers: Optional[int],
+    *,
+    cache_by_content: bool = False,
+    use_git_index: bool = False,
+    start_method: Optional[str] = None,
+    limits: Limits = Limits(),
+    executor: Optional[Executor] = None,
+    cache: Optional[Cache] = None,
 ) -> None:
-    """Reformat multiple files using a ProcessPoolExecutor."""
+    """Reformat multiple files using a ProcessPoolExecutor.
+
+    `start_method` is the :mod:`multiprocessing` start method for the workers,
+    or None for the platform default. Formatting a single file is stopped, and
+    reported as a failure, when it exceeds `limits`.
+
+    Callers that format again and again, like --watch, can pass the `executor`
+    and the `cache` to keep using. `workers` and `start_method` are ignored then,
+    and the executor is left running.
+    """
     maybe_install_uvloop()
 
-    executor: Executor
-    if workers is None:
-        workers = int(os.environ.get("PYINK_NUM_WORKERS", 0))
-        workers = workers or os.cpu_count() or 1
-    if sys.platform == "win32":
-        # Work around https://bugs.python.org/issue26903
-        workers = min(workers, 60)
-    try:
-        executor = ProcessPoolExecutor(max_workers=workers)
-    except (ImportError, NotImplementedError, OSError):
-        # we arrive here if the underlying system does not support multi-processing
-        # like in AWS Lambda or Termux, in which case we gracefully fallback to
-        # a ThreadPoolExecutor with just a single worker (more workers would not do us
-        # any good due to the Global Interpreter Lock)
-        executor = ThreadPoolExecutor(max_workers=1)
+    own_executor = executor is None
+    jobserver = None
+    if executor is None:
+        in_process = False
+        if workers is not None:
+            reason = "--workers"
+        elif workers := int(os.environ.get("PYINK_NUM_WORKERS", 0)):
+            reason = "PYINK_NUM_WORKERS"
+        else:
+            workers, reason = choose_workers(sources)
+            # The limits can only be enforced in separate processes.
+            in_process = workers == 1 and start_method is None and limits == Limits()
+        if sys.platform == "win32":
+            # Work around https://bugs.python.org/issue26903
+            workers = min(workers, 60)
+        if not in_process:
+            jobserver = JobServer.from_environment(max_tokens=workers - 1)
+        if report.verbose:
+            if in_process:
+                out(f"Formatting in-process ({reason})", fg="blue")
+            else:
+                out(f"Using {workers} worker process(es) ({reason})", fg="blue")
+            if jobserver is not None:
+                out("Sharing parallelism with the make jobserver", fg="blue")
+        if in_process:
+            executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            executor = start_workers(workers, mode, start_method)
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
@@ -107,6 +579,11 @@ def reformat_many(
                 report=report,
                 loop=loop,
                 executor=executor,
+                cache_by_content=cache_by_content,
+                use_git_index=use_git_index,
+                limits=limits,
+                jobserver=jobserver,
+                cache=cache,
             )
         )
     finally:
@@ -114,8 +591,10 @@ def reformat_many(
             shutdown(loop)
         finally:
             asyncio.set_event_loop(None)
-        if executor is not None:
+        if own_executor:
             executor.shutdown()
+        if jobserver is not None:
+            jobserver.close()
 
 
 async def schedule_formatting(
@@ -126,38 +605,147 @@ async def schedule_formatting(
     report: "Report",
     loop: asyncio.AbstractEventLoop,
     executor: "Executor",
+    *,
+    cache_by_content: bool = False,
+    use_git_index: bool = False,
+    limits: Limits = Limits(),
+    jobserver: Optional[JobServer] = None,
+    cache: Optional[Cache] = None,
 ) -> None:
     """Run formatting of `sources` in parallel using the provided `executor`.
 
     (Use ProcessPoolExecutors for actual parallelism.)
 
     `write_back`, `fast`, and `mode` options are passed to
-    :func:`format_file_in_place`.
+    :func:`format_file_bytes_in_place`. With a `jobserver`, only one task runs
+    per token held, plus one for the implicit token of this process. `cache` is
+    read from disk unless given.
     """
-    cache = Cache.read(mode)
-    if write_back not in (WriteBack.DIFF, WriteBack.COLOR_DIFF):
-        sources, cached = cache.filtered_cached(sources)
-        for src in sorted(cached):
-            report.done(src, Changed.CACHED)
+    is_diff = write_back in (WriteBack.DIFF, WriteBack.COLOR_DIFF)
+    if is_diff:
+        cache = None
+    elif cache is None:
+        cache = Cache.read(mode, by_content=cache_by_content)
     if not sources:
         return
 
+    resolved = {src: src.resolve() for src in sources}
+    if cache is not None:
+        # Only look up the entries here; stat calls and hashing happen in the
+        # workers, in parallel.
+        cache.prefetch(resolved.values())
+        if use_git_index:
+            cache.use_git_index(resolved.values())
+
     cancelled = []
-    sources_to_cache = []
-    lock = None
-    if write_back in (WriteBack.DIFF, WriteBack.COLOR_DIFF):
-        # For diff output, we need locks to ensure we don't interleave output
-        # from different processes.
-        manager = Manager()
-        lock = manager.Lock()
-    tasks = {
-        asyncio.ensure_future(
-            loop.run_in_executor(
-                executor, format_file_in_place, src, fast, mode, write_back, lock
+    file_data_to_cache: Dict[Path, FileData] = {}
+    durations: Dict[Path, float] = {}
+    grammars: Dict[Path, str] = {}
+    # Diffs are printed in sorted path order, so that the output doesn't depend on
+    # which worker finishes first. Batches are then formed in that order too, and
+    # their results are handled once all earlier batches were.
+    batches = batch_sources(estimate_costs(resolved, cache), ordered=is_diff)
+    window = DIFF_REORDER_WINDOW if is_diff else len(batches)
+    finished: Dict[int, List[Union[WorkerResult, WorkerError]]] = {}
+    warm_ups: List[float] = []
+    next_batch = 0
+    submitted = 0
+    tasks: Dict["asyncio.Future[Any]", int] = {}
+    # Resolved when a jobserver token arrives, to wait for new tasks too.
+    wakeup: "asyncio.Future[None]" = loop.create_future()
+    waiting_for_token = False
+    last_checkpoint = time.monotonic()
+
+    def may_start() -> bool:
+        if submitted >= len(batches) or len(tasks) + len(finished) >= window:
+            return False
+        return jobserver is None or len(tasks) < 1 + jobserver.tokens
+
+    def submit() -> None:
+        """Start the next batches while there is room in the window."""
+        nonlocal submitted
+        while may_start():
+            batch = [
+                (src, cache.subset(resolved[src]) if cache is not None else None)
+                for src in batches[submitted]
+            ]
+            task = asyncio.ensure_future(
+                loop.run_in_executor(
+                    executor,
+                    format_files_in_worker,
+                    batch,
+                    fast,
+                    mode,
+                    write_back,
+                    limits,
+                )
             )
-        ): src
-        for src in sorted(sources)
-    }
+            tasks[task] = submitted
+            submitted += 1
+
+    def balance_tokens() -> None:
+        """Wait for a token if another batch could start, release unused ones."""
+        nonlocal waiting_for_token
+        if jobserver is None:
+            return
+        while jobserver.tokens > max(len(tasks) - 1, 0):
+            jobserver.release()
+        want_token = (
+            not cancelled
+            and submitted < len(batches)
+            and len(tasks) + len(finished) < window
+            and jobserver.tokens < jobserver.max_tokens
+        )
+        if want_token and not waiting_for_token:
+            loop.add_reader(jobserver.read_fd, on_token)
+        elif waiting_for_token and not want_token:
+            loop.remove_reader(jobserver.read_fd)
+        waiting_for_token = want_token
+
+    def on_token() -> None:
+        assert jobserver is not None
+        if jobserver.acquire():
+            submit()
+            if not wakeup.done():
+                wakeup.set_result(None)
+        balance_tokens()
+
+    def handle(
+        batch: List[Path], results: List[Union[WorkerResult, WorkerError]]
+    ) -> None:
+        for src, result in zip(batch, results):
+            if isinstance(result, WorkerError):
+                if report.verbose:
+                    err(result.traceback, nl=False)
+                report.failed(src, str(result.exc))
+                continue
+            if result.diff is not None:
+                write_diff(*result.diff)
+            if result.duration is not None:
+                durations[src] = result.duration
+            if result.grammar is not None:
+                grammars[src] = result.grammar
+            # If the file was written back or was successfully checked as
+            # well-formatted, store this information in the cache.
+            if result.file_data is not None and (
+                write_back is WriteBack.YES
+                or (write_back is WriteBack.CHECK and result.changed is not Changed.YES)
+            ):
+                file_data_to_cache[src] = result.file_data
+            report.done(src, result.changed)
+
+    def checkpoint() -> None:
+        """Write the results collected since the last checkpoint to the cache."""
+        nonlocal last_checkpoint
+        if cache is not None and (file_data_to_cache or durations or grammars):
+            cache.write_file_data(file_data_to_cache, durations, grammars)
+        file_data_to_cache.clear()
+        durations.clear()
+        grammars.clear()
+        last_checkpoint = time.monotonic()
+
+    submit()
+    balance_tokens()
     pending = tasks.keys()
     try:
         loop.add_signal_handler(signal.SIGINT, cancel, pending)
@@ -165,26 +753,59 @@ async def schedule_formatting(
     except NotImplementedError:
         # There are no good alternatives for these on Windows.
         pass
-    while pending:
-        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
-        for task in done:
-            src = tasks.pop(task)
-            if task.cancelled():
-                cancelled.append(task)
-            elif exc := task.exception():
-                if report.verbose:
-                    traceback.print_exception(type(exc), exc, exc.__traceback__)
-                report.failed(src, str(exc))
-            else:
-                changed = Changed.YES if task.result() else Changed.NO
-                # If the file was written back or was successfully checked as
-                # well-formatted, store this information in the cache.
-                if write_back is WriteBack.YES or (
-                    write_back is WriteBack.CHECK and changed is Changed.NO
-                ):
-                    sources_to_cache.append(src)
-                report.done(src, changed)
-    if cancelled:
-        await asyncio.gather(*cancelled, return_exceptions=True)
-    if sources_to_cache:
-        cache.write(sources_to_cache)
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                [*pending, wakeup], return_when=asyncio.FIRST_COMPLETED
+            )
+            if wakeup.done():
+                wakeup = loop.create_future()
+            for task in done:
+                if task not in tasks:
+                    continue
+                index = tasks.pop(task)
+                if task.cancelled():
+                    cancelled.append(task)
+                    continue
+                if exc := task.exception():
+                    # The whole batch was lost, e.g. because a worker died.
+                    tb = "".join(
+                        traceback.format_exception(type(exc), exc, exc.__traceback__)
+                    )
+                    results: List[Union[WorkerResult, WorkerError]] = [
+                        WorkerError(exc, tb) for _ in batches[index]
+                    ]
+                else:
+                    results, warm_up_seconds = task.result()
+                    if warm_up_seconds is not None:
+                        warm_ups.append(warm_up_seconds)
+                if is_diff:
+                    finished[index] = results
+                else:
+                    handle(batches[index], results)
+            while next_batch in finished:
+                handle(batches[next_batch], finished.pop(next_batch))
+                next_batch += 1
+            if (
+                max(len(file_data_to_cache), len(durations)) >= CHECKPOINT_FILES
+                or time.monotonic() - last_checkpoint >= CHECKPOINT_SECONDS
+            ):
+                checkpoint()
+            if not cancelled:
+                submit()
+            balance_tokens()
+        if cancelled:
+            await asyncio.gather(*cancelled, return_exceptions=True)
+        # Whatever is left was held up by a cancelled batch.
+        for index in sorted(finished):
+            handle(batches[index], finished[index])
+    finally:
+        # Also reached when the run is torn down by `shutdown()`, e.g. after a
+        # KeyboardInterrupt where there are no signal handlers.
+        checkpoint()
+    if report.verbose and warm_ups:
+        # Reported separately, as it isn't part of the time spent on any file.
+        out(
+            f"Warmed up {len(warm_ups)} worker(s) in {sum(warm_ups):.3f}s total",
+            fg="blue",
+        )
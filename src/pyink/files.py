@@ -1,5 +1,7 @@
+import heapq
 import io
 import os
+import re
 import sys
 from functools import lru_cache
 from pathlib import Path
@@ -13,6 +15,7 @@ from typing import (
     Optional,
     Pattern,
     Sequence,
+    Set,
     Tuple,
     Union,
 )
@@ -33,6 +36,8 @@ if sys.version_info >= (3, 11):
 else:
     import tomli as tomllib
 
+from pyink import git
+from pyink.cache import DirectoryListings, scan_directory
 from pyink.handle_ipynb_magics import jupyter_dependencies_are_installed
 from pyink.mode import TargetVersion
 from pyink.output import err
@@ -232,6 +237,10 @@ def find_user_pyproject_toml() -> Path:
     return user_config_path.resolve()
 
 
+# Named groups can't repeat in the single regex `_Gitignore` compiles.
+_NAMED_GROUP = re.compile(r"\(\?P<\w+>")
+
+
 @lru_cache
 def get_gitignore(root: Path) -> PathSpec:
     """Return a PathSpec matching gitignore content if present."""
@@ -276,22 +285,80 @@ def normalize_path_maybe_ignore(
     return root_relative_path
 
 
-def _path_is_ignored(
-    root_relative_path: str,
-    root: Path,
-    gitignore_dict: Dict[Path, PathSpec],
-) -> bool:
-    path = root / root_relative_path
-    # Note that this logic is sensitive to the ordering of gitignore_dict. Callers must
-    # ensure that gitignore_dict is ordered from least specific to most specific.
-    for gitignore_path, pattern in gitignore_dict.items():
-        try:
-            relative_path = path.relative_to(gitignore_path).as_posix()
-        except ValueError:
-            break
-        if pattern.match_file(relative_path):
+class _Gitignore:
+    """The rules of the .gitignore files that apply in a directory tree.
+
+    A path is ignored if the rules of any of the files match it. Files without
+    negated patterns, the usual case, are compiled into a single regular
+    expression, with each pattern anchored at the directory of its file, so
+    matching a path takes one regex match however deeply the files nest.
+    """
+
+    def __init__(self, levels: Tuple[Tuple[str, PathSpec], ...] = ()) -> None:
+        # The root-relative directory of each file, ending with a slash unless
+        # it's the root, and its rules. Ordered from the root down.
+        self.levels = levels
+        alternatives: List[str] = []
+        self._unmerged: List[Tuple[str, PathSpec]] = []
+        for prefix, spec in levels:
+            patterns = [
+                pattern for pattern in spec.patterns if pattern.include is not None
+            ]
+            regexes = [getattr(pattern, "regex", None) for pattern in patterns]
+            if any(not pattern.include for pattern in patterns) or None in regexes:
+                # The last matching pattern decides, so leave these to PathSpec.
+                self._unmerged.append((prefix, spec))
+                continue
+            for regex in regexes:
+                assert regex is not None
+                body = _NAMED_GROUP.sub("(?:", regex.pattern).lstrip("^")
+                alternatives.append(f"{re.escape(prefix)}(?:{body})")
+        self._regex: Optional[Pattern[str]] = None
+        if alternatives:
+            self._regex = re.compile("|".join(alternatives))
+
+    @classmethod
+    def from_dict(
+        cls, root: Path, gitignore_dict: Dict[Path, PathSpec]
+    ) -> "_Gitignore":
+        """Compile the PathSpecs of `gitignore_dict`, keyed by their directory.
+
+        Note that this is sensitive to the ordering of `gitignore_dict`. Callers
+        must ensure that it's ordered from least specific to most specific.
+        """
+        gitignore = cls()
+        for directory, spec in gitignore_dict.items():
+            if not spec.patterns:
+                continue
+            try:
+                root_relative_dir = directory.relative_to(root).as_posix()
+            except ValueError:
+                break
+            gitignore = gitignore.extend(root_relative_dir, spec)
+        return gitignore
+
+    def extend(self, root_relative_dir: str, spec: PathSpec) -> "_Gitignore":
+        """Return the rules with those of the .gitignore file in `root_relative_dir`.
+
+        Directories without a .gitignore file share the rules of their parent.
+        """
+        if not spec.patterns:
+            return self
+        prefix = "" if root_relative_dir in ("", ".") else root_relative_dir + "/"
+        return _Gitignore((*self.levels, (prefix, spec)))
+
+    def __bool__(self) -> bool:
+        return bool(self.levels)
+
+    def is_ignored(self, root_relative_path: str) -> bool:
+        if self._regex is not None and self._regex.match(root_relative_path):
             return True
-    return False
+        for prefix, spec in self._unmerged:
+            if root_relative_path.startswith(prefix) and spec.match_file(
+                root_relative_path[len(prefix) :]
+            ):
+                return True
+        return False
 
 
 def path_is_excluded(
@@ -314,6 +381,7 @@ def gen_python_files(
     *,
     verbose: bool,
     quiet: bool,
+    listings: Optional[DirectoryListings] = None,
 ) -> Iterator[Path]:
     """Generate all files under `path` whose paths are not excluded by the
     `exclude_regex`, `extend_exclude`, or `force_exclude` regexes,
@@ -321,17 +389,19 @@ def gen_python_files(
 
     Symbolic links pointing outside of the `root` directory are ignored.
 
-    `report` is where output about exclusions goes.
+    `report` is where output about exclusions goes. `listings` caches the
+    entries of the directories below `paths`.
     """
 
     assert root.is_absolute(), f"INTERNAL ERROR: `root` must be absolute but is {root}"
+    gitignore = None
+    if gitignore_dict is not None:
+        gitignore = _Gitignore.from_dict(root, gitignore_dict)
     for child in paths:
         root_relative_path = child.absolute().relative_to(root).as_posix()
 
         # First ignore files matching .gitignore, if passed
-        if gitignore_dict and _path_is_ignored(
-            root_relative_path, root, gitignore_dict
-        ):
+        if gitignore and gitignore.is_ignored(root_relative_path):
             report.path_ignored(child, "matches a .gitignore file content")
             continue
 
@@ -359,26 +429,19 @@ def gen_python_files(
             continue
 
         if child.is_dir():
-            # If gitignore is None, gitignore usage is disabled, while a Falsey
-            # gitignore is when the directory doesn't have a .gitignore file.
-            if gitignore_dict is not None:
-                new_gitignore_dict = {
-                    **gitignore_dict,
-                    root / child: get_gitignore(child),
-                }
-            else:
-                new_gitignore_dict = None
-            yield from gen_python_files(
-                child.iterdir(),
+            yield from _gen_python_files_in_dir(
+                root / child,
+                root_relative_path[1:-1],
                 root,
                 include,
                 exclude,
                 extend_exclude,
                 force_exclude,
                 report,
-                new_gitignore_dict,
+                gitignore,
                 verbose=verbose,
                 quiet=quiet,
+                listings=listings,
             )
 
         elif child.is_file():
@@ -391,6 +454,225 @@ def gen_python_files(
                 yield child
 
 
+def _gen_python_files_in_dir(
+    directory: Path,
+    root_relative_dir: str,
+    root: Path,
+    include: Pattern[str],
+    exclude: Pattern[str],
+    extend_exclude: Optional[Pattern[str]],
+    force_exclude: Optional[Pattern[str]],
+    report: Report,
+    gitignore: Optional[_Gitignore],
+    *,
+    verbose: bool,
+    quiet: bool,
+    listings: Optional[DirectoryListings] = None,
+) -> Iterator[Path]:
+    """Like `gen_python_files`, for everything in the `directory` at
+    `root_relative_dir`.
+
+    It lists directories with `os.scandir`, whose entries already know their
+    type, and only resolves symbolic links, since other entries of a directory
+    inside `root` can't point outside of it. That makes it about one syscall per
+    directory instead of several per entry. With `listings`, directories that
+    didn't change since they were last listed aren't listed again.
+    """
+    if listings is not None:
+        entries = listings.scan(directory)
+    else:
+        entries = scan_directory(directory)
+    # If gitignore is None, gitignore usage is disabled, while a Falsey
+    # gitignore is when no .gitignore file applies so far.
+    if gitignore is not None and any(
+        name == ".gitignore"
+        and (kind == "f" or (kind == "l" and (directory / name).is_file()))
+        for name, kind in entries
+    ):
+        gitignore = gitignore.extend(root_relative_dir, get_gitignore(directory))
+    for name, kind in entries:
+        path = directory / name
+        root_relative_path = f"{root_relative_dir}/{name}".lstrip("/")
+
+        # First ignore files matching .gitignore, if passed
+        if gitignore and gitignore.is_ignored(root_relative_path):
+            report.path_ignored(path, "matches a .gitignore file content")
+            continue
+
+        # Then ignore with `--exclude` `--extend-exclude` and `--force-exclude` options.
+        is_symlink = kind == "l"
+        is_dir = path.is_dir() if is_symlink else kind == "d"
+        root_relative_path = "/" + root_relative_path
+        if is_dir:
+            root_relative_path += "/"
+
+        if path_is_excluded(root_relative_path, exclude):
+            report.path_ignored(path, "matches the --exclude regular expression")
+            continue
+
+        if path_is_excluded(root_relative_path, extend_exclude):
+            report.path_ignored(path, "matches the --extend-exclude regular expression")
+            continue
+
+        if path_is_excluded(root_relative_path, force_exclude):
+            report.path_ignored(path, "matches the --force-exclude regular expression")
+            continue
+
+        if is_symlink:
+            if normalize_path_maybe_ignore(path, root, report) is None:
+                continue
+
+        if is_dir:
+            yield from _gen_python_files_in_dir(
+                path,
+                root_relative_path[1:-1],
+                root,
+                include,
+                exclude,
+                extend_exclude,
+                force_exclude,
+                report,
+                gitignore,
+                verbose=verbose,
+                quiet=quiet,
+                listings=listings,
+            )
+
+        elif kind == "f" or (is_symlink and path.is_file()):
+            is_ipynb = name.endswith(".ipynb")
+            if is_ipynb and not jupyter_dependencies_are_installed(
+                warn=verbose or not quiet
+            ):
+                continue
+            include_match = include.search(root_relative_path) if include else True
+            if include_match:
+                yield path
+
+
+def gen_python_files_from_git(
+    directory: Path,
+    root: Path,
+    include: Pattern[str],
+    exclude: Pattern[str],
+    extend_exclude: Optional[Pattern[str]],
+    force_exclude: Optional[Pattern[str]],
+    report: Report,
+    gitignore_dict: Optional[Dict[Path, PathSpec]],
+    *,
+    verbose: bool,
+    quiet: bool,
+) -> Optional[List[Path]]:
+    """Like `gen_python_files` for the contents of `directory`, but listing the
+    files with git instead of walking the directory.
+
+    Git applies the .gitignore rules if `gitignore_dict` isn't None; the regular
+    expressions are matched against every file and its parent directories, the
+    same as during a walk. Return None if `directory` isn't in a git checkout.
+    """
+    assert root.is_absolute(), f"INTERNAL ERROR: `root` must be absolute but is {root}"
+    listed = git.list_files(directory, use_gitignore=gitignore_dict is not None)
+    if listed is None:
+        return None
+    directory_prefix = directory.relative_to(root).as_posix() + "/"
+    if directory_prefix == "./":
+        directory_prefix = ""
+    # Whether each directory below `directory` is excluded, by its path relative
+    # to `directory`.
+    excluded_dirs: Dict[str, bool] = {"": False}
+
+    patterns = [
+        (pattern, name)
+        for pattern, name in (
+            (exclude, "exclude"),
+            (extend_exclude, "extend-exclude"),
+            (force_exclude, "force-exclude"),
+        )
+        if pattern
+    ]
+
+    def is_excluded(root_relative_path: str, path: str) -> bool:
+        """Check `root_relative_path` against the regexes, reporting a match."""
+        for pattern, name in patterns:
+            if path_is_excluded(root_relative_path, pattern):
+                report.path_ignored(
+                    directory / path, f"matches the --{name} regular expression"
+                )
+                return True
+        return False
+
+    def dir_is_excluded(path: str) -> bool:
+        if path not in excluded_dirs:
+            parent = path.rpartition("/")[0]
+            excluded_dirs[path] = dir_is_excluded(parent) or is_excluded(
+                f"/{directory_prefix}{path}/", path
+            )
+        return excluded_dirs[path]
+
+    sources: List[Path] = []
+    for path in listed.files:
+        if dir_is_excluded(path.rpartition("/")[0]):
+            continue
+        root_relative_path = f"/{directory_prefix}{path}"
+        if is_excluded(root_relative_path, path):
+            continue
+        if path.endswith(".ipynb") and not jupyter_dependencies_are_installed(
+            warn=verbose or not quiet
+        ):
+            continue
+        if include.search(root_relative_path) if include else True:
+            sources.append(directory / path)
+    # Git doesn't list what's behind these, so they're handled like in a walk.
+    for path in listed.others:
+        if not dir_is_excluded(path.rpartition("/")[0]):
+            sources.extend(
+                gen_python_files(
+                    [directory / path],
+                    root,
+                    include,
+                    exclude,
+                    extend_exclude,
+                    force_exclude,
+                    report,
+                    gitignore_dict,
+                    verbose=verbose,
+                    quiet=quiet,
+                )
+            )
+    return sources
+
+
+def shard_sources(
+    sources: Iterable[Path], root: Path, index: int, count: int
+) -> Set[Path]:
+    """Return the files of shard `index` (counting from 1) out of `count`.
+
+    Files are dealt out largest first to the shard with the least bytes so far, so
+    the shards take about as long. The split only depends on the paths relative to
+    `root` and the file sizes, so every machine of a sharded run computes the same
+    one from the same checkout.
+    """
+    sized = []
+    for src in sources:
+        try:
+            key = src.absolute().relative_to(root).as_posix()
+        except ValueError:
+            key = src.absolute().as_posix()
+        try:
+            size = src.stat().st_size
+        except OSError:
+            size = 0
+        sized.append((-size, key, src))
+    sized.sort()
+    shards: List[Tuple[int, int]] = [(0, shard) for shard in range(count)]
+    selected = set()
+    for negative_size, _, src in sized:
+        load, shard = heapq.heappop(shards)
+        if shard == index - 1:
+            selected.add(src)
+        heapq.heappush(shards, (load - negative_size, shard))
+    return selected
+
+
 def wrap_stream_for_windows(
     f: io.TextIOWrapper,
 ) -> Union[io.TextIOWrapper, "colorama.AnsiToWin32"]:
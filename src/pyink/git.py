@@ -0,0 +1,112 @@
+"""Listing files with git, which already knows them from its index."""
+
+import os
+import subprocess
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+# Modes of index entries.
+REGULAR_MODES = ("100644", "100755")
+SYMLINK_MODE = "120000"
+GITLINK_MODE = "160000"
+# Repositories can use SHA-256 instead, but blob ids are only useful as content
+# digests if they are computed the same way as `pyink.cache.content_digest`.
+SHA1_HEX_LENGTH = 40
+
+
+class GitFiles(NamedTuple):
+    """The files in a directory of a git checkout, relative to it."""
+
+    # Tracked and untracked regular files that exist in the work tree.
+    files: List[str]
+    # Entries to handle like any other path: symbolic links, and submodules and
+    # nested repositories, which git lists without their contents.
+    others: List[str]
+
+
+def ls_files(directory: Path, *args: str) -> Optional[List[str]]:
+    """Run `git ls-files` in `directory`, returning None if that doesn't work."""
+    try:
+        result = subprocess.run(
+            ["git", "ls-files", "-z", *args],
+            cwd=directory,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return [os.fsdecode(entry) for entry in result.stdout.split(b"\0") if entry]
+
+
+def list_files(directory: Path, *, use_gitignore: bool) -> Optional[GitFiles]:
+    """List the files in `directory` from the git index, plus untracked files.
+
+    With `use_gitignore`, files matching the .gitignore rules are left out, even
+    if they are tracked, like the directory walk does. Return None if `directory`
+    isn't in a git checkout or git isn't available.
+    """
+    # Tagged with "H" for tracked files, "R" for deleted ones, "S" for ones
+    # outside of a sparse checkout, and "?" for untracked ones.
+    args = ["-t", "--stage", "--deleted", "--others"]
+    if use_gitignore:
+        args.append("--exclude-standard")
+    listed = ls_files(directory, *args)
+    ignored: Optional[List[str]] = []
+    if use_gitignore:
+        ignored = ls_files(directory, "--cached", "--ignored", "--exclude-standard")
+    if listed is None or ignored is None:
+        return None
+
+    skip = set(ignored)
+    skip.update(entry[2:].partition("\t")[2] for entry in listed if entry[0] in "RS")
+    files: List[str] = []
+    others: List[str] = []
+    for entry in listed:
+        tag, rest = entry[0], entry[2:]
+        if tag == "?":
+            if rest.endswith("/"):
+                # A nested repository.
+                others.append(rest.rstrip("/"))
+            elif os.path.islink(os.path.join(directory, rest)):
+                others.append(rest)
+            else:
+                files.append(rest)
+            continue
+        meta, _, path = rest.partition("\t")
+        if path in skip:
+            continue
+        # Unmerged files have several entries, one per stage.
+        skip.add(path)
+        mode = meta.split(" ", 1)[0]
+        if mode in (SYMLINK_MODE, GITLINK_MODE):
+            others.append(path)
+        else:
+            files.append(path)
+    return GitFiles(files, others)
+
+
+def blob_ids(directory: Path, *paths: str) -> Optional[Dict[str, str]]:
+    """Return the blob ids of files in `directory` that are unmodified in the
+    work tree, by their path relative to it.
+
+    Git knows whether they are unmodified from the stat data in its index, so none
+    of the files are read, unless they were changed right after the index was
+    written. `paths` limit the files to those, if given. Return None if
+    `directory` isn't in a git checkout, or one with SHA-1 object ids.
+    """
+    staged = ls_files(directory, "--stage", "--", *paths)
+    modified = ls_files(directory, "--modified", "--", *paths)
+    if staged is None or modified is None:
+        return None
+    skip = set(modified)
+    ids: Dict[str, str] = {}
+    for entry in staged:
+        meta, _, path = entry.partition("\t")
+        mode, blob_id, stage = meta.split(" ")
+        if mode not in REGULAR_MODES or stage != "0" or path in skip:
+            continue
+        if len(blob_id) != SHA1_HEX_LENGTH:
+            return None
+        ids[path] = blob_id
+    return ids
@@ -15,34 +15,9 @@ from typing import (
     Iterator,
 )
 
-from blib2to3.pgen2.token import ASYNC, NEWLINE, STRING
+from blib2to3.pgen2.token import ASYNC, NEWLINE
 from blib2to3.pytree import type_repr
-from pyink.mode import Quote
 from pyink.nodes import LN, Leaf, Node, STANDALONE_COMMENT, syms, Visitor
-from pyink.strings import STRING_PREFIX_CHARS
-
-
-def majority_quote(node: Node) -> Quote:
-    """Returns the majority quote from node.
-
-    Triple quotes strings are excluded from calculation. If even, returns double
-    quote.
-    """
-    num_double_quotes = 0
-    num_single_quotes = 0
-    for leaf in node.leaves():
-        if leaf.type == STRING:
-            value = leaf.value.lstrip(STRING_PREFIX_CHARS)
-            if value.startswith(("'''", '"""')):
-                continue
-            if value.startswith('"'):
-                num_double_quotes += 1
-            else:
-                num_single_quotes += 1
-    if num_single_quotes > num_double_quotes:
-        return Quote.SINGLE
-    else:
-        return Quote.DOUBLE
 
 
 def convert_unchanged_lines(src_node: Node, lines: Collection[Tuple[int, int]]):
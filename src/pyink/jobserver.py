@@ -0,0 +1,120 @@
+"""
+Client for the GNU make jobserver, to share one parallelism budget with make and
+other tools it runs, like several pyink processes started at once.
+
+Every job owns one implicit token. To run more work in parallel, a job reads a
+token byte from the jobserver, and writes the same byte back when it's done. See
+https://www.gnu.org/software/make/manual/html_node/POSIX-Jobserver.html.
+"""
+
+import os
+import sys
+from typing import Iterable, List, Optional
+
+
+class JobServer:
+    """Tokens acquired from a GNU make jobserver, beyond the implicit one."""
+
+    def __init__(
+        self,
+        read_fd: int,
+        write_fd: int,
+        *,
+        max_tokens: int,
+        owned_fds: Iterable[int] = (),
+    ) -> None:
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        # Holding more tokens than we have workers for would only starve others.
+        self.max_tokens = max_tokens
+        self._owned_fds = set(owned_fds)
+        self._tokens: List[bytes] = []
+
+    @classmethod
+    def from_environment(
+        cls, *, max_tokens: int, makeflags: Optional[str] = None
+    ) -> Optional["JobServer"]:
+        """Connect to the jobserver announced in `makeflags`, if any.
+
+        `makeflags` defaults to the `MAKEFLAGS` environment variable. Both the
+        `fifo:PATH` style of make 4.4 and the older `R,W` file descriptor style are
+        supported. Return None if there is no usable jobserver, e.g. because make
+        didn't pass its file descriptors to this process, or if they can't be read
+        without blocking.
+        """
+        if sys.platform == "win32" or max_tokens < 1:
+            return None
+        if makeflags is None:
+            makeflags = os.environ.get("MAKEFLAGS", "")
+        auth = None
+        for flag in makeflags.split():
+            for prefix in ("--jobserver-auth=", "--jobserver-fds="):
+                if flag.startswith(prefix):
+                    auth = flag[len(prefix) :]
+        if not auth:
+            return None
+
+        if auth.startswith("fifo:"):
+            try:
+                fd = os.open(auth[len("fifo:") :], os.O_RDWR | os.O_NONBLOCK)
+            except OSError:
+                return None
+            return cls(fd, fd, max_tokens=max_tokens, owned_fds=[fd])
+
+        try:
+            read_fd, write_fd = (int(fd) for fd in auth.split(","))
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+        except (ValueError, OSError):
+            return None
+        try:
+            # Reopening the pipe gives us a non-blocking file description of our
+            # own, without changing the one make and the other jobs share. Tokens
+            # are acquired from the event loop, which a blocking read could stall
+            # for as long as other jobs hold every token, so without one the
+            # jobserver isn't used at all.
+            own_read_fd = os.open(
+                f"/proc/self/fd/{read_fd}", os.O_RDONLY | os.O_NONBLOCK
+            )
+        except OSError:
+            return None
+        return cls(
+            own_read_fd, write_fd, max_tokens=max_tokens, owned_fds=[own_read_fd]
+        )
+
+    @property
+    def tokens(self) -> int:
+        """How many tokens are held, not counting the implicit one."""
+        return len(self._tokens)
+
+    def acquire(self) -> bool:
+        """Try to take a token without blocking. Return whether it worked."""
+        if self.tokens >= self.max_tokens:
+            return False
+        try:
+            token = os.read(self.read_fd, 1)
+        except (BlockingIOError, InterruptedError):
+            return False
+        if not token:
+            return False
+        self._tokens.append(token)
+        return True
+
+    def release(self) -> None:
+        """Give one held token back to the jobserver."""
+        token = self._tokens.pop()
+        try:
+            os.write(self.write_fd, token)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        """Give back all held tokens and close the file descriptors we opened."""
+        while self._tokens:
+            self.release()
+        for fd in self._owned_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._owned_fds = set()
@@ -156,6 +156,17 @@ class LineGenerator(Visitor[Line]):
         self.current_line = Line(mode=self.mode, depth=depth)
         yield complete_line
 
+    def visit(self, node: LN) -> Iterator[Line]:
+        """Like `Visitor.visit`, then drop the sibling maps of `node`.
+
+        Asking a leaf or node for its `prev_sibling` or `next_sibling` builds those
+        maps for all the children of its parent at once. They are only a cache,
+        rebuilt when needed, but would otherwise stay around for the whole tree.
+        """
+        yield from super().visit(node)
+        if isinstance(node, Node):
+            node.invalidate_sibling_maps()
+
     def visit_default(self, node: LN) -> Iterator[Line]:
         """Default `visit_*()` implementation. Recurses to children of `node`."""
         if isinstance(node, Leaf):
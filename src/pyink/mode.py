@@ -238,6 +238,9 @@ class Mode:
     preview: bool = False
     is_pyink: bool = False
     pyink_indentation: Literal[2, 4] = 4
+    # Tokenize with `pyink.tokenizer`. It produces the same tokens as blib2to3, so
+    # it doesn't change the output and isn't part of the cache key.
+    fast_tokenizer: bool = False
 
     def __post_init__(self) -> None:
         if self.experimental_string_processing:
@@ -3,11 +3,15 @@ Parse Python code and perform AST validation.
 """
 
 import ast
+import re
 import sys
-from typing import Iterable, Iterator, List, Set, Tuple
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 
 from pyink.mode import VERSION_TO_FEATURES, Feature, TargetVersion, supports_feature
 from pyink.nodes import syms
+from pyink.tokenizer import generate_tokens
 from blib2to3 import pygram
 from blib2to3.pgen2 import driver
 from blib2to3.pgen2.grammar import Grammar
@@ -16,10 +20,102 @@ from blib2to3.pgen2.tokenize import TokenError
 from blib2to3.pytree import Leaf, Node
 
 
+# Constructs that only parse with some of the grammars, found without tokenizing.
+# Strings and comments are matched first, so that nothing inside them counts.
+GRAMMAR_HINTS_RE = re.compile(
+    r"""
+    (?P<skip>
+        \#[^\r\n]*
+        | [rRbBuUfF]{0,2}
+        (?: \'\'\'(?:\\.|[^\\])*?\'\'\' | \"\"\"(?:\\.|[^\\])*?\"\"\"
+            | '(?:\\.|[^\\'\r\n])*' | "(?:\\.|[^\\"\r\n])*" )
+    )
+    # A match statement, or a type alias statement. Subjects that start with an
+    # operator, like `match (x):`, could as well be a call or subscript.
+    | (?P<soft_keyword>
+        ^[ \t]*
+        (?: match[ \t]+(?!(?:in|is|if|and|or|not|else|for)\b)[\w'"{]
+            | type[ \t]+\w+[ \t]*[=\[] )
+    )
+    # `async` or `await` used as a name.
+    | (?P<async_name>
+        (?: \.[ \t]* | \b(?:def|class|import|as)[ \t]+ ) (?:async|await)\b
+        | \b(?:async|await)[ \t]*(?:[=.,)\]}:;]|$)
+    )
+    """,
+    re.MULTILINE | re.VERBOSE,
+)
+
+
 class InvalidInput(ValueError):
     """Raised when input source code fails all parse attempts."""
 
 
+class GrammarChoice(threading.local):
+    """The grammar `lib2to3_parse` tries first in this thread, and the one the
+    last successful parse used, by `grammar_name`.
+    """
+
+    preferred: Optional[str] = None
+    used: Optional[str] = None
+
+
+grammar_choice = GrammarChoice()
+
+
+def grammar_name(grammar: Grammar) -> str:
+    """Return the name a grammar is remembered by, e.g. in the cache."""
+    return ".".join(str(part) for part in grammar.version)
+
+
+@contextmanager
+def preferred_grammar(name: Optional[str]) -> Iterator[GrammarChoice]:
+    """Try the grammar called `name` first in the block, unless the source has
+    constructs that rule it out.
+
+    Typically it's the grammar the same file was parsed with the last time. The
+    grammar parses end up using is recorded in the `GrammarChoice` yielded.
+    """
+    previous = grammar_choice.preferred
+    grammar_choice.preferred = name
+    grammar_choice.used = None
+    try:
+        yield grammar_choice
+    finally:
+        grammar_choice.preferred = previous
+
+
+def select_grammars(
+    src_txt: str, grammars: List[Grammar], preferred: Optional[str] = None
+) -> List[Grammar]:
+    """Order `grammars` so that the one most likely to parse `src_txt` is first.
+
+    All of them are still tried when it doesn't, in their original order
+    otherwise. Wherever more than one grammar parses a file, they produce the
+    same tree, so this only saves the parse attempts that would have failed.
+    """
+    if len(grammars) < 2:
+        return grammars
+    soft_keywords = async_names = False
+    for match in GRAMMAR_HINTS_RE.finditer(src_txt):
+        if match.lastgroup == "soft_keyword":
+            soft_keywords = True
+        elif match.lastgroup == "async_name":
+            async_names = True
+        if soft_keywords and async_names:
+            # No grammar has both.
+            return grammars
+    if soft_keywords:
+        first = next((g for g in grammars if g.soft_keywords), None)
+    elif async_names:
+        first = next((g for g in grammars if not g.async_keywords), None)
+    else:
+        first = next((g for g in grammars if grammar_name(g) == preferred), None)
+    if first is None:
+        return grammars
+    return [first, *(g for g in grammars if g is not first)]
+
+
 def get_grammars(target_versions: Set[TargetVersion]) -> List[Grammar]:
     if not target_versions:
         # No target_version specified, so try all grammars.
@@ -51,17 +147,31 @@ def get_grammars(target_versions: Set[TargetVersion]) -> List[Grammar]:
     return grammars
 
 
-def lib2to3_parse(src_txt: str, target_versions: Iterable[TargetVersion] = ()) -> Node:
-    """Given a string with source, return the lib2to3 Node."""
+def lib2to3_parse(
+    src_txt: str,
+    target_versions: Iterable[TargetVersion] = (),
+    *,
+    fast_tokenizer: bool = False,
+) -> Node:
+    """Given a string with source, return the lib2to3 Node.
+
+    With `fast_tokenizer`, it's tokenized by `pyink.tokenizer` instead of blib2to3.
+    """
     if not src_txt.endswith("\n"):
         src_txt += "\n"
 
-    grammars = get_grammars(set(target_versions))
+    grammars = select_grammars(
+        src_txt, get_grammars(set(target_versions)), grammar_choice.preferred
+    )
     errors = {}
     for grammar in grammars:
         drv = driver.Driver(grammar)
         try:
-            result = drv.parse_string(src_txt, True)
+            if fast_tokenizer:
+                result = drv.parse_tokens(generate_tokens(src_txt, grammar), True)
+            else:
+                result = drv.parse_string(src_txt, True)
+            grammar_choice.used = grammar_name(grammar)
             break
 
         except ParseError as pe:
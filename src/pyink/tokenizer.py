@@ -0,0 +1,211 @@
+"""
+A faster front-end for the blib2to3 tokenizer.
+
+It produces the same tokens as `blib2to3.pgen2.tokenize.generate_tokens`, prefixes
+and comments included, but scans the whole source with a single regular
+expression instead of going line by line. Only well-formed sources with the
+common constructs are tokenized this way. For anything else, such as tokenizer
+errors, sources that aren't normalized to "\\n" newlines, or grammars where
+`async` and `await` are names, it hands over to blib2to3.
+"""
+
+import io
+import re
+from itertools import islice
+from typing import Iterator, Optional, Pattern
+
+from blib2to3.pgen2 import tokenize
+from blib2to3.pgen2.grammar import Grammar
+from blib2to3.pgen2.token import (
+    ASYNC,
+    AWAIT,
+    COMMENT,
+    DEDENT,
+    ENDMARKER,
+    INDENT,
+    NAME,
+    NEWLINE,
+    NL,
+    NUMBER,
+    OP,
+    STRING,
+)
+from blib2to3.pgen2.tokenize import GoodTokenInfo
+
+TABSIZE = 8
+
+# The same patterns as blib2to3 uses, without capturing groups.
+_NUMBER = (
+    r"(?:\d+(?:_\d+)*[jJ]"
+    r"|(?:(?:\d+(?:_\d+)*\.(?:\d+(?:_\d+)*)?|\.\d+(?:_\d+)*)(?:[eE][-+]?\d+(?:_\d+)*)?"
+    r"|\d+(?:_\d+)*[eE][-+]?\d+(?:_\d+)*)[jJ]"
+    r"|(?:\d+(?:_\d+)*\.(?:\d+(?:_\d+)*)?|\.\d+(?:_\d+)*)(?:[eE][-+]?\d+(?:_\d+)*)?"
+    r"|\d+(?:_\d+)*[eE][-+]?\d+(?:_\d+)*"
+    r"|0[bB]_?[01]+(?:_[01]+)*"
+    r"|0[xX]_?[\da-fA-F]+(?:_[\da-fA-F]+)*[lL]?"
+    r"|0[oO]?_?[0-7]+(?:_[0-7]+)*[lL]?"
+    r"|[1-9]\d*(?:_\d+)*[lL]?|0[lL]?)"
+)
+_OPERATOR = r"(?:\*\*=?|>>=?|<<=?|<>|!=|//=?|->|[+\-*/%&@|^=<>:]=?|~|[][(){}]|[:;.,`@])"
+_STRING_PREFIX = r"(?:[uUrRbBfF]|[rR][fFbB]|[fFbBuU][rR])?"
+_NAME = r"[^\s#\(\)\[\]\{\}+\-*/!@$%^&=|;:'\",\.<>/?`~\\]+"
+
+# One group per kind of token. blib2to3 tries numbers before operators and names
+# last, but the lookaheads make the order irrelevant, so the most common kinds
+# can come first. Strings must be complete: where one is continued on the next
+# line, nothing matches, and that is left to blib2to3, like unterminated ones.
+TOKEN_RE: Pattern[str] = re.compile(
+    r"[ \f\t]*(?:"
+    rf"((?!\d)(?!{_STRING_PREFIX}['\"]){_NAME})"  # 1: name
+    r"|((?!\.\d)" + _OPERATOR + r")"  # 2: operator
+    r"|(\n)"  # 3: newline
+    rf"|({_STRING_PREFIX}(?:'''[^'\\]*(?:(?:\\[\s\S]|'(?!''))[^'\\]*)*'''"
+    r'|"""[^"\\]*(?:(?:\\[\s\S]|"(?!""))[^"\\]*)*"""))'  # 4: triple-quoted string
+    rf"|({_STRING_PREFIX}(?:'''|\"\"\"))"  # 5: unterminated triple-quoted string
+    rf"|({_STRING_PREFIX}(?:'[^\n'\\]*(?:\\.[^\n'\\]*)*'"
+    r'|"[^\n"\\]*(?:\\.[^\n"\\]*)*"))'  # 6: string
+    rf"|({_NUMBER})"  # 7: number
+    r"|(#[^\r\n]*)"  # 8: comment
+    r"|(\\\n)"  # 9: explicit line joining
+    r")"
+)
+
+
+class Unsupported(Exception):
+    """Raised when the source needs the full blib2to3 tokenizer."""
+
+
+def generate_tokens(
+    source: str, grammar: Optional[Grammar] = None
+) -> Iterator[GoodTokenInfo]:
+    """Tokenize `source` like blib2to3 does for `grammar`."""
+    if grammar is None or not grammar.async_keywords:
+        yield from tokenize.generate_tokens(io.StringIO(source).readline, grammar)
+        return
+    count = 0
+    try:
+        for count, token in enumerate(tokenize_source(source), 1):
+            yield token
+    except Unsupported:
+        # Up to here, the tokens are the same either way.
+        tokens = tokenize.generate_tokens(io.StringIO(source).readline, grammar)
+        yield from islice(tokens, count, None)
+
+
+def tokenize_source(source: str) -> Iterator[GoodTokenInfo]:  # noqa: C901
+    """Generate the tokens of `source`, with `async` and `await` as keywords.
+
+    Raise Unsupported as soon as it has anything this tokenizer doesn't handle,
+    before generating a token blib2to3 wouldn't.
+    """
+    if "\r" in source or not source.endswith("\n"):
+        raise Unsupported
+    find = source.find
+    indents = [0]
+    parenlev = 0
+    lnum = 1
+    pos = line_start = 0
+    line = source[: find("\n") + 1]
+    # 1 at the start of a line with a new statement, 2 on such a line that only
+    # has a comment, 0 anywhere else.
+    new_statement = 1
+    for match in TOKEN_RE.finditer(source):
+        if match.start() != pos:
+            # Nothing matched in between.
+            raise Unsupported
+        kind = match.lastindex
+        token = match.group(kind)
+        start = match.start(kind)
+        pos = match.end()
+        col = start - line_start
+        if new_statement:
+            if kind == 3:
+                # A blank line, or one with just a comment.
+                yield (NL, token, (lnum, col), (lnum, col + 1), line)
+                lnum += 1
+                line_start = pos
+                line = source[pos : find("\n", pos) + 1]
+                new_statement = 1
+                continue
+            if kind == 8:
+                new_statement = 2
+            elif new_statement == 1:
+                new_statement = 0
+                indent = source[line_start:start]
+                if "\t" in indent or "\f" in indent:
+                    if "\f" in indent:
+                        raise Unsupported
+                    column = 0
+                    for char in indent:
+                        if char == " ":
+                            column += 1
+                        else:
+                            column = (column // TABSIZE + 1) * TABSIZE
+                else:
+                    column = col
+                if column > indents[-1]:
+                    indents.append(column)
+                    yield (INDENT, indent, (lnum, 0), (lnum, col), line)
+                elif column < indents[-1]:
+                    if column not in indents:
+                        # Doesn't match any outer indentation level.
+                        raise Unsupported
+                    spos = (lnum, col)
+                    while column < indents[-1]:
+                        indents.pop()
+                        yield (DEDENT, "", spos, spos, line)
+        if kind == 1:
+            if token == "async":
+                yield (ASYNC, token, (lnum, col), (lnum, col + len(token)), line)
+            elif token == "await":
+                yield (AWAIT, token, (lnum, col), (lnum, col + len(token)), line)
+            elif token[0].isidentifier():
+                yield (NAME, token, (lnum, col), (lnum, col + len(token)), line)
+            else:
+                raise Unsupported
+        elif kind == 2:
+            if token in "([{":
+                parenlev += 1
+            elif token in ")]}":
+                parenlev -= 1
+                if parenlev < 0:
+                    raise Unsupported
+            yield (OP, token, (lnum, col), (lnum, col + len(token)), line)
+        elif kind == 3 or kind == 9:
+            if kind == 3 and parenlev == 0:
+                yield (NEWLINE, token, (lnum, col), (lnum, col + 1), line)
+                new_statement = 1
+            else:
+                # The statement continues on the next line.
+                yield (NL, token, (lnum, col), (lnum, col + len(token)), line)
+            lnum += 1
+            line_start = pos
+            line = source[pos : find("\n", pos) + 1]
+        elif kind == 6:
+            yield (STRING, token, (lnum, col), (lnum, col + len(token)), line)
+        elif kind == 7:
+            yield (NUMBER, token, (lnum, col), (lnum, col + len(token)), line)
+        elif kind == 4:
+            newlines = token.count("\n")
+            if newlines:
+                # Reported with all the lines it spans. The line it ends on goes on.
+                first_line_start = line_start
+                line_start = source.rfind("\n", 0, pos) + 1
+                line_end = find("\n", pos) + 1
+                line = source[line_start:line_end]
+                epos = (lnum + newlines, pos - line_start)
+                lines = source[first_line_start:line_end]
+                yield (STRING, token, (lnum, col), epos, lines)
+                lnum += newlines
+            else:
+                yield (STRING, token, (lnum, col), (lnum, col + len(token)), line)
+        elif kind == 8:
+            yield (COMMENT, token, (lnum, col), (lnum, col + len(token)), line)
+        else:
+            raise Unsupported
+    if pos != len(source) or not new_statement:
+        # Not tokenized up to the end, or EOF in a multi-line statement.
+        raise Unsupported
+    for _ in indents[1:]:
+        yield (DEDENT, "", (lnum, 0), (lnum, 0), "")
+    yield (ENDMARKER, "", (lnum, 0), (lnum, 0), "")
@@ -0,0 +1,363 @@
+"""
+Formatting files whenever they change, from a process that keeps the formatter, the
+cache and the worker processes around between changes.
+
+NOTE: this module is only imported with --watch.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import multiprocessing
+import os
+import select
+import signal
+import struct
+import sys
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import (
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+)
+
+from pyink import WriteBack
+from pyink.cache import Cache
+from pyink.concurrency import (
+    Limits,
+    reformat_many,
+    start_workers,
+    usable_cpus,
+    warm_up_worker,
+)
+from pyink.mode import Mode
+from pyink.output import err, out
+from pyink.report import Report
+
+# Editors write a file in several steps, e.g. through a temporary file that is
+# renamed. Events are collected until there were none for this many seconds.
+DEBOUNCE_SECONDS = 0.1
+# How often the polling fallback looks for changes.
+POLL_SECONDS = 0.5
+
+
+class Watcher(ABC):
+    """Reports changes to the entries of a set of directories."""
+
+    @abstractmethod
+    def watch(self, directories: Collection[Path]) -> None:
+        """Watch `directories` from now on, instead of the previous ones."""
+
+    @abstractmethod
+    def wait(self, timeout: Optional[float] = None) -> Optional[Set[Path]]:
+        """Wait for changes and return the paths that changed.
+
+        Return an empty set if nothing changed within `timeout` seconds, or None
+        if something changed but it's not known what.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class PollingWatcher(Watcher):
+    """Finds changes by comparing the mtimes and sizes of the entries."""
+
+    def __init__(self, interval: float = POLL_SECONDS) -> None:
+        self.interval = interval
+        self._directories: Set[Path] = set()
+        self._snapshot: Dict[Path, Tuple[int, int]] = {}
+
+    def _scan(self) -> Dict[Path, Tuple[int, int]]:
+        snapshot: Dict[Path, Tuple[int, int]] = {}
+        for directory in self._directories:
+            try:
+                with os.scandir(directory) as scanned:
+                    for entry in scanned:
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        snapshot[Path(entry.path)] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                continue
+        return snapshot
+
+    def watch(self, directories: Collection[Path]) -> None:
+        self._directories = set(directories)
+        self._snapshot = self._scan()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Set[Path]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(self.interval)
+            snapshot = self._scan()
+            changed = {
+                path
+                for path in snapshot.keys() | self._snapshot.keys()
+                if snapshot.get(path) != self._snapshot.get(path)
+            }
+            self._snapshot = snapshot
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+class InotifyWatcher(Watcher):
+    """Gets told about changes by the Linux kernel, through inotify(7)."""
+
+    # From <sys/inotify.h>.
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    MASK = (
+        IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_ONLYDIR
+    )
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, libc: ctypes.CDLL, fd: int) -> None:
+        self._libc = libc
+        self.fd = fd
+        self._directories: Dict[int, Path] = {}
+
+    @classmethod
+    def create(cls) -> Optional["InotifyWatcher"]:
+        """Return a watcher, or None if inotify isn't available."""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        return cls(libc, fd)
+
+    def watch(self, directories: Collection[Path]) -> None:
+        """Like `Watcher.watch`. Raise OSError if the kernel refuses, typically
+        because there is a limit to the number of watches a user can have.
+        """
+        wanted = set(directories)
+        for wd, directory in list(self._directories.items()):
+            if directory not in wanted:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._directories[wd]
+        for directory in wanted.difference(self._directories.values()):
+            wd = self._libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), self.MASK
+            )
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # Removed in the meantime.
+                    continue
+                raise OSError(error, os.strerror(error), str(directory))
+            self._directories[wd] = directory
+
+    def _read(self, changed: Set[Path]) -> bool:
+        """Add the paths of the queued events to `changed`.
+
+        Return False if events were lost.
+        """
+        complete = True
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return complete
+            offset = 0
+            while offset + self.EVENT.size <= len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    complete = False
+                if mask & self.IN_IGNORED:
+                    # The directory is gone.
+                    self._directories.pop(wd, None)
+                    continue
+                if mask & self.IN_CREATE and not mask & self.IN_ISDIR:
+                    # Only interesting once the file is written and closed.
+                    continue
+                directory = self._directories.get(wd)
+                if directory is not None and name:
+                    changed.add(directory / os.fsdecode(name))
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Set[Path]]:
+        changed: Set[Path] = set()
+        complete = True
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            complete = self._read(changed) and complete
+            readable, _, _ = select.select([self.fd], [], [], DEBOUNCE_SECONDS)
+        return changed if complete else None
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def warm_up_idle_worker(mode: Optional[Mode] = None) -> None:
+    """Like `warm_up_worker`, for workers that are idle most of the time.
+
+    Ctrl-C is left to the main process, which stops them when it exits, so that
+    they don't each print a traceback.
+    """
+    if multiprocessing.parent_process() is not None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    warm_up_worker(mode)
+
+
+def new_watcher() -> Watcher:
+    """Return an inotify watcher where possible, a polling one otherwise."""
+    return InotifyWatcher.create() or PollingWatcher()
+
+
+def watched_directories(
+    sources: Iterable[Path], directories: Collection[Path]
+) -> Set[Path]:
+    """Return the directories to watch for changes to `sources`.
+
+    Those are the parents of each source up to the one of `directories` it was
+    found in, so that new files next to any source are noticed too.
+    """
+    roots = {directory.absolute() for directory in directories}
+    watched = set(roots)
+    for src in sources:
+        parents: List[Path] = []
+        for parent in src.absolute().parents:
+            if parent in roots:
+                watched.update(parents)
+                break
+            parents.append(parent)
+        else:
+            # A source passed by itself, outside of `directories`.
+            watched.add(src.absolute().parent)
+    return watched
+
+
+def watch_sources(
+    sources: Set[Path],
+    directories: Collection[Path],
+    discover: Callable[[], Set[Path]],
+    include: Pattern[str],
+    fast: bool,
+    write_back: WriteBack,
+    mode: Mode,
+    report: Report,
+    workers: Optional[int],
+    *,
+    cache_by_content: bool = False,
+    use_git_index: bool = False,
+    start_method: Optional[str] = None,
+    limits: Limits = Limits(),
+    watcher: Optional[Watcher] = None,
+) -> None:
+    """Format `sources`, then format them again when they change, until
+    interrupted.
+
+    New files next to the sources, or in `directories`, are found by calling
+    `discover` again when a path matching `include` or a new directory shows up.
+    The worker processes and the cache are kept across changes. `report` holds
+    the results of the last round of formatting.
+    """
+    if workers is None:
+        workers = int(os.environ.get("PYINK_NUM_WORKERS", 0)) or usable_cpus()[0]
+    executor = start_workers(
+        workers, mode, start_method, initializer=warm_up_idle_worker
+    )
+    is_diff = write_back in (WriteBack.DIFF, WriteBack.COLOR_DIFF)
+    cache = None if is_diff else Cache.read(mode, by_content=cache_by_content)
+    if watcher is None:
+        watcher = new_watcher()
+
+    def reformat(todo: Set[Path]) -> None:
+        report.change_count = report.same_count = report.failure_count = 0
+        reformat_many(
+            todo,
+            fast,
+            write_back,
+            mode,
+            report,
+            workers,
+            cache_by_content=cache_by_content,
+            use_git_index=use_git_index,
+            limits=limits,
+            executor=executor,
+            cache=cache,
+        )
+        if report.verbose or not report.quiet:
+            err(str(report))
+
+    def watch(sources: Set[Path]) -> Set[Path]:
+        nonlocal watcher
+        watched = watched_directories(sources, directories)
+        try:
+            watcher.watch(watched)
+        except OSError as e:
+            if isinstance(watcher, PollingWatcher):
+                raise
+            err(f"Cannot watch for changes with inotify ({e}), polling instead.")
+            watcher.close()
+            watcher = PollingWatcher()
+            watcher.watch(watched)
+        return watched
+
+    try:
+        reformat(sources)
+        watched = watch(sources)
+        if report.verbose or not report.quiet:
+            out("Watching for changes, press Ctrl-C to stop.")
+        while True:
+            changed = watcher.wait()
+            known = {src.absolute() for src in sources}
+            if changed is None or any(
+                path not in known
+                and (
+                    include.search("/" + path.name)
+                    or (path.is_dir() and path not in watched)
+                )
+                for path in changed
+            ):
+                new_sources = discover()
+                if changed is None:
+                    changed = set(new_sources)
+                else:
+                    changed.update(new_sources - sources)
+                sources = new_sources
+                watched = watch(sources)
+            changed = {path.absolute() for path in changed}
+            todo = {
+                src for src in sources if src.absolute() in changed and src.is_file()
+            }
+            if cache is not None:
+                # Such as the files pyink itself just wrote back. Digests from
+                # the git index may be stale by now.
+                cache.git_digests.clear()
+                todo, _ = cache.filtered_cached(todo)
+            if todo:
+                reformat(todo)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        executor.shutdown()
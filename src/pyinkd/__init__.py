@@ -0,0 +1,384 @@
+"""A long-running Pyink server.
+
+`pyink-daemon` keeps the formatter imported, the blib2to3 grammars loaded and a pool
+of warm worker processes around, so editors and pre-commit hooks don't pay for
+interpreter startup on every save.
+"""
+
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
+from multiprocessing import freeze_support
+from typing import Collection, Optional, Set, Tuple
+
+try:
+    from aiohttp import web
+except ImportError as ie:
+    raise ImportError(
+        f"aiohttp dependency is not installed: {ie}. "
+        + "Please re-install pyink with the '[d]' extra install "
+        + "to obtain aiohttp: `pip install pyink[d]`"
+    ) from None
+
+import click
+
+import pyink
+from _pyink_version import version as __version__
+from pyink.concurrency import maybe_install_uvloop, warm_up_worker
+from pyink.mode import Mode, QuoteStyle, TargetVersion
+from pyink.ranges import parse_line_ranges
+
+# Request headers
+PROTOCOL_VERSION_HEADER = "X-Protocol-Version"
+LINE_LENGTH_HEADER = "X-Line-Length"
+PYTHON_VARIANT_HEADER = "X-Python-Variant"
+SKIP_SOURCE_FIRST_LINE = "X-Skip-Source-First-Line"
+SKIP_STRING_NORMALIZATION_HEADER = "X-Skip-String-Normalization"
+SKIP_MAGIC_TRAILING_COMMA = "X-Skip-Magic-Trailing-Comma"
+PREVIEW = "X-Preview"
+FAST_OR_SAFE_HEADER = "X-Fast-Or-Safe"
+DIFF_HEADER = "X-Diff"
+LINE_RANGES_HEADER = "X-Line-Ranges"
+PYINK_HEADER = "X-Pyink"
+PYINK_INDENTATION_HEADER = "X-Pyink-Indentation"
+PYINK_USE_MAJORITY_QUOTES_HEADER = "X-Pyink-Use-Majority-Quotes"
+
+PYINK_HEADERS = [
+    PROTOCOL_VERSION_HEADER,
+    LINE_LENGTH_HEADER,
+    PYTHON_VARIANT_HEADER,
+    SKIP_SOURCE_FIRST_LINE,
+    SKIP_STRING_NORMALIZATION_HEADER,
+    SKIP_MAGIC_TRAILING_COMMA,
+    PREVIEW,
+    FAST_OR_SAFE_HEADER,
+    DIFF_HEADER,
+    LINE_RANGES_HEADER,
+    PYINK_HEADER,
+    PYINK_INDENTATION_HEADER,
+    PYINK_USE_MAJORITY_QUOTES_HEADER,
+]
+
+# Response headers
+PYINK_VERSION_HEADER = "X-Pyink-Version"
+
+DEFAULT_RESULT_CACHE_SIZE = 1024
+
+
+class InvalidVariantHeader(Exception):
+    pass
+
+
+class ResultCache:
+    """A bounded, in-memory LRU cache of formatting results.
+
+    Entries are keyed by the request content together with everything that
+    influences its formatting, so re-sending an unchanged buffer is answered
+    without touching the worker pool. A `None` result means the content was
+    already well formatted.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_RESULT_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Optional[str]]" = OrderedDict()
+
+    @staticmethod
+    def key(
+        content: str, mode: Mode, fast: bool, lines: Collection[Tuple[int, int]]
+    ) -> str:
+        digest = hashlib.sha256()
+        digest.update(mode.get_cache_key().encode())
+        digest.update(b"\0fast\0" if fast else b"\0safe\0")
+        digest.update(repr(sorted(lines)).encode())
+        digest.update(b"\0")
+        digest.update(content.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[str]:
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key: str, formatted: Optional[str]) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries[key] = formatted
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+@click.command(context_settings={"help_option_names": ["-h", "--help"]})
+@click.option(
+    "--bind-host",
+    type=str,
+    help="Address to bind the server to.",
+    default="localhost",
+    show_default=True,
+)
+@click.option(
+    "--bind-port", type=int, help="Port to listen on", default=45485, show_default=True
+)
+@click.option(
+    "--bind-socket",
+    type=click.Path(dir_okay=False, path_type=str),
+    default=None,
+    help=(
+        "Listen on the Unix domain socket at this path instead of a TCP port."
+        " Takes precedence over --bind-host and --bind-port."
+    ),
+)
+@click.option(
+    "-W",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of worker processes. Defaults to the number of CPUs in the system.",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=DEFAULT_RESULT_CACHE_SIZE,
+    show_default=True,
+    help="Number of formatting results kept in memory. Use 0 to disable.",
+)
+@click.version_option(version=pyink.__version__)
+def main(
+    bind_host: str,
+    bind_port: int,
+    bind_socket: Optional[str],
+    workers: Optional[int],
+    cache_size: int,
+) -> None:
+    logging.basicConfig(level=logging.INFO)
+    app = make_app(workers=workers, cache_size=cache_size)
+    ver = pyink.__version__
+    if bind_socket:
+        pyink.out(f"pyinkd version {ver} listening on {bind_socket}")
+        web.run_app(app, path=bind_socket, handle_signals=True, print=None)
+    else:
+        pyink.out(f"pyinkd version {ver} listening on {bind_host} port {bind_port}")
+        web.run_app(
+            app, host=bind_host, port=bind_port, handle_signals=True, print=None
+        )
+
+
+def make_app(
+    *, workers: Optional[int] = None, cache_size: int = DEFAULT_RESULT_CACHE_SIZE
+) -> web.Application:
+    app = web.Application()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=warm_up_worker)
+    cache = ResultCache(cache_size)
+    app.add_routes([web.post("/", partial(handle, executor=executor, cache=cache))])
+
+    async def shutdown_executor(app: web.Application) -> None:
+        executor.shutdown(wait=False)
+
+    app.on_cleanup.append(shutdown_executor)
+    return app
+
+
+async def handle(  # noqa: C901
+    request: web.Request, executor: Executor, cache: Optional[ResultCache] = None
+) -> web.Response:
+    headers = {PYINK_VERSION_HEADER: __version__}
+    try:
+        if request.headers.get(PROTOCOL_VERSION_HEADER, "1") != "1":
+            return web.Response(
+                status=501, text="This server only supports protocol version 1"
+            )
+        try:
+            line_length = int(
+                request.headers.get(LINE_LENGTH_HEADER, pyink.DEFAULT_LINE_LENGTH)
+            )
+        except ValueError:
+            return web.Response(status=400, text="Invalid line length header value")
+
+        if PYTHON_VARIANT_HEADER in request.headers:
+            value = request.headers[PYTHON_VARIANT_HEADER]
+            try:
+                pyi, versions = parse_python_variant_header(value)
+            except InvalidVariantHeader as e:
+                return web.Response(
+                    status=400,
+                    text=f"Invalid value for {PYTHON_VARIANT_HEADER}: {e.args[0]}",
+                )
+        else:
+            pyi = False
+            versions = set()
+
+        pyink_indentation = request.headers.get(PYINK_INDENTATION_HEADER, "4")
+        if pyink_indentation not in ("2", "4"):
+            return web.Response(
+                status=400, text=f"Invalid value for {PYINK_INDENTATION_HEADER}"
+            )
+
+        lines = []
+        if LINE_RANGES_HEADER in request.headers:
+            try:
+                lines = parse_line_ranges(
+                    request.headers[LINE_RANGES_HEADER].split(",")
+                )
+            except ValueError as e:
+                return web.Response(status=400, text=str(e))
+
+        skip_string_normalization = bool(
+            request.headers.get(SKIP_STRING_NORMALIZATION_HEADER, False)
+        )
+        skip_magic_trailing_comma = bool(
+            request.headers.get(SKIP_MAGIC_TRAILING_COMMA, False)
+        )
+        skip_source_first_line = bool(
+            request.headers.get(SKIP_SOURCE_FIRST_LINE, False)
+        )
+        if lines and skip_source_first_line:
+            return web.Response(
+                status=400,
+                text=(
+                    f"Cannot use {LINE_RANGES_HEADER} together with"
+                    f" {SKIP_SOURCE_FIRST_LINE}"
+                ),
+            )
+        preview = bool(request.headers.get(PREVIEW, False))
+        is_pyink = request.headers.get(PYINK_HEADER, "1") != "0"
+        use_majority_quotes = bool(
+            request.headers.get(PYINK_USE_MAJORITY_QUOTES_HEADER, False)
+        )
+        fast = False
+        if request.headers.get(FAST_OR_SAFE_HEADER, "safe") == "fast":
+            fast = True
+        mode = Mode(
+            target_versions=versions,
+            is_pyi=pyi,
+            line_length=line_length,
+            skip_source_first_line=skip_source_first_line,
+            string_normalization=not skip_string_normalization,
+            magic_trailing_comma=not skip_magic_trailing_comma,
+            preview=preview,
+            is_pyink=is_pyink,
+            pyink_indentation=2 if pyink_indentation == "2" else 4,
+            quote_style=(
+                QuoteStyle.MAJORITY if use_majority_quotes else QuoteStyle.DOUBLE
+            ),
+        )
+        req_bytes = await request.content.read()
+        charset = request.charset if request.charset is not None else "utf8"
+        req_str = req_bytes.decode(charset)
+        then = datetime.now(timezone.utc)
+
+        header = ""
+        if skip_source_first_line:
+            first_newline_position: int = req_str.find("\n") + 1
+            header = req_str[:first_newline_position]
+            req_str = req_str[first_newline_position:]
+
+        cache_key = ResultCache.key(req_str, mode, fast, lines)
+        if cache is not None and cache_key in cache:
+            cached = cache.get(cache_key)
+            if cached is None:
+                raise pyink.NothingChanged
+            formatted_str = cached
+        else:
+            loop = asyncio.get_event_loop()
+            try:
+                formatted_str = await loop.run_in_executor(
+                    executor,
+                    partial(
+                        pyink.format_file_contents,
+                        req_str,
+                        fast=fast,
+                        mode=mode,
+                        lines=lines,
+                    ),
+                )
+            except pyink.NothingChanged:
+                if cache is not None:
+                    cache.put(cache_key, None)
+                raise
+            if cache is not None:
+                cache.put(cache_key, formatted_str)
+
+        # Preserve CRLF line endings
+        nl = req_str.find("\n")
+        if nl > 0 and req_str[nl - 1] == "\r":
+            formatted_str = formatted_str.replace("\n", "\r\n")
+            # If, after swapping line endings, nothing changed, then say so
+            if formatted_str == req_str:
+                raise pyink.NothingChanged
+
+        # Put the source first line back
+        req_str = header + req_str
+        formatted_str = header + formatted_str
+
+        # Only output the diff in the HTTP response
+        only_diff = bool(request.headers.get(DIFF_HEADER, False))
+        if only_diff:
+            now = datetime.now(timezone.utc)
+            src_name = f"In\t{then}"
+            dst_name = f"Out\t{now}"
+            loop = asyncio.get_event_loop()
+            formatted_str = await loop.run_in_executor(
+                executor,
+                partial(pyink.diff, req_str, formatted_str, src_name, dst_name),
+            )
+
+        return web.Response(
+            content_type=request.content_type,
+            charset=charset,
+            headers=headers,
+            text=formatted_str,
+        )
+    except pyink.NothingChanged:
+        return web.Response(status=204, headers=headers)
+    except pyink.InvalidInput as e:
+        return web.Response(status=400, headers=headers, text=str(e))
+    except Exception as e:
+        logging.exception("Exception during handling a request")
+        return web.Response(status=500, headers=headers, text=str(e))
+
+
+def parse_python_variant_header(value: str) -> Tuple[bool, Set[TargetVersion]]:
+    if value == "pyi":
+        return True, set()
+    else:
+        versions = set()
+        for version in value.split(","):
+            if version.startswith("py"):
+                version = version[len("py") :]
+            if "." in version:
+                major_str, *rest = version.split(".")
+            else:
+                major_str = version[0]
+                rest = [version[1:]] if len(version) > 1 else []
+            try:
+                major = int(major_str)
+                if major != 3:
+                    raise InvalidVariantHeader("major version must be 3")
+                if len(rest) > 0:
+                    minor = int(rest[0])
+                else:
+                    # Default to lowest supported minor version.
+                    minor = 3
+                version_str = f"PY{major}{minor}"
+                if not hasattr(TargetVersion, version_str):
+                    raise InvalidVariantHeader(f"3.{minor} is not supported")
+                versions.add(TargetVersion[version_str])
+            except (KeyError, ValueError):
+                raise InvalidVariantHeader("expected e.g. '3.7', 'py3.5'") from None
+        return False, versions
+
+
+def patched_main() -> None:
+    maybe_install_uvloop()
+    freeze_support()
+    main()
+
+
+if __name__ == "__main__":
+    patched_main()
@@ -0,0 +1,3 @@
+import pyinkd
+
+pyinkd.patched_main()
@@ -4,14 +4,17 @@ import asyncio
 import inspect
 import io
 import logging
-import multiprocessing
 import os
 import re
+import shutil
+import sqlite3
+import subprocess
 import sys
 import textwrap
+import time
 import types
 from concurrent.futures import ThreadPoolExecutor
-from contextlib import contextmanager, redirect_stderr
+from contextlib import closing, contextmanager, redirect_stderr
 from dataclasses import replace
 from io import BytesIO
 from pathlib import Path
@@ -24,8 +27,10 @@ from typing import (
     Iterator,
     List,
     Optional,
+    Pattern,
     Sequence,
     Set,
+    Tuple,
     Type,
     TypeVar,
     Union,
@@ -56,6 +61,7 @@ from tests.util import (
     PY36_VERSIONS,
     THIS_DIR,
     BlackBaseTestCase,
+    all_data_cases,
     assert_format,
     change_directory,
     dump_to_stderr,
@@ -841,6 +847,76 @@ class BlackTestCase(BlackBaseTestCase):
         pyink.lib2to3_parse(py3_only)
         pyink.lib2to3_parse(py3_only, {TargetVersion.PY36})
 
+    def test_line_generator_drops_sibling_maps(self) -> None:
+        from blib2to3.pytree import Node
+        from pyink.linegen import LineGenerator
+
+        source = (
+            "def f(a, b=1):\n"
+            "    x = {'key': [a, b], 'other': (1, 2)}\n"
+            "    return call(x, a + b * 2, name='s')  # comment\n"
+        )
+        root = pyink.lib2to3_parse(source)
+        line_generator = LineGenerator(mode=DEFAULT_MODE, features=())
+        lines = [str(line) for line in line_generator.visit(root)]
+        self.assertTrue(lines)
+        for node in root.pre_order():
+            if isinstance(node, Node):
+                self.assertIsNone(node.prev_sibling_map)
+                self.assertIsNone(node.next_sibling_map)
+
+    def test_select_grammars(self) -> None:
+        from pyink.parsing import get_grammars, grammar_name, select_grammars
+
+        grammars = get_grammars(set())
+
+        def first(src: str, preferred: Optional[str] = None) -> str:
+            return grammar_name(select_grammars(src, grammars, preferred)[0])
+
+        self.assertEqual(first("x = 1\n"), "3.7")
+        self.assertEqual(first("match x:\n    case 1:\n        pass\n"), "3.10")
+        self.assertEqual(first("type X = int\n"), "3.10")
+        self.assertEqual(first("async = 1\n"), "3.0")
+        self.assertEqual(first("x.await()\n"), "3.0")
+        # Nothing in strings and comments counts.
+        self.assertEqual(first("x = 'match x:'  # async = 1\n"), "3.7")
+        self.assertEqual(first('"""\nmatch x:\n"""\n'), "3.7")
+        # These parse as a call and a subscript with any grammar.
+        self.assertEqual(first("match (x)\nmatch [x]\n"), "3.7")
+        # Without constructs that rule it out, the preferred grammar goes first.
+        self.assertEqual(first("x = 1\n", "3.10"), "3.10")
+        self.assertEqual(first("async = 1\n", "3.10"), "3.0")
+        self.assertEqual(len(select_grammars("async = 1\n", grammars)), 3)
+
+    def test_select_grammars_same_tree(self) -> None:
+        from pyink import parsing
+
+        def parse(src: str) -> Tuple[str, str]:
+            try:
+                node = pyink.lib2to3_parse(src)
+            except pyink.InvalidInput as exc:
+                return "", str(exc)
+            return repr(node), str(node)
+
+        for case in all_data_cases("cases"):
+            with self.subTest(case=case):
+                source, _ = read_data("cases", case)
+                with patch.object(
+                    parsing, "select_grammars", side_effect=lambda src, g, p: g
+                ):
+                    expected = parse(source)
+                self.assertEqual(parse(source), expected)
+
+    def test_preferred_grammar(self) -> None:
+        from pyink.parsing import grammar_choice, preferred_grammar
+
+        with preferred_grammar("3.10") as choice:
+            pyink.lib2to3_parse("x = 1\n")
+            self.assertEqual(choice.used, "3.10")
+            pyink.lib2to3_parse("async = 1\n")
+            self.assertEqual(choice.used, "3.0")
+        self.assertIsNone(grammar_choice.preferred)
+
     def test_get_features_used_decorator(self) -> None:
         # Test the feature detection of new decorator syntax
         # since this makes some test cases of test_get_features_used()
@@ -1006,6 +1082,70 @@ class BlackTestCase(BlackBaseTestCase):
         )
         self.assertEqual({"unicode_literals", "print"}, pyink.get_future_imports(node))
 
+    def test_annotate_tree(self) -> None:
+        from pyink.annotation import annotate_tree
+        from pyink.mode import Quote
+
+        source = (
+            "from __future__ import annotations\n"
+            "x = 'a' + 'b' + f\"{c=}\" + '''d'''\n"
+            "# fmt: off\n"
+            "y = [1,2]\n"
+            "# fmt: on\n"
+            "z = (w := 1_000)  # fmt: skip\n"
+        )
+        node = pyink.lib2to3_parse(source)
+        annotations = annotate_tree(node, future_imports=pyink.get_future_imports(node))
+        self.assertEqual(
+            annotations.features,
+            {
+                Feature.FUTURE_ANNOTATIONS,
+                Feature.F_STRINGS,
+                Feature.DEBUG_F_STRINGS,
+                Feature.ASSIGNMENT_EXPRESSIONS,
+                Feature.NUMERIC_UNDERSCORES,
+            },
+        )
+        self.assertEqual((annotations.single_quotes, annotations.double_quotes), (2, 1))
+        self.assertEqual(annotations.majority_quote, Quote.SINGLE)
+        self.assertEqual(
+            [leaf.value for leaf in annotations.fmt_pass_leaves], ["y", "z", "\n"]
+        )
+
+        annotations = annotate_tree(node, detect_features=False)
+        self.assertEqual(annotations.features, set())
+        self.assertEqual(len(annotations.fmt_pass_leaves), 3)
+        node = pyink.lib2to3_parse("x = 1  # fmt is on\n")
+        self.assertEqual(annotate_tree(node).fmt_pass_leaves, [])
+
+    def test_normalize_fmt_off_scales_linearly(self) -> None:
+        from pyink import comments
+        from pyink.nodes import STANDALONE_COMMENT
+
+        def source(regions: int) -> str:
+            return "".join(
+                f"# fmt: off\ntable_{i} = [\n    1,2,  3,\n]\n# fmt: on\n"
+                f"row_{i} = [1,2,  3]  # fmt: skip\n"
+                for i in range(regions)
+            )
+
+        def comment_scans(regions: int) -> int:
+            node = pyink.lib2to3_parse(source(regions))
+            with patch(
+                "pyink.comments.list_comments", wraps=comments.list_comments
+            ) as list_comments:
+                comments.normalize_fmt_off(node, DEFAULT_MODE, ())
+            standalone = [
+                leaf for leaf in node.leaves() if leaf.type == STANDALONE_COMMENT
+            ]
+            self.assertEqual(len(standalone), 2 * regions)
+            return list_comments.call_count
+
+        scans = [comment_scans(regions) for regions in (50, 100, 200)]
+        # Twice the regions, twice the work.
+        self.assertEqual(scans[2] - scans[1], 2 * (scans[1] - scans[0]))
+        self.assertEqual(pyink.format_str(source(200), mode=DEFAULT_MODE), source(200))
+
     @pytest.mark.incompatible_with_mypyc
     def test_debug_visitor(self) -> None:
         source, _ = read_data("miscellaneous", "debug_visitor")
@@ -2044,6 +2184,285 @@ class BlackTestCase(BlackBaseTestCase):
             b"Cannot use line-ranges in the pyproject.toml file." in result.stderr_bytes
         )
 
+    def test_start_method(self) -> None:
+        with TemporaryDirectory() as workspace, cache_dir(), patch(
+            "pyink.concurrency.ProcessPoolExecutor",
+            side_effect=lambda **kwargs: ThreadPoolExecutor(
+                max_workers=kwargs["max_workers"],
+                initializer=kwargs["initializer"],
+                initargs=kwargs["initargs"],
+            ),
+        ) as executor:
+            for name in ("one.py", "two.py"):
+                (Path(workspace) / name).write_text("x = 1\n", encoding="utf-8")
+            self.invokeBlack(["--start-method", "spawn", workspace])
+            mp_context = executor.call_args.kwargs["mp_context"]
+            self.assertEqual(mp_context.get_start_method(), "spawn")
+
+    def test_start_method_unsupported(self) -> None:
+        with TemporaryDirectory() as workspace, patch(
+            "multiprocessing.get_all_start_methods", return_value=["spawn"]
+        ):
+            for name in ("one.py", "two.py"):
+                (Path(workspace) / name).write_text("x = 1\n", encoding="utf-8")
+            result = CliRunner().invoke(
+                pyink.main, ["--start-method", "fork", workspace]
+            )
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("Start method fork is not supported", result.output)
+
+    def test_worker_warm_up(self) -> None:
+        from pyink import concurrency
+
+        concurrency.warm_up_worker(DEFAULT_MODE)
+        results, warm_up_seconds = concurrency.format_files_in_worker(
+            [], False, DEFAULT_MODE, pyink.WriteBack.YES
+        )
+        self.assertEqual(results, [])
+        self.assertIsNotNone(warm_up_seconds)
+        # Only the first batch of a worker reports its warm-up.
+        _, warm_up_seconds = concurrency.format_files_in_worker(
+            [], False, DEFAULT_MODE, pyink.WriteBack.YES
+        )
+        self.assertIsNone(warm_up_seconds)
+
+    def test_per_file_timeout(self) -> None:
+        from pyink import concurrency
+
+        def slow(*args: Any, **kwargs: Any) -> None:
+            time.sleep(10)
+
+        with TemporaryDirectory() as workspace, patch(
+            "pyink.format_file_contents", side_effect=slow
+        ):
+            src = Path(workspace) / "slow.py"
+            src.write_text("x  =  1\n", encoding="utf-8")
+            start = time.perf_counter()
+            (error,), _ = concurrency.format_files_in_worker(
+                [(src, None)],
+                False,
+                DEFAULT_MODE,
+                pyink.WriteBack.YES,
+                concurrency.Limits(timeout=0.1),
+            )
+            self.assertLess(time.perf_counter() - start, 5)
+            assert isinstance(error, concurrency.WorkerError)
+            self.assertEqual(str(error.exc), "timed out after 0.1 seconds")
+            # Only formatting is interrupted, never writing the file back.
+            self.assertEqual(src.read_text(encoding="utf-8"), "x  =  1\n")
+
+    def test_per_file_max_memory(self) -> None:
+        from pyink import concurrency
+
+        def out_of_memory(*args: Any, **kwargs: Any) -> None:
+            # The formatter wraps some errors, like in its AST safety checks.
+            try:
+                raise MemoryError
+            except MemoryError as exc:
+                raise AssertionError("INTERNAL ERROR: invalid code") from exc
+
+        with TemporaryDirectory() as workspace, patch(
+            "pyink.concurrency.format_file_bytes_in_place", side_effect=out_of_memory
+        ):
+            src = Path(workspace) / "big.py"
+            src.write_text("x = 1\n", encoding="utf-8")
+            (error,), _ = concurrency.format_files_in_worker(
+                [(src, None)],
+                False,
+                DEFAULT_MODE,
+                pyink.WriteBack.YES,
+                concurrency.Limits(max_memory=100),
+            )
+            assert isinstance(error, concurrency.WorkerError)
+            self.assertEqual(str(error.exc), "exceeded the memory limit of 100 MB")
+
+    def test_worker_error_without_traceback(self) -> None:
+        from pyink import concurrency
+
+        with TemporaryDirectory() as workspace, patch(
+            "pyink.concurrency.format_file_bytes_in_place", side_effect=MemoryError
+        ), patch("traceback.format_exc", side_effect=MemoryError):
+            src = Path(workspace) / "big.py"
+            src.write_text("x = 1\n", encoding="utf-8")
+            (error,), _ = concurrency.format_files_in_worker(
+                [(src, None)],
+                False,
+                DEFAULT_MODE,
+                pyink.WriteBack.YES,
+                concurrency.Limits(max_memory=100),
+            )
+            assert isinstance(error, concurrency.WorkerError)
+            self.assertEqual(str(error.exc), "exceeded the memory limit of 100 MB")
+            self.assertEqual(error.traceback, "")
+
+    def test_worker_warm_up_verbose(self) -> None:
+        with TemporaryDirectory() as workspace, cache_dir(), patch(
+            "pyink.concurrency.ProcessPoolExecutor", new=ThreadPoolExecutor
+        ):
+            for name in ("one.py", "two.py"):
+                (Path(workspace) / name).write_text("x = 1\n", encoding="utf-8")
+            result = BlackRunner().invoke(
+                pyink.main,
+                [
+                    "--verbose",
+                    "--config",
+                    str(THIS_DIR / "empty.toml"),
+                    "--workers",
+                    "1",
+                    workspace,
+                ],
+            )
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Using 1 worker process(es) (--workers)", result.stderr)
+            self.assertRegex(result.stderr, r"Warmed up 1 worker\(s\) in \d+\.\d+s")
+
+    def test_choose_workers(self) -> None:
+        from pyink import concurrency
+
+        with TemporaryDirectory() as workspace, patch(
+            "pyink.concurrency.usable_cpus", return_value=(4, "cgroup CPU quota")
+        ):
+            small = [Path(workspace) / f"small{i}.py" for i in range(2)]
+            big = [Path(workspace) / f"big{i}.py" for i in range(8)]
+            for src in small:
+                src.write_text("x = 1\n", encoding="utf-8")
+            for src in big:
+                src.write_bytes(b"x = 1\n" * concurrency.MIN_BYTES_PER_WORKER)
+            self.assertEqual(
+                concurrency.choose_workers(small), (1, "2 file(s), 12 bytes")
+            )
+            self.assertEqual(
+                concurrency.choose_workers([*small, *big]), (4, "cgroup CPU quota")
+            )
+
+    def test_choose_workers_in_process(self) -> None:
+        with TemporaryDirectory() as workspace, cache_dir(), patch(
+            "pyink.concurrency.usable_cpus", return_value=(4, "CPUs in the system")
+        ), patch("pyink.concurrency.ProcessPoolExecutor") as executor:
+            for name in ("one.py", "two.py"):
+                (Path(workspace) / name).write_text("x = 1\n", encoding="utf-8")
+            result = BlackRunner().invoke(
+                pyink.main,
+                ["--verbose", "--config", str(THIS_DIR / "empty.toml"), workspace],
+            )
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Formatting in-process (2 file(s), 12 bytes)", result.stderr)
+            executor.assert_not_called()
+
+    def test_cgroup_cpu_quota(self) -> None:
+        from pyink.concurrency import cgroup_cpu_quota
+
+        with TemporaryDirectory() as workspace:
+            root = Path(workspace)
+            self.assertIsNone(cgroup_cpu_quota(root))
+            (root / "cpu.max").write_text("max 100000\n", encoding="utf-8")
+            self.assertIsNone(cgroup_cpu_quota(root))
+            (root / "cpu.max").write_text("250000 100000\n", encoding="utf-8")
+            self.assertEqual(cgroup_cpu_quota(root), 3)
+            (root / "cpu.max").unlink()
+            (root / "cpu").mkdir()
+            (root / "cpu" / "cpu.cfs_quota_us").write_text("400000\n")
+            (root / "cpu" / "cpu.cfs_period_us").write_text("100000\n")
+            self.assertEqual(cgroup_cpu_quota(root), 4)
+            (root / "cpu" / "cpu.cfs_quota_us").write_text("-1\n")
+            self.assertIsNone(cgroup_cpu_quota(root))
+
+    def test_shard_sources(self) -> None:
+        with TemporaryDirectory() as workspace:
+            root = Path(workspace)
+            sources = set()
+            for i in range(20):
+                src = root / f"f{i}.py"
+                src.write_text("x = 1\n" * (i + 1), encoding="utf-8")
+                sources.add(src)
+            shards = [pyink.files.shard_sources(sources, root, i, 3) for i in (1, 2, 3)]
+            self.assertEqual(set().union(*shards), sources)
+            self.assertEqual(sum(len(shard) for shard in shards), len(sources))
+            sizes = [sum(src.stat().st_size for src in shard) for shard in shards]
+            self.assertLessEqual(max(sizes) - min(sizes), 20 * len("x = 1\n"))
+            # The split doesn't depend on the order or spelling of the paths.
+            relative = {Path(os.path.relpath(src)) for src in sources}
+            shard = pyink.files.shard_sources(relative, root, 2, 3)
+            self.assertEqual({src.resolve() for src in shard}, shards[1])
+
+    def test_shard(self) -> None:
+        with TemporaryDirectory() as workspace, cache_dir():
+            for i in range(4):
+                (Path(workspace) / f"f{i}.py").write_text(
+                    "x  =  1\n" * (i + 1), encoding="utf-8"
+                )
+            outputs = []
+            for index in (1, 2):
+                result = BlackRunner().invoke(
+                    pyink.main,
+                    [
+                        "--verbose",
+                        "--check",
+                        "--config",
+                        str(THIS_DIR / "empty.toml"),
+                        "--shard",
+                        f"{index}/2",
+                        workspace,
+                    ],
+                )
+                self.assertEqual(result.exit_code, 1)
+                self.assertIn(f"Shard {index}/2: 2 of 4 files", result.stderr)
+                outputs.append(result.stderr)
+            for i in range(4):
+                would_reformat = f"would reformat {Path(workspace) / f'f{i}.py'}"
+                self.assertEqual(sum(would_reformat in out for out in outputs), 1)
+
+    def test_discovery_time_verbose(self) -> None:
+        with TemporaryDirectory() as workspace:
+            (Path(workspace) / "sub").mkdir()
+            for name in ("one.py", "sub/two.py"):
+                (Path(workspace) / name).write_text("x = 1\n", encoding="utf-8")
+            result = BlackRunner().invoke(
+                pyink.main,
+                [
+                    "--verbose",
+                    "--check",
+                    "--config",
+                    str(THIS_DIR / "empty.toml"),
+                    workspace,
+                ],
+            )
+            self.assertEqual(result.exit_code, 0)
+            self.assertRegex(result.stderr, r"Found 2 source\(s\) in \d+\.\d{3}s")
+
+    def test_shard_invalid(self) -> None:
+        for value in ("0/2", "3/2", "1", "a/b", "1/2/3"):
+            result = BlackRunner().invoke(pyink.main, ["--shard", value, "."])
+            self.assertEqual(result.exit_code, 2, value)
+            self.assertIn("Invalid value for '--shard'", result.stderr)
+        result = BlackRunner().invoke(pyink.main, ["--shard", "1/2", "-c", "x = 1"])
+        self.assertEqual(result.exit_code, 1)
+
+    def test_formatting_modules_imported_lazily(self) -> None:
+        # The formatting machinery is only imported once a file needs formatting.
+        formatting_modules = {
+            "blib2to3.pytree",
+            "pyink.comments",
+            "pyink.linegen",
+            "pyink.lines",
+            "pyink.nodes",
+            "pyink.parsing",
+            "pyink.trans",
+        }
+        for args in (["-c", "import pyink"], ["-m", "pyink", "--version"]):
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", *args],
+                capture_output=True,
+                encoding="utf-8",
+                check=True,
+            )
+            imported: Set[str] = set()
+            for line in result.stderr.splitlines():
+                if line.startswith("import time:") and "|" in line:
+                    imported.add(line.rsplit("|", 1)[1].strip())
+            self.assertIn("pyink", imported)
+            self.assertFalse(formatting_modules & imported, args)
+
 
 class TestCaching:
     def test_get_cache_dir(
@@ -2077,7 +2496,7 @@ class TestCaching:
         mode = DEFAULT_MODE
         with cache_dir() as workspace:
             cache_file = get_cache_file(mode)
-            cache_file.write_text("this is not a pickle", encoding="utf-8")
+            cache_file.write_text("this is not a database", encoding="utf-8")
             assert pyink.Cache.read(mode).file_data == {}
             src = (workspace / "test.py").resolve()
             src.write_text("print('hello')", encoding="utf-8")
@@ -2085,6 +2504,26 @@ class TestCaching:
             cache = pyink.Cache.read(mode)
             assert not cache.is_changed(src)
 
+    def test_cache_locked_file_kept(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            src = (workspace / "test.py").resolve()
+            src.write_text("print('hello')", encoding="utf-8")
+            other = (workspace / "other.py").resolve()
+            other.write_text("print('world')", encoding="utf-8")
+            pyink.Cache.read(mode).write([src])
+            cache = pyink.Cache.read(mode)
+            # Another process is in the middle of writing.
+            with closing(sqlite3.connect(str(cache.cache_file))) as db:
+                db.execute("BEGIN IMMEDIATE")
+                with patch("pyink.cache.LOCK_TIMEOUT", 0.01):
+                    cache.write([other])
+                db.rollback()
+            assert cache.cache_file.exists()
+            cache = pyink.Cache.read(mode)
+            assert not cache.is_changed(src)
+            assert cache.is_changed(other)
+
     def test_cache_single_file_already_cached(self) -> None:
         mode = DEFAULT_MODE
         with cache_dir() as workspace:
@@ -2095,6 +2534,57 @@ class TestCaching:
             invokeBlack([str(src)])
             assert src.read_text(encoding="utf-8") == "print('hello')"
 
+    def test_cache_by_content(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            original = (workspace / "original.py").resolve()
+            original.write_text("print('hello')", encoding="utf-8")
+            pyink.Cache.read(mode).write([original])
+            (workspace / "copy").mkdir()
+            copy = (workspace / "copy" / "copy.py").resolve()
+            copy.write_bytes(original.read_bytes())
+            stub = (workspace / "copy" / "copy.pyi").resolve()
+            stub.write_bytes(original.read_bytes())
+
+            assert pyink.Cache.read(mode).is_changed(copy)
+            cache = pyink.Cache.read(mode, by_content=True)
+            assert not cache.is_changed(copy)
+            assert cache.is_changed(stub)
+
+            invokeBlack([str(copy), "--cache-by-content"])
+            assert copy.read_text(encoding="utf-8") == "print('hello')"
+            invokeBlack([str(copy)])
+            assert copy.read_text(encoding="utf-8") == 'print("hello")\n'
+
+            # The newly formatted contents are now known as well.
+            original.write_text('print("hello")\n', encoding="utf-8")
+            assert pyink.Cache.read(mode).is_changed(original)
+            assert not pyink.Cache.read(mode, by_content=True).is_changed(original)
+
+    def test_cache_by_content_stdin(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            src = (workspace / "test.py").resolve()
+            src.write_text("print('hello')\n", encoding="utf-8")
+            pyink.Cache.read(mode).write([src])
+            runner = BlackRunner()
+            for args, expected in [
+                (["-"], 'print("hello")\n'),
+                (["--cache-by-content", "-"], "print('hello')\n"),
+                (["--cache-by-content", "--stdin-filename", "x.pyi", "-"], None),
+            ]:
+                result = runner.invoke(
+                    pyink.main,
+                    ["--config", str(THIS_DIR / "empty.toml"), *args],
+                    input=BytesIO(b"print('hello')\n"),
+                )
+                assert result.exit_code == 0, result.stderr
+                if expected is None:
+                    # Stubs are formatted differently, so the cache doesn't apply.
+                    assert result.stdout == 'print("hello")\n'
+                else:
+                    assert result.stdout == expected
+
     @event_loop()
     def test_cache_multiple_files(self) -> None:
         mode = DEFAULT_MODE
@@ -2114,6 +2604,194 @@ class TestCaching:
             assert not cache.is_changed(one)
             assert not cache.is_changed(two)
 
+    def test_cache_validated_in_worker(self) -> None:
+        from pyink.concurrency import format_file_in_worker
+
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            src = (workspace / "test.py").resolve()
+            src.write_text("print('hello')\n", encoding="utf-8")
+            pyink.Cache.read(mode).write([src])
+            cache = pyink.Cache.read(mode)
+            cache.prefetch([src])
+            with patch.object(Path, "read_bytes") as read_bytes:
+                result = format_file_in_worker(
+                    src, False, mode, pyink.WriteBack.YES, cache.subset(src)
+                )
+            assert result == (pyink.Changed.CACHED, None, None, None, None)
+            read_bytes.assert_not_called()
+
+    def test_cache_all_cached_skips_workers(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            srcs = [(workspace / f"test{i}.py").resolve() for i in range(3)]
+            for src in srcs:
+                src.write_text("print('hello')", encoding="utf-8")
+            pyink.Cache.read(mode).write(srcs)
+            with patch(
+                "pyink.concurrency.reformat_many"
+            ) as reformat_many, patch.object(Path, "read_bytes") as read_bytes:
+                invokeBlack([str(workspace)])
+            reformat_many.assert_not_called()
+            read_bytes.assert_not_called()
+            # A file that was only touched is looked at by its contents.
+            os.utime(srcs[0], (0, 0))
+            with patch("pyink.concurrency.reformat_many") as reformat_many:
+                invokeBlack([str(workspace)])
+            reformat_many.assert_called_once()
+            assert reformat_many.call_args.kwargs["sources"] == {srcs[0]}
+
+    def test_cache_refreshed_when_unchanged_by_content(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace, patch(
+            "concurrent.futures.ProcessPoolExecutor", new=ThreadPoolExecutor
+        ):
+            one = (workspace / "one.py").resolve()
+            two = (workspace / "two.py").resolve()
+            for src in (one, two):
+                src.write_text("print('hello')\n", encoding="utf-8")
+            pyink.Cache.read(mode).write([one, two])
+            os.utime(one, (0, 0))
+            invokeBlack([str(workspace)])
+            # The entry matches the stat result again, so the file isn't read on
+            # the next run.
+            cache = pyink.Cache.read(mode)
+            cache.prefetch([one])
+            _, cached = cache.filtered_by_stat([one])
+            assert cached == {one}
+
+    @pytest.mark.parametrize("newline", ["\n", "\r\n"], ids=["lf", "crlf"])
+    def test_cache_file_data_from_worker(self, newline: str) -> None:
+        from pyink.concurrency import format_file_in_worker
+
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            src = (workspace / "test.py").resolve()
+            src.write_bytes(f"print('hello'){newline}x = 1{newline}".encode())
+            cache = pyink.Cache.read(mode)
+            cache.prefetch([src])
+            changed, file_data, *_ = format_file_in_worker(
+                src, False, mode, pyink.WriteBack.YES, cache.subset(src)
+            )
+            assert changed is pyink.Changed.YES
+            # The worker hashes what it wrote instead of reading it back.
+            assert file_data == pyink.Cache.get_file_data(src)
+
+    def test_cache_records_grammars(self) -> None:
+        from pyink import parsing
+
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace, patch(
+            "concurrent.futures.ProcessPoolExecutor", new=ThreadPoolExecutor
+        ):
+            one = (workspace / "one.py").resolve()
+            one.write_text("x = 1\n", encoding="utf-8")
+            two = (workspace / "two.py").resolve()
+            two.write_text("match x:\n    case 1:\n        pass\n", encoding="utf-8")
+            invokeBlack([str(workspace)])
+            cache = pyink.Cache.read(mode)
+            assert cache.get_grammar(str(one)) == "3.7"
+            assert cache.get_grammar(str(two)) == "3.10"
+            # The next run tries that grammar first, for the files that changed.
+            two.write_text("match (x):\n    case 1:\n        pass\n", encoding="utf-8")
+            with patch.object(
+                parsing, "preferred_grammar", wraps=parsing.preferred_grammar
+            ) as preferred_grammar:
+                invokeBlack([str(workspace)])
+            preferred_grammar.assert_called_once_with("3.10")
+
+    def test_cache_records_durations(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace, patch(
+            "concurrent.futures.ProcessPoolExecutor", new=ThreadPoolExecutor
+        ):
+            one = (workspace / "one.py").resolve()
+            one.write_text("print('hello')", encoding="utf-8")
+            two = (workspace / "two.py").resolve()
+            two.write_text("print('hello')", encoding="utf-8")
+            pyink.Cache.read(mode).write([one])
+            invokeBlack([str(workspace)])
+            cache = pyink.Cache.read(mode)
+            cache.prefetch([one, two])
+            # Cached files weren't formatted, so there's nothing to record.
+            assert str(one) not in cache.durations
+            assert cache.durations[str(two)] > 0
+
+    def test_cache_checkpoints(self) -> None:
+        mode = DEFAULT_MODE
+        write_file_data = pyink.Cache.write_file_data
+        with cache_dir() as workspace, patch(
+            "concurrent.futures.ProcessPoolExecutor", new=ThreadPoolExecutor
+        ), patch("pyink.concurrency.BATCH_SECONDS", 0), patch(
+            "pyink.concurrency.CHECKPOINT_FILES", 2
+        ), patch.object(
+            pyink.Cache, "write_file_data", autospec=True, side_effect=write_file_data
+        ) as written:
+            sources = [(workspace / f"f{i}.py").resolve() for i in range(6)]
+            for src in sources:
+                src.write_text("print('hello')", encoding="utf-8")
+            invokeBlack([str(workspace)])
+            assert written.call_count == 3
+            cache = pyink.Cache.read(mode)
+            assert not cache.filtered_cached(sources)[0]
+
+    def test_cache_checkpoint_when_interrupted(self) -> None:
+        mode = DEFAULT_MODE
+        done = Report.done
+        calls = 0
+
+        def interrupt(report: Report, src: Path, changed: pyink.Changed) -> None:
+            nonlocal calls
+            calls += 1
+            if calls > 3:
+                raise KeyboardInterrupt
+            done(report, src, changed)
+
+        with cache_dir() as workspace, patch(
+            "concurrent.futures.ProcessPoolExecutor", new=ThreadPoolExecutor
+        ), patch("pyink.concurrency.BATCH_SECONDS", 0):
+            sources = [(workspace / f"f{i}.py").resolve() for i in range(6)]
+            for src in sources:
+                src.write_text("print('hello')", encoding="utf-8")
+            with patch.object(Report, "done", autospec=True, side_effect=interrupt):
+                invokeBlack([str(workspace)], exit_code=1)
+            # The files finished before the interruption are already cached.
+            todo, cached = pyink.Cache.read(mode).filtered_cached(sources)
+            assert len(cached) == 4
+            assert len(todo) == 2
+
+    def test_schedule_longest_first(self) -> None:
+        from pyink.concurrency import batch_sources, estimate_costs
+
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            slow = (workspace / "slow.py").resolve()
+            big = (workspace / "big.py").resolve()
+            small = [(workspace / f"small{i}.py").resolve() for i in range(100)]
+            for src in small:
+                src.write_text("x = 1\n", encoding="utf-8")
+            slow.write_text("x = 1\n" * 2_000, encoding="utf-8")
+            big.write_text("x = 1\n" * 1_000, encoding="utf-8")
+            cache = pyink.Cache.read(mode)
+            cache.write_file_data(
+                {slow: pyink.Cache.get_file_data(slow)}, durations={slow: 6.0}
+            )
+            cache = pyink.Cache.read(mode)
+            resolved = {src: src for src in [*small, big, slow]}
+            cache.prefetch(resolved)
+            costs = estimate_costs(resolved, cache)
+            assert costs[slow] == 6.0
+            # Without history, estimates scale with the size, at the throughput
+            # recorded for other files.
+            assert costs[big] == pytest.approx(3.0)
+            assert costs[small[0]] < 0.01
+            batches = batch_sources(costs)
+            # The file that was slow last time starts first, then the biggest
+            # one. The many tiny files are grouped into a few tasks.
+            assert batches[:2] == [[slow], [big]]
+            assert sorted(sum(batches[2:], [])) == sorted(small)
+            assert len(batches) < 10
+
     @pytest.mark.incompatible_with_mypyc
     @pytest.mark.parametrize("color", [False, True], ids=["no-color", "with-color"])
     def test_no_cache_when_writeback_diff(self, color: bool) -> None:
@@ -2133,23 +2811,36 @@ class TestCaching:
                 read_cache.assert_called_once()
                 write_cache.assert_not_called()
 
+    @pytest.mark.parametrize("window", [1, 256])
     @pytest.mark.parametrize("color", [False, True], ids=["no-color", "with-color"])
     @event_loop()
-    def test_output_locking_when_writeback_diff(self, color: bool) -> None:
+    def test_diff_output_in_sorted_order(self, color: bool, window: int) -> None:
         with cache_dir() as workspace:
-            for tag in range(0, 4):
-                src = (workspace / f"test{tag}.py").resolve()
-                src.write_text("print('hello')", encoding="utf-8")
+            # The first file takes the longest to format, so it's done last.
+            names = [f"test{tag}.py" for tag in range(4)]
+            (workspace / names[0]).write_text(
+                "print('hello')\n" * 300, encoding="utf-8"
+            )
+            for name in names[1:]:
+                (workspace / name).write_text("print('hello')", encoding="utf-8")
+            cmd = ["--diff", "--workers", "4", str(workspace)]
+            if color:
+                cmd.append("--color")
             with patch(
-                "pyink.concurrency.Manager", wraps=multiprocessing.Manager
-            ) as mgr:
-                cmd = ["--diff", str(workspace)]
-                if color:
-                    cmd.append("--color")
-                invokeBlack(cmd, exit_code=0)
-                # this isn't quite doing what we want, but if it _isn't_
-                # called then we cannot be using the lock it provides
-                mgr.assert_called()
+                "concurrent.futures.ProcessPoolExecutor", new=ThreadPoolExecutor
+            ), patch("pyink.concurrency.BATCH_SECONDS", 0), patch(
+                "pyink.concurrency.DIFF_REORDER_WINDOW", window
+            ):
+                result = BlackRunner().invoke(
+                    pyink.main, ["--config", str(THIS_DIR / "empty.toml"), *cmd]
+                )
+            assert result.exit_code == 0, result.output
+            headers = [
+                Path(line.split("\t")[0].split()[-1]).name
+                for line in unstyle(result.stdout).splitlines()
+                if line.startswith("--- ")
+            ]
+            assert headers == names
 
     def test_no_cache_when_stdin(self) -> None:
         mode = DEFAULT_MODE
@@ -2285,6 +2976,158 @@ class TestCaching:
             two = pyink.Cache.read(short_mode)
             assert two.is_changed(path)
 
+    def test_write_cache_concurrent_writers(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            one = (workspace / "one.py").resolve()
+            two = (workspace / "two.py").resolve()
+            one.touch()
+            two.write_text("x = 2\n", encoding="utf-8")
+            # Both caches are opened before either writes, like two pyink processes
+            # started at the same time.
+            first = pyink.Cache.read(mode)
+            second = pyink.Cache.read(mode)
+            first.write([one])
+            second.write([two])
+            cache = pyink.Cache.read(mode)
+            assert cache.filtered_cached([one, two]) == (set(), {one, two})
+
+    def test_write_cache_only_upserts_given_files(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            src = (workspace / "test.py").resolve()
+            src.touch()
+            pyink.Cache.read(mode).write([src])
+            cache = pyink.Cache.read(mode)
+            assert not cache.is_changed(src)
+            with patch.object(
+                pyink.Cache, "get_file_data", wraps=pyink.Cache.get_file_data
+            ) as get_file_data:
+                other = (workspace / "other.py").resolve()
+                other.touch()
+                cache.write([other])
+            get_file_data.assert_called_once_with(other)
+            assert not pyink.Cache.read(mode).is_changed(src)
+
+    def test_read_cache_outdated_schema(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            src = (workspace / "test.py").resolve()
+            src.touch()
+            pyink.Cache.read(mode).write([src])
+            with patch("pyink.cache.SCHEMA_VERSION", pyink.cache.SCHEMA_VERSION + 1):
+                cache = pyink.Cache.read(mode)
+                assert cache.is_changed(src)
+                cache.write([src])
+                assert not pyink.Cache.read(mode).is_changed(src)
+
+    def test_content_digest(self) -> None:
+        # The same ids as `git hash-object`.
+        digest = pyink.cache.content_digest
+        assert digest(b"") == "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
+        assert digest(b"x = 1\n") == "7d4290a117a4ddcc11daae7ea675841033830c8f"
+
+    @pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+    def test_cache_use_git_index(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            root = (workspace / "repo").resolve()
+            root.mkdir()
+            clean = root / "clean.py"
+            copy = root / "copy.py"
+            modified = root / "modified.py"
+            untracked = root / "untracked.py"
+            for src in (clean, copy, modified, untracked):
+                src.write_text("x = 1\n", encoding="utf-8")
+            for args in (["init"], ["add", "clean.py", "copy.py", "modified.py"]):
+                subprocess.run(
+                    ["git", *args], cwd=root, check=True, capture_output=True
+                )
+            pyink.Cache.read(mode).write([clean, modified, untracked])
+            # Like a fresh checkout, or a change that keeps the size.
+            modified.write_text("x = 2\n", encoding="utf-8")
+            for src in (clean, modified, untracked):
+                os.utime(src, (0, 0))
+
+            cache = pyink.Cache.read(mode, by_content=True)
+            cache.use_git_index([clean, copy, modified, untracked])
+            assert set(cache.git_digests) == {str(clean), str(copy)}
+            read_bytes = Path.read_bytes
+            with patch.object(
+                Path, "read_bytes", autospec=True, side_effect=read_bytes
+            ) as read:
+                changed, done = cache.filtered_cached(
+                    [clean, copy, modified, untracked]
+                )
+            assert changed == {modified}
+            assert done == {clean, copy, untracked}
+            # Only the files that aren't unmodified in git were read.
+            assert {call.args[0] for call in read.call_args_list} == {
+                modified,
+                untracked,
+            }
+
+    @pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+    def test_cache_use_git_index_eol_conversion(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            root = (workspace / "repo").resolve()
+            root.mkdir()
+            src = root / "crlf.py"
+            src.write_bytes(b"x = 1\r\n")
+            for args in (["init"], ["config", "core.autocrlf", "true"], ["add", "."]):
+                subprocess.run(
+                    ["git", *args], cwd=root, check=True, capture_output=True
+                )
+            pyink.Cache.read(mode).write([src])
+
+            cache = pyink.Cache.read(mode)
+            cache.use_git_index([src])
+            # Git hashed the contents with LF line endings.
+            assert cache.git_digests == {
+                str(src): pyink.cache.content_digest(b"x = 1\n")
+            }
+            assert not cache.is_changed(src)
+
+    def test_cache_merge(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            one = (workspace / "one.py").resolve()
+            two = (workspace / "two.py").resolve()
+            for src in (one, two):
+                src.write_text("x = 1\n", encoding="utf-8")
+            shards = []
+            for i, src in enumerate((one, two)):
+                shard = workspace / f"shard{i}"
+                with patch("pyink.cache.CACHE_DIR", shard / pyink.__version__):
+                    pyink.Cache.read(mode).write_file_data(
+                        {src: pyink.Cache.get_file_data(src)}, durations={src: 1.0}
+                    )
+                shards.append(str(shard))
+            assert pyink.Cache.read(mode).filtered_cached([one, two])[0] == {one, two}
+            result = CliRunner().invoke(pyink.cache_main, ["merge", *shards])
+            assert result.exit_code == 0, result.output
+            cache = pyink.Cache.read(mode)
+            assert cache.filtered_cached([one, two]) == (set(), {one, two})
+            assert cache.durations == {str(one): 1.0, str(two): 1.0}
+            # The shards themselves are left alone.
+            with patch("pyink.cache.CACHE_DIR", Path(shards[0]) / pyink.__version__):
+                assert pyink.Cache.read(mode).is_changed(two)
+
+    def test_cache_merge_outdated_schema(self) -> None:
+        mode = DEFAULT_MODE
+        with cache_dir() as workspace:
+            src = (workspace / "test.py").resolve()
+            src.touch()
+            pyink.Cache.read(mode).write([src])
+            cache_file = get_cache_file(mode)
+            with patch("pyink.cache.SCHEMA_VERSION", pyink.cache.SCHEMA_VERSION + 1):
+                result = CliRunner().invoke(
+                    pyink.cache_main, ["merge", "--into", "out", str(cache_file)]
+                )
+            assert result.exit_code == 1
+            assert "is not a cache of this version of pyink" in result.output
+
 
 def assert_collected_sources(
     src: Sequence[Union[str, Path]],
@@ -2296,6 +3139,7 @@ def assert_collected_sources(
     extend_exclude: Optional[str] = None,
     force_exclude: Optional[str] = None,
     stdin_filename: Optional[str] = None,
+    use_git_index: bool = False,
 ) -> None:
     gs_src = tuple(str(Path(s)) for s in src)
     gs_expected = [Path(s) for s in expected]
@@ -2316,11 +3160,88 @@ def assert_collected_sources(
         force_exclude=gs_force_exclude,
         report=pyink.Report(),
         stdin_filename=stdin_filename,
+        use_git_index=use_git_index,
     )
     assert sorted(collected) == sorted(gs_expected)
 
 
 class TestFileCollection:
+    @pytest.mark.skipif(shutil.which("git") is None, reason="needs git")
+    @pytest.mark.parametrize(
+        "options",
+        [
+            {},
+            {"exclude": r"/b/"},
+            {"extend_exclude": r"/excluded/", "force_exclude": r"forced\.py"},
+            {"include": r"\.pyi$"},
+        ],
+    )
+    def test_use_git_index(self, tmp_path: Path, options: Dict[str, str]) -> None:
+        root = tmp_path.resolve()
+        for name in [
+            "a.py",
+            "a.pyi",
+            "tracked_ignored.py",
+            "deleted.py",
+            "untracked.py",
+            "untracked_ignored.py",
+            "forced.py",
+            "b/c.py",
+            "b/excluded/d.py",
+            "b/nested/e.py",
+            "b/nested/f.py",
+            "build/g.py",
+            ".venv/h.py",
+        ]:
+            (root / name).parent.mkdir(parents=True, exist_ok=True)
+            (root / name).write_text("x = 1\n", encoding="utf-8")
+        (root / "b" / "nested" / ".gitignore").write_text("f.py\n", encoding="utf-8")
+
+        def git(*args: str) -> None:
+            subprocess.run(["git", *args], cwd=root, check=True, capture_output=True)
+
+        git("init")
+        git("add", ".")
+        (root / ".gitignore").write_text(
+            "tracked_ignored.py\nuntracked_ignored.py\nbuild/\n", encoding="utf-8"
+        )
+        (root / "deleted.py").unlink()
+        git("rm", "--cached", "-q", "untracked.py", "untracked_ignored.py")
+
+        def pattern(name: str) -> Optional[Pattern[str]]:
+            return compile_pattern(options[name]) if name in options else None
+
+        def collect(use_git_index: bool) -> Set[Path]:
+            return pyink.get_sources(
+                root=root,
+                src=(str(root),),
+                quiet=False,
+                verbose=False,
+                include=pattern("include") or DEFAULT_INCLUDE,
+                exclude=pattern("exclude"),
+                extend_exclude=pattern("extend_exclude"),
+                force_exclude=pattern("force_exclude"),
+                report=MagicMock(),
+                stdin_filename=None,
+                use_git_index=use_git_index,
+            )
+
+        walked = collect(use_git_index=False)
+        assert walked
+        assert collect(use_git_index=True) == walked
+
+    def test_use_git_index_outside_git(self) -> None:
+        with patch("pyink.git.ls_files", return_value=None) as ls_files:
+            path = THIS_DIR / "data" / "include_exclude_tests"
+            assert_collected_sources(
+                [path],
+                [path / "b/dont_exclude/a.py", path / "b/dont_exclude/a.pyi"],
+                include=r"\.pyi?$",
+                exclude=r"/exclude/|/\.definitely_exclude/",
+                use_git_index=True,
+            )
+        ls_files.assert_called()
+
     def test_include_exclude(self) -> None:
         path = THIS_DIR / "data" / "include_exclude_tests"
         src = [path]
@@ -2473,6 +3394,56 @@ class TestFileCollection:
         expected = [target / "b.py"]
         assert_collected_sources([target], expected, root=root)
 
+    def test_compiled_gitignore(self) -> None:
+        root = Path("/project")
+        gitignores = {
+            root: ["*.log", "/build/", "docs/**/gen", "!important.log", "a?c"],
+            root / "pkg": ["/local.py", "tmp/", "*.pyc"],
+            root / "pkg" / "sub": ["data[0-9].py", "# comment", ""],
+        }
+        specs = {
+            directory: PathSpec.from_lines("gitwildmatch", lines)
+            for directory, lines in gitignores.items()
+        }
+        gitignore = pyink.files._Gitignore.from_dict(root, specs)
+        paths = [
+            f"{directory}{name}"
+            for directory in ("", "pkg/", "pkg/sub/", "build/", "docs/x/")
+            for name in (
+                "x.log",
+                "important.log",
+                "build",
+                "build/x.py",
+                "gen",
+                "gen/x.py",
+                "abc",
+                "local.py",
+                "tmp",
+                "tmp/x.py",
+                "x.pyc",
+                "data1.py",
+                "datax.py",
+                "ok.py",
+            )
+        ]
+
+        def is_ignored(path: str) -> bool:
+            # Any .gitignore file matching the path ignores it, with its patterns
+            # relative to its directory.
+            for directory, spec in specs.items():
+                prefix = directory.relative_to(root).as_posix() + "/"
+                prefix = "" if prefix == "./" else prefix
+                if path.startswith(prefix) and spec.match_file(path[len(prefix) :]):
+                    return True
+            return False
+
+        for path in paths:
+            assert gitignore.is_ignored(path) == is_ignored(path), path
+        assert gitignore.is_ignored("pkg/sub/data1.py")
+        assert not gitignore.is_ignored("data1.py")
+        assert gitignore.is_ignored("x.log")
+        assert not gitignore.is_ignored("important.log")
+
     def test_empty_include(self) -> None:
         path = DATA_DIR / "include_exclude_tests"
         src = [path]
@@ -2592,6 +3563,126 @@ class TestFileCollection:
         outside_root_symlink.resolve.assert_called_once()
         ignored_symlink.resolve.assert_not_called()
 
+    @pytest.mark.incompatible_with_mypyc
+    def test_nested_symlinks(self) -> None:
+        with TemporaryDirectory() as workspace, TemporaryDirectory() as outside:
+            root = Path(workspace).resolve()
+            (root / "pkg" / "sub").mkdir(parents=True)
+            (root / "pkg" / "sub" / "a.py").write_text("x = 1\n", encoding="utf-8")
+            (root / "pkg" / "b.py").write_text("x = 1\n", encoding="utf-8")
+            (Path(outside) / "c.py").write_text("x = 1\n", encoding="utf-8")
+            try:
+                (root / "pkg" / "inside.py").symlink_to(root / "pkg" / "b.py")
+                (root / "pkg" / "outside").symlink_to(outside, target_is_directory=True)
+            except (OSError, NotImplementedError) as e:
+                pytest.skip(f"Can't create symlinks: {e}")
+            report = MagicMock()
+            resolve = Path.resolve
+            with patch.object(
+                Path, "resolve", autospec=True, side_effect=resolve
+            ) as resolved:
+                files = set(
+                    pyink.gen_python_files(
+                        [root / "pkg"],
+                        root,
+                        re.compile(pyink.DEFAULT_INCLUDES),
+                        re.compile(pyink.DEFAULT_EXCLUDES),
+                        None,
+                        None,
+                        report,
+                        None,
+                        verbose=False,
+                        quiet=False,
+                    )
+                )
+        assert files == {
+            root / "pkg" / "sub" / "a.py",
+            root / "pkg" / "b.py",
+            root / "pkg" / "inside.py",
+        }
+        report.path_ignored.assert_called_once_with(
+            root / "pkg" / "outside", f"is a symbolic link that points outside {root}"
+        )
+        # Only the top-level path and the symlinks were resolved.
+        assert {call.args[0] for call in resolved.call_args_list} == {
+            root / "pkg",
+            root / "pkg" / "inside.py",
+            root / "pkg" / "outside",
+        }
+
+    def test_cache_listings(self) -> None:
+        with TemporaryDirectory() as workspace:
+            root = Path(workspace).resolve()
+            cache_dir = root / "cache"
+            pkg = root / "pkg"
+            (pkg / "sub").mkdir(parents=True)
+            (pkg / "sub" / "a.py").write_text("x = 1\n", encoding="utf-8")
+            (pkg / "b.py").write_text("x = 1\n", encoding="utf-8")
+            for directory in (pkg / "sub", pkg):
+                os.utime(directory, (0, 0))
+
+            def get_sources() -> Set[Path]:
+                return pyink.get_sources(
+                    root=root,
+                    src=(str(root / "pkg"),),
+                    quiet=True,
+                    verbose=False,
+                    include=re.compile(pyink.DEFAULT_INCLUDES),
+                    exclude=None,
+                    extend_exclude=None,
+                    force_exclude=None,
+                    report=pyink.Report(),
+                    stdin_filename=None,
+                    cache_listings=True,
+                )
+
+            scan = pyink.files.scan_directory
+            with patch("pyink.cache.CACHE_DIR", cache_dir), patch(
+                "pyink.cache.scan_directory", side_effect=scan
+            ) as scanned:
+                assert get_sources() == {pkg / "sub" / "a.py", pkg / "b.py"}
+                assert scanned.call_count == 1
+                assert (cache_dir / "listings.db").exists()
+                listings = pyink.cache.DirectoryListings.read(root)
+                assert listings.listings[str(pkg / "sub")][1] == [("a.py", "f")]
+
+                scanned.reset_mock()
+                assert get_sources() == {pkg / "sub" / "a.py", pkg / "b.py"}
+                scanned.assert_not_called()
+
+                # Adding a file updates the mtime of its directory.
+                (pkg / "sub" / "c.py").write_text("x = 1\n", encoding="utf-8")
+                (pkg / "sub" / "a.py").unlink()
+                assert get_sources() == {pkg / "sub" / "c.py", pkg / "b.py"}
+                scanned.assert_called_once_with(pkg / "sub")
+                # It was changed too recently to be cached though.
+                scanned.reset_mock()
+                get_sources()
+                scanned.assert_called_once_with(pkg / "sub")
+
+    def test_cache_listings_locked_file_kept(self) -> None:
+        with TemporaryDirectory() as workspace:
+            root = Path(workspace).resolve()
+            cache_dir = root / "cache"
+            for name in ("a", "b"):
+                (root / name).mkdir()
+                os.utime(root / name, (0, 0))
+            with patch("pyink.cache.CACHE_DIR", cache_dir):
+                listings = pyink.cache.DirectoryListings.read(root)
+                listings.scan(root / "a")
+                listings.write()
+                listings = pyink.cache.DirectoryListings.read(root)
+                listings.scan(root / "b")
+                # Another process is in the middle of writing.
+                with closing(sqlite3.connect(str(listings.cache_file))) as db:
+                    db.execute("BEGIN IMMEDIATE")
+                    with patch("pyink.cache.LOCK_TIMEOUT", 0.01):
+                        listings.write()
+                    db.rollback()
+                assert listings.cache_file.exists()
+                listings = pyink.cache.DirectoryListings.read(root)
+                assert set(listings.listings) == {str(root / "a")}
+
     @patch("pyink.find_project_root", lambda *args: (THIS_DIR.resolve(), None))
     def test_get_sources_with_stdin(self) -> None:
         src = ["-"]
@@ -0,0 +1,138 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterator, Tuple
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+
+import pyink
+from pyink.jobserver import JobServer
+from tests.util import THIS_DIR
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="The make jobserver is POSIX only"
+)
+
+
+@pytest.fixture
+def pipe() -> Iterator[Tuple[int, int]]:
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"+++")
+    try:
+        yield read_fd, write_fd
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+
+def available(read_fd: int) -> bytes:
+    os.set_blocking(read_fd, False)
+    try:
+        return os.read(read_fd, 1024)
+    except BlockingIOError:
+        return b""
+
+
+def test_no_jobserver() -> None:
+    assert JobServer.from_environment(max_tokens=4, makeflags="") is None
+    assert JobServer.from_environment(max_tokens=4, makeflags="-j4 -k") is None
+    makeflags = "-j4 --jobserver-auth=999,998"
+    assert JobServer.from_environment(max_tokens=4, makeflags=makeflags) is None
+
+
+def test_pipe(pipe: Tuple[int, int]) -> None:
+    read_fd, write_fd = pipe
+    makeflags = f"-j4 --jobserver-auth={read_fd},{write_fd}"
+    jobserver = JobServer.from_environment(max_tokens=2, makeflags=makeflags)
+    assert jobserver is not None
+    assert jobserver.acquire()
+    assert jobserver.acquire()
+    # Capped at max_tokens even though make has one more to give.
+    assert not jobserver.acquire()
+    assert jobserver.tokens == 2
+    jobserver.release()
+    assert jobserver.tokens == 1
+    jobserver.close()
+    assert jobserver.tokens == 0
+    assert available(read_fd) == b"+++"
+
+
+def test_pipe_empty(pipe: Tuple[int, int]) -> None:
+    read_fd, write_fd = pipe
+    assert available(read_fd) == b"+++"
+    makeflags = f"--jobserver-fds={read_fd},{write_fd} -j"
+    jobserver = JobServer.from_environment(max_tokens=2, makeflags=makeflags)
+    assert jobserver is not None
+    assert not jobserver.acquire()
+    jobserver.close()
+
+
+def test_pipe_without_non_blocking_reopen(pipe: Tuple[int, int]) -> None:
+    read_fd, write_fd = pipe
+    makeflags = f"-j4 --jobserver-auth={read_fd},{write_fd}"
+    with patch("os.open", side_effect=OSError):
+        assert JobServer.from_environment(max_tokens=2, makeflags=makeflags) is None
+    assert available(read_fd) == b"+++"
+
+
+def test_max_tokens() -> None:
+    assert JobServer.from_environment(max_tokens=0, makeflags="-j4") is None
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="needs os.mkfifo")
+def test_fifo() -> None:
+    with TemporaryDirectory() as workspace:
+        fifo = os.path.join(workspace, "jobserver")
+        os.mkfifo(fifo)
+        makeflags = f"-j3 --jobserver-auth=fifo:{fifo}"
+        jobserver = JobServer.from_environment(max_tokens=4, makeflags=makeflags)
+        assert jobserver is not None
+        assert not jobserver.acquire()
+        os.write(jobserver.write_fd, b"ab")
+        assert jobserver.acquire()
+        assert jobserver.acquire()
+        assert not jobserver.acquire()
+        jobserver.release()
+        jobserver.release()
+        assert jobserver.acquire()
+        jobserver.close()
+
+
+def test_formatting_returns_tokens(pipe: Tuple[int, int]) -> None:
+    read_fd, write_fd = pipe
+    makeflags = f"-j4 --jobserver-auth={read_fd},{write_fd}"
+    acquire = JobServer.acquire
+    with TemporaryDirectory() as workspace, patch(
+        "pyink.cache.CACHE_DIR", Path(workspace) / "cache"
+    ), patch.dict(os.environ, {"MAKEFLAGS": makeflags}), patch(
+        "pyink.concurrency.ProcessPoolExecutor", new=ThreadPoolExecutor
+    ), patch(
+        "pyink.concurrency.BATCH_SECONDS", 0
+    ), patch.object(
+        JobServer, "acquire", autospec=True, side_effect=acquire
+    ) as acquired:
+        sources = Path(workspace) / "src"
+        sources.mkdir()
+        for i in range(20):
+            (sources / f"f{i}.py").write_text(f"x  =  {i}\n", encoding="utf-8")
+        result = CliRunner().invoke(
+            pyink.main,
+            [
+                "--verbose",
+                "--config",
+                str(THIS_DIR / "empty.toml"),
+                "--workers",
+                "4",
+                str(sources),
+            ],
+        )
+        assert result.exit_code == 0, result.output
+        assert "Sharing parallelism with the make jobserver" in result.output
+        assert acquired.called
+        for i in range(20):
+            assert (sources / f"f{i}.py").read_text(encoding="utf-8") == f"x = {i}\n"
+    assert available(read_fd) == b"+++"
@@ -0,0 +1,267 @@
+import re
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+
+from tests.util import DETERMINISTIC_HEADER, read_data
+
+try:
+    from aiohttp import web
+    from aiohttp.test_utils import AioHTTPTestCase
+
+    import pyinkd
+except ImportError as e:
+    raise RuntimeError("Please install Pyink with the 'd' extra") from e
+
+
+class PyinkDTestCase(AioHTTPTestCase):
+    def test_pyinkd_main(self) -> None:
+        with patch("pyinkd.web.run_app"):
+            result = CliRunner().invoke(pyinkd.main, [])
+            if result.exception is not None:
+                raise result.exception
+            self.assertEqual(result.exit_code, 0)
+
+    def test_pyinkd_main_bind_socket(self) -> None:
+        with patch("pyinkd.web.run_app") as run_app:
+            result = CliRunner().invoke(pyinkd.main, ["--bind-socket", "pyinkd.sock"])
+            if result.exception is not None:
+                raise result.exception
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(run_app.call_args.kwargs["path"], "pyinkd.sock")
+
+    async def get_application(self) -> web.Application:
+        return pyinkd.make_app(workers=1)
+
+    async def test_pyinkd_request_needs_formatting(self) -> None:
+        response = await self.client.post("/", data=b"print('hello world')")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.charset, "utf8")
+        self.assertEqual(await response.read(), b'print("hello world")\n')
+
+    async def test_pyinkd_request_no_change(self) -> None:
+        response = await self.client.post("/", data=b'print("hello world")\n')
+        self.assertEqual(response.status, 204)
+        self.assertEqual(await response.read(), b"")
+
+    async def test_pyinkd_request_syntax_error(self) -> None:
+        response = await self.client.post("/", data=b"what even ( is")
+        self.assertEqual(response.status, 400)
+        content = await response.text()
+        self.assertTrue(
+            content.startswith("Cannot parse"),
+            msg=f"Expected error to start with 'Cannot parse', got {repr(content)}",
+        )
+
+    async def test_pyinkd_unsupported_version(self) -> None:
+        response = await self.client.post(
+            "/", data=b"what", headers={pyinkd.PROTOCOL_VERSION_HEADER: "2"}
+        )
+        self.assertEqual(response.status, 501)
+
+    async def test_pyinkd_supported_version(self) -> None:
+        response = await self.client.post(
+            "/", data=b"what", headers={pyinkd.PROTOCOL_VERSION_HEADER: "1"}
+        )
+        self.assertEqual(response.status, 200)
+
+    async def test_pyinkd_invalid_python_variant(self) -> None:
+        async def check(header_value: str, expected_status: int = 400) -> None:
+            response = await self.client.post(
+                "/",
+                data=b"what",
+                headers={pyinkd.PYTHON_VARIANT_HEADER: header_value},
+            )
+            self.assertEqual(response.status, expected_status)
+
+        await check("lol")
+        await check("ruby3.5")
+        await check("pyi3.6")
+        await check("py1.5")
+        await check("2")
+        await check("2.7")
+        await check("py2.7")
+        await check("2.8")
+        await check("py2.8")
+        await check("3.0")
+        await check("pypy3.0")
+        await check("jython3.4")
+
+    async def test_pyinkd_pyi(self) -> None:
+        source, expected = read_data("miscellaneous", "force_pyi")
+        response = await self.client.post(
+            "/", data=source, headers={pyinkd.PYTHON_VARIANT_HEADER: "pyi"}
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.text(), expected)
+
+    async def test_pyinkd_diff(self) -> None:
+        diff_header = re.compile(
+            r"(In|Out)\t\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d\.\d\d\d\d\d\d\+\d\d:\d\d"
+        )
+
+        source, _ = read_data("miscellaneous", "blackd_diff")
+        expected, _ = read_data("miscellaneous", "blackd_diff.diff")
+
+        response = await self.client.post(
+            "/", data=source, headers={pyinkd.DIFF_HEADER: "true"}
+        )
+        self.assertEqual(response.status, 200)
+
+        actual = await response.text()
+        actual = diff_header.sub(DETERMINISTIC_HEADER, actual)
+        self.assertEqual(actual, expected)
+
+    async def test_pyinkd_python_variant(self) -> None:
+        code = (
+            "def f(\n"
+            "    and_has_a_bunch_of,\n"
+            "    very_long_arguments_too,\n"
+            "    and_lots_of_them_as_well_lol,\n"
+            "    **and_very_long_keyword_arguments\n"
+            "):\n"
+            "    pass\n"
+        )
+
+        async def check(header_value: str, expected_status: int) -> None:
+            response = await self.client.post(
+                "/", data=code, headers={pyinkd.PYTHON_VARIANT_HEADER: header_value}
+            )
+            self.assertEqual(
+                response.status, expected_status, msg=await response.text()
+            )
+
+        await check("3.6", 200)
+        await check("py3.6", 200)
+        await check("3.6,3.7", 200)
+        await check("3.6,py3.7", 200)
+        await check("py36,py37", 200)
+        await check("36", 200)
+        await check("3.6.4", 200)
+        await check("3.4", 204)
+        await check("py3.4", 204)
+        await check("py34,py36", 204)
+        await check("34", 204)
+
+    async def test_pyinkd_line_length(self) -> None:
+        response = await self.client.post(
+            "/", data=b'print("hello")\n', headers={pyinkd.LINE_LENGTH_HEADER: "7"}
+        )
+        self.assertEqual(response.status, 200)
+
+    async def test_pyinkd_invalid_line_length(self) -> None:
+        response = await self.client.post(
+            "/", data=b'print("hello")\n', headers={pyinkd.LINE_LENGTH_HEADER: "NaN"}
+        )
+        self.assertEqual(response.status, 400)
+
+    async def test_pyinkd_skip_first_source_line(self) -> None:
+        invalid_first_line = b"Header will be skipped\r\ni = [1,2,3]\nj = [1,2,3]\n"
+        expected_result = b"Header will be skipped\r\ni = [1, 2, 3]\nj = [1, 2, 3]\n"
+        response = await self.client.post("/", data=invalid_first_line)
+        self.assertEqual(response.status, 400)
+        response = await self.client.post(
+            "/",
+            data=invalid_first_line,
+            headers={pyinkd.SKIP_SOURCE_FIRST_LINE: "true"},
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.read(), expected_result)
+
+    async def test_pyinkd_preview(self) -> None:
+        response = await self.client.post(
+            "/", data=b'print("hello")\n', headers={pyinkd.PREVIEW: "true"}
+        )
+        self.assertEqual(response.status, 204)
+
+    async def test_pyinkd_response_pyink_version_header(self) -> None:
+        response = await self.client.post("/")
+        self.assertIsNotNone(response.headers.get(pyinkd.PYINK_VERSION_HEADER))
+
+    async def test_pyinkd_pyink_indentation(self) -> None:
+        response = await self.client.post(
+            "/",
+            data=b"if x:\n    y = 1\n",
+            headers={pyinkd.PYINK_INDENTATION_HEADER: "2"},
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.read(), b"if x:\n  y = 1\n")
+
+        response = await self.client.post(
+            "/",
+            data=b"if x:\n    y = 1\n",
+            headers={pyinkd.PYINK_INDENTATION_HEADER: "3"},
+        )
+        self.assertEqual(response.status, 400)
+
+    async def test_pyinkd_pyink_use_majority_quotes(self) -> None:
+        source = b"a = 'x'\nb = 'y'\nc = \"z\"\n"
+        response = await self.client.post(
+            "/",
+            data=source,
+            headers={pyinkd.PYINK_USE_MAJORITY_QUOTES_HEADER: "true"},
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.read(), b"a = 'x'\nb = 'y'\nc = 'z'\n")
+
+    async def test_pyinkd_line_ranges(self) -> None:
+        source = b"a = [1,2]\nb = [1,2]\nc = [1,2]\n"
+        response = await self.client.post(
+            "/", data=source, headers={pyinkd.LINE_RANGES_HEADER: "2-2"}
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(await response.read(), b"a = [1,2]\nb = [1, 2]\nc = [1,2]\n")
+
+        response = await self.client.post(
+            "/", data=source, headers={pyinkd.LINE_RANGES_HEADER: "1-2,3"}
+        )
+        self.assertEqual(response.status, 400)
+
+    async def test_pyinkd_result_cache(self) -> None:
+        put = pyinkd.ResultCache.put
+        with patch.object(
+            pyinkd.ResultCache, "put", autospec=True, side_effect=put
+        ) as cache_put:
+            for _ in range(2):
+                response = await self.client.post("/", data=b"print('cached')")
+                self.assertEqual(response.status, 200)
+                self.assertEqual(await response.read(), b'print("cached")\n')
+            for _ in range(2):
+                response = await self.client.post("/", data=b'print("cached")\n')
+                self.assertEqual(response.status, 204)
+            # Only the first request for each content reached the worker pool.
+            self.assertEqual(cache_put.call_count, 2)
+
+
+class TestResultCache:
+    def test_lru_eviction(self) -> None:
+        cache = pyinkd.ResultCache(max_size=2)
+        mode = pyinkd.Mode()
+        keys = [pyinkd.ResultCache.key(f"x = {i}\n", mode, False, []) for i in range(3)]
+        cache.put(keys[0], None)
+        cache.put(keys[1], "x = 1\n")
+        assert cache.get(keys[0]) is None
+        cache.put(keys[2], "x = 2\n")
+        assert keys[0] in cache
+        assert keys[1] not in cache
+        assert keys[2] in cache
+
+    def test_disabled(self) -> None:
+        cache = pyinkd.ResultCache(max_size=0)
+        key = pyinkd.ResultCache.key("x = 1\n", pyinkd.Mode(), False, [])
+        cache.put(key, None)
+        assert key not in cache
+
+    @pytest.mark.parametrize(
+        "other",
+        [
+            ("x = 1\n", pyinkd.Mode(line_length=1), False, []),
+            ("x = 1\n", pyinkd.Mode(), True, []),
+            ("x = 1\n", pyinkd.Mode(), False, [(1, 1)]),
+            ("x = 2\n", pyinkd.Mode(), False, []),
+        ],
+    )
+    def test_key_covers_formatting_inputs(self, other: tuple) -> None:
+        key = pyinkd.ResultCache.key("x = 1\n", pyinkd.Mode(), False, [])
+        assert pyinkd.ResultCache.key(*other) != key
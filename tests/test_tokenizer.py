@@ -0,0 +1,95 @@
+import io
+from typing import Iterator, List, Union
+
+import pytest
+
+import pyink
+from blib2to3 import pygram
+from blib2to3.pgen2 import tokenize
+from blib2to3.pgen2.grammar import Grammar
+from pyink import tokenizer
+from tests.util import all_data_cases, read_data
+
+GRAMMARS = {
+    "async_keywords": pygram.python_grammar_async_keywords,
+    "soft_keywords": pygram.python_grammar_soft_keywords,
+    "async_names": pygram.python_grammar,
+}
+# Sources that only blib2to3 tokenizes, or that it fails to tokenize.
+EDGE_CASES = [
+    "",
+    "x = 1",
+    "x = 1\r\ny = 2\r\n",
+    "x = (1,\n",
+    "x = 1 + \\\n",
+    "x = 1 + \\\n    2\n",
+    "if x:\n    y\n  z\n",
+    "\tif x:\n\t\ty\n        z\n",
+    "\x0cx = 1\nif x:\n\x0c    y\n",
+    "s = '''abc\n",
+    "s = '''abc\\\n'''\n",
+    "s = 'abc\\\ndef'\n",
+    "s = f'abc\\\ndef'\n",
+    "x = $\n",
+    "x = a €\n",
+    "x)\ny = 1\n",
+    "async def f():\n    await x\nasync = 1\n",
+    "def f(\n    x,  # comment\n\n    y,\n):\n    # comment\n    pass\n",
+    'x = """\nabc\n"""; y = 1\n',
+]
+
+Tokens = List[Union[tokenize.GoodTokenInfo, str]]
+
+
+def collect(tokens: Iterator[tokenize.GoodTokenInfo]) -> Tokens:
+    """Return the tokens, and the exception tokenizing ends with, if any."""
+    result: Tokens = []
+    try:
+        result.extend(tokens)
+    except Exception as exc:
+        result.append(repr(exc))
+    return result
+
+
+def assert_same_tokens(source: str, grammar: Grammar) -> None:
+    expected = collect(
+        tokenize.generate_tokens(io.StringIO(source).readline, grammar=grammar)
+    )
+    assert collect(tokenizer.generate_tokens(source, grammar)) == expected
+
+
+@pytest.mark.parametrize("grammar", GRAMMARS.values(), ids=GRAMMARS.keys())
+@pytest.mark.parametrize("filename", all_data_cases("cases"))
+def test_same_tokens_as_blib2to3(filename: str, grammar: Grammar) -> None:
+    source, expected = read_data("cases", filename)
+    assert_same_tokens(source, grammar)
+    assert_same_tokens(expected, grammar)
+
+
+@pytest.mark.parametrize("grammar", GRAMMARS.values(), ids=GRAMMARS.keys())
+@pytest.mark.parametrize("source", EDGE_CASES)
+def test_same_tokens_as_blib2to3_edge_cases(source: str, grammar: Grammar) -> None:
+    assert_same_tokens(source, grammar)
+
+
+def test_supported() -> None:
+    # Not handed over to blib2to3, or the tests above wouldn't test much.
+    for filename in ["function", "expression", "comments", "pattern_matching_complex"]:
+        source, _ = read_data("cases", filename)
+        assert list(tokenizer.tokenize_source(source))
+
+
+def test_unsupported() -> None:
+    for source in ["x = 1\r\n", "s = '''abc\n", "x = (1,\n", "x = $\n"]:
+        with pytest.raises(tokenizer.Unsupported):
+            list(tokenizer.tokenize_source(source))
+
+
+def test_fast_tokenizer_mode() -> None:
+    source, _ = read_data("cases", "function")
+    mode = pyink.Mode(fast_tokenizer=True)
+    assert pyink.format_str(source, mode=mode) == pyink.format_str(
+        source, mode=pyink.Mode()
+    )
+    # The output is the same either way, so the cache is shared.
+    assert mode.get_cache_key() == pyink.Mode().get_cache_key()
@@ -0,0 +1,136 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Collection, Iterator, List, Optional, Set
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+
+import pyink
+from pyink.watch import InotifyWatcher, PollingWatcher, Watcher, watched_directories
+from tests.util import THIS_DIR
+
+
+@pytest.fixture
+def workspace() -> Iterator[Path]:
+    with TemporaryDirectory() as workspace:
+        yield Path(workspace).resolve()
+
+
+class ScriptedWatcher(Watcher):
+    """Runs the next step on every wait, and stops once there are none left."""
+
+    def __init__(self, steps: List[Callable[[], Optional[Set[Path]]]]) -> None:
+        self.steps = steps
+        self.watched: List[Set[Path]] = []
+
+    def watch(self, directories: Collection[Path]) -> None:
+        self.watched.append(set(directories))
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Set[Path]]:
+        if not self.steps:
+            raise KeyboardInterrupt
+        return self.steps.pop(0)()
+
+
+def test_watcher_is_abstract() -> None:
+    class Incomplete(Watcher):
+        def watch(self, directories: Collection[Path]) -> None:
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()  # type: ignore[abstract]
+
+
+def test_polling_watcher(workspace: Path) -> None:
+    src = workspace / "a.py"
+    src.write_text("x = 1\n", encoding="utf-8")
+    watcher = PollingWatcher(interval=0.01)
+    watcher.watch([workspace])
+    assert watcher.wait(timeout=0.05) == set()
+    src.write_text("x = 10\n", encoding="utf-8")
+    (workspace / "b.py").write_text("x = 1\n", encoding="utf-8")
+    assert watcher.wait(timeout=1) == {src, workspace / "b.py"}
+    src.unlink()
+    assert watcher.wait(timeout=1) == {src}
+
+
+def test_inotify_watcher(workspace: Path) -> None:
+    watcher = InotifyWatcher.create()
+    if watcher is None:
+        pytest.skip("inotify is not available")
+    src = workspace / "a.py"
+    src.write_text("x = 1\n", encoding="utf-8")
+    try:
+        watcher.watch([workspace])
+        assert watcher.wait(timeout=0) == set()
+        src.write_text("x = 2\n", encoding="utf-8")
+        assert watcher.wait(timeout=1) == {src}
+        # Saved through a temporary file, like many editors do.
+        (workspace / "a.py.tmp").write_text("x = 3\n", encoding="utf-8")
+        os.replace(workspace / "a.py.tmp", src)
+        assert src in (watcher.wait(timeout=1) or set())
+        (workspace / "pkg").mkdir()
+        assert watcher.wait(timeout=1) == {workspace / "pkg"}
+        watcher.watch([workspace / "pkg"])
+        src.write_text("x = 4\n", encoding="utf-8")
+        assert watcher.wait(timeout=0.05) == set()
+    finally:
+        watcher.close()
+
+
+def test_watched_directories(workspace: Path) -> None:
+    sources = [
+        workspace / "pkg" / "sub" / "a.py",
+        workspace / "pkg" / "b.py",
+        workspace / "other" / "c.py",
+    ]
+    assert watched_directories(sources, [workspace / "pkg"]) == {
+        workspace / "pkg",
+        workspace / "pkg" / "sub",
+        workspace / "other",
+    }
+
+
+def test_watch(workspace: Path) -> None:
+    pkg = workspace / "pkg"
+    pkg.mkdir()
+    src = pkg / "a.py"
+    src.write_text("x  =  1\n", encoding="utf-8")
+
+    def edit() -> Set[Path]:
+        src.write_text("x  =  10\n", encoding="utf-8")
+        return {src}
+
+    def add_package() -> Set[Path]:
+        (pkg / "sub").mkdir()
+        (pkg / "sub" / "b.py").write_text("y  =  1\n", encoding="utf-8")
+        return {pkg / "sub"}
+
+    def written_back() -> Set[Path]:
+        return {src, pkg / "sub" / "b.py"}
+
+    watcher = ScriptedWatcher([edit, add_package, written_back])
+    with patch("pyink.cache.CACHE_DIR", workspace / "cache"), patch(
+        "pyink.watch.new_watcher", return_value=watcher
+    ), patch("pyink.concurrency.ProcessPoolExecutor", new=ThreadPoolExecutor):
+        result = CliRunner().invoke(
+            pyink.main, ["--config", str(THIS_DIR / "empty.toml"), "--watch", str(pkg)]
+        )
+    assert result.exit_code == 0, result.output
+    assert src.read_text(encoding="utf-8") == "x = 10\n"
+    assert (pkg / "sub" / "b.py").read_text(encoding="utf-8") == "y = 1\n"
+    assert not watcher.steps
+    assert watcher.watched == [{pkg}, {pkg, pkg / "sub"}]
+    # Once initially, after the edit and for the new package, but not for the
+    # files pyink wrote back.
+    assert result.output.count("1 file reformatted.") == 3
+    assert "Watching for changes" in result.output
+
+
+def test_watch_stdin() -> None:
+    result = CliRunner().invoke(pyink.main, ["--watch", "-"], input="x = 1\n")
+    assert result.exit_code == 1
+    assert "Cannot use --watch with code passed in" in result.output